@@ -0,0 +1,124 @@
+"""
+Check one-pass parent_error propagation against a reference prefix search and measure its time
+
+Usage:
+    python -m benchmarks.parent_errors
+"""
+import random
+import timeit
+from operations.internal_transactions import InternalTransactions
+from config import PARITY_HOSTS
+
+TRANSACTIONS_NUMBER = 200
+TREE_DEPTH = 8
+TREE_WIDTH = 3
+ERROR_PROBABILITY = 0.05
+REPEATS = 5
+
+
+class _Trie:
+    """
+    Minimal prefix tree with the lookups of pygtrie.Trie used to define parent errors
+    """
+    def __init__(self):
+        self.children = {}
+        self.has_value = False
+
+    def __setitem__(self, key, value):
+        node = self
+        for step in key:
+            node = node.children.setdefault(step, _Trie())
+        node.has_value = True
+
+    def shortest_prefix(self, key):
+        node = self
+        for length in range(len(key) + 1):
+            if node.has_value:
+                return key[:length]
+            if length == len(key) or key[length] not in node.children:
+                return None
+            node = node.children[key[length]]
+
+    def has_key(self, key):
+        node = self
+        for step in key:
+            node = node.children.get(step)
+            if node is None:
+                return False
+        return node.has_value
+
+
+def _set_parent_errors_reference(trace):
+    """
+    Reference parent_error propagation: a transaction has a parent error
+    if a strict prefix of its traceAddress belongs to a failed transaction
+    """
+    errors = {}
+    for transaction in trace:
+        if "error" in transaction.keys():
+            if transaction["transactionHash"] not in errors.keys():
+                errors[transaction["transactionHash"]] = _Trie()
+            errors[transaction["transactionHash"]][transaction["traceAddress"]] = True
+    for transaction in trace:
+        if transaction["transactionHash"] in errors.keys():
+            errors_trie = errors[transaction["transactionHash"]]
+            prefix_exists = errors_trie.shortest_prefix(transaction["traceAddress"]) is not None
+            is_node = errors_trie.has_key(transaction["traceAddress"])
+            if prefix_exists and not is_node:
+                transaction["parent_error"] = True
+
+
+def _generate_call_tree(transaction_hash, address, depth, random_generator):
+    """
+    Generate trace of one ethereum transaction as a random call tree in order of traceAddress
+    """
+    transaction = {"transactionHash": transaction_hash, "traceAddress": address}
+    if random_generator.random() < ERROR_PROBABILITY:
+        transaction["error"] = "Out of gas"
+    tree = [transaction]
+    if depth < TREE_DEPTH:
+        for index in range(random_generator.randint(1, TREE_WIDTH)):
+            tree += _generate_call_tree(transaction_hash, address + [index], depth + 1, random_generator)
+    return tree
+
+
+def generate_trace(seed=0):
+    """
+    Generate trace with deep call trees for TRANSACTIONS_NUMBER ethereum transactions
+
+    Returns
+    -------
+    list
+        List of transactions
+    """
+    random_generator = random.Random(seed)
+    trace = []
+    for index in range(TRANSACTIONS_NUMBER):
+        trace += _generate_call_tree("0x{}".format(index), [], 0, random_generator)
+    return trace
+
+
+def _copy_trace(trace):
+    return [transaction.copy() for transaction in trace]
+
+
+def run():
+    trace = generate_trace()
+    internal_transactions = InternalTransactions({}, None, PARITY_HOSTS)
+
+    expected_trace = _copy_trace(trace)
+    _set_parent_errors_reference(expected_trace)
+    actual_trace = _copy_trace(trace)
+    internal_transactions._set_parent_errors(actual_trace)
+    assert expected_trace == actual_trace, "One-pass propagation differs from the reference"
+
+    traces = [_copy_trace(trace) for _ in range(REPEATS)]
+    stack_time = min(timeit.repeat(lambda: internal_transactions._set_parent_errors(traces.pop()), number=1,
+                                   repeat=REPEATS))
+    print("Transactions in trace: {}".format(len(trace)))
+    print("Failed transactions: {}".format(len([t for t in trace if "error" in t])))
+    print("one pass: {:.4f}s".format(stack_time))
+
+
+if __name__ == '__main__':
+    run()
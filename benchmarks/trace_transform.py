@@ -0,0 +1,148 @@
+"""
+Compare single-pass transformation of traces to columns with the previous per-transaction implementation
+
+Usage:
+    python -m benchmarks.trace_transform
+"""
+import random
+import timeit
+import utils
+from operations.internal_transactions import InternalTransactions
+from benchmarks.parent_errors import generate_trace, _copy_trace
+from config import PARITY_HOSTS
+
+REPEATS = 5
+
+
+def _set_trace_hashes(trace):
+    """
+    Previous implementation of InternalTransactions._set_trace_hashes
+    """
+    traces_size = {}
+    for transaction in trace:
+        transaction_hash = transaction["transactionHash"] or transaction["blockHash"]
+        if transaction_hash not in traces_size.keys():
+            traces_size[transaction_hash] = 0
+        transaction["hash"] = "{}.{}".format(transaction_hash, traces_size[transaction_hash])
+        traces_size[transaction_hash] += 1
+
+
+def _preprocess_internal_transaction(transaction):
+    """
+    Previous implementation of InternalTransactions._preprocess_internal_transaction
+    """
+    transaction = transaction.copy()
+    for field in ["action", "result"]:
+        if (field in transaction.keys()) and (transaction[field]):
+            transaction.update(transaction[field])
+            del transaction[field]
+    for field in ["value", "gasPrice", "gasUsed"]:
+        if (field in transaction.keys()) and (transaction[field]):
+            value_string = transaction[field][0:2] + "0" + transaction[field][2:]
+            transaction[field] = int(value_string, 0) / 1e18
+    if "gasUsed" in transaction:
+        transaction["gasUsed"] = int(transaction["gasUsed"] * 1e18)
+    return transaction
+
+
+def _transform_traces_previous(internal_transactions, trace):
+    """
+    Previous transformation and conversion of trace to columns before insertion
+    """
+    _set_trace_hashes(trace)
+    internal_transactions._set_parent_errors(trace)
+    internal_docs = [
+        _preprocess_internal_transaction(transaction) for transaction in trace if transaction["transactionHash"]
+    ]
+    miner_docs = [
+        _preprocess_internal_transaction(transaction) for transaction in trace if not transaction["transactionHash"]
+    ]
+    return utils.make_columns(internal_docs), utils.make_columns(miner_docs)
+
+
+def generate_parity_trace(seed=0):
+    """
+    Generate trace with deep call trees in the format of parity trace_block response
+
+    Returns
+    -------
+    list
+        List of transactions
+    """
+    random_generator = random.Random(seed)
+    trace = []
+    for transaction in generate_trace(seed):
+        transaction_hash = transaction["transactionHash"]
+        trace.append(dict(
+            transaction,
+            blockHash="0x1",
+            blockNumber=1,
+            subtraces=0,
+            transactionPosition=int(transaction_hash, 0),
+            type="call",
+            gasPrice=hex(random_generator.randint(1, 10 ** 11)),
+            action={
+                "callType": "call",
+                "from": "0x{:040x}".format(random_generator.getrandbits(160)),
+                "to": "0x{:040x}".format(random_generator.getrandbits(160)),
+                "gas": hex(random_generator.randint(0, 10 ** 6)),
+                "input": "0x",
+                "value": hex(random_generator.randint(0, 10 ** 20))
+            },
+            result=None if "error" in transaction else {
+                "gasUsed": hex(random_generator.randint(0, 10 ** 6)),
+                "output": "0x"
+            }
+        ))
+    trace.append({
+        "transactionHash": None,
+        "blockHash": "0x1",
+        "blockNumber": 1,
+        "subtraces": 0,
+        "traceAddress": [],
+        "type": "reward",
+        "action": {"author": "0x1", "rewardType": "block", "value": hex(2 * 10 ** 18)},
+        "result": None
+    })
+    return trace
+
+
+def _assert_equal_columns(expected, actual):
+    """
+    Check that columns of both implementations are the same
+
+    Previous implementation could floor gasUsed by one because of conversion through ether
+    """
+    for field, values in expected.items():
+        if field == "gasUsed":
+            assert all((value is None and actual_value is None) or abs(value - actual_value) <= 1
+                       for value, actual_value in zip(values, actual[field])), "Implementations return different gasUsed"
+        elif field == "parent_error":
+            assert [bool(value) for value in values] == [bool(value) for value in actual[field]], \
+                "Implementations return different parent_error"
+        elif field != "result":
+            assert values == actual[field], "Implementations return different {}".format(field)
+
+
+def run():
+    trace = generate_parity_trace()
+    internal_transactions = InternalTransactions({}, None, PARITY_HOSTS)
+
+    expected_columns = _transform_traces_previous(internal_transactions, _copy_trace(trace))
+    actual_columns = internal_transactions._transform_traces(_copy_trace(trace))
+    for expected, actual in zip(expected_columns, actual_columns):
+        _assert_equal_columns(expected, actual)
+
+    traces = [_copy_trace(trace) for _ in range(2 * REPEATS)]
+    previous_time = min(timeit.repeat(lambda: _transform_traces_previous(internal_transactions, traces.pop()),
+                                      number=1, repeat=REPEATS))
+    single_pass_time = min(timeit.repeat(lambda: internal_transactions._transform_traces(traces.pop()), number=1,
+                                         repeat=REPEATS))
+    print("Transactions in trace: {}".format(len(trace)))
+    print("previous: {:.4f}s".format(previous_time))
+    print("single pass: {:.4f}s".format(single_pass_time))
+    print("Speedup: {:.1f}x".format(previous_time / single_pass_time))
+
+
+if __name__ == '__main__':
+    run()
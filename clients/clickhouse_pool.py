@@ -0,0 +1,215 @@
+import os
+import time
+import atexit
+from threading import Condition
+from clickhouse_driver import Client
+from clickhouse_driver.errors import ServerException
+from config import MAX_MEMORY_USAGE, CLICKHOUSE_POOL_SIZE, CLICKHOUSE_POOL_TIMEOUT, CLICKHOUSE_PING_INTERVAL
+
+_pools = {}
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def create_connection():
+    """
+    Create clickhouse connection and set initial parameters (for example, max memory usage)
+
+    Settings are sent with each query, so they survive reconnects
+
+    Returns
+    -------
+    clickhouse_driver.Client
+        Connection to a clickhouse
+    """
+    # TODO wait for clickhouse port
+    return Client('localhost', send_receive_timeout=10000, settings={"max_memory_usage": MAX_MEMORY_USAGE})
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of clickhouse connections
+
+    Idle connections are reused in LIFO order. Connections idle for longer than
+    ping_interval seconds are pinged before reuse and replaced if the server doesn't answer
+    """
+    def __init__(self, create=create_connection, max_size=CLICKHOUSE_POOL_SIZE, timeout=CLICKHOUSE_POOL_TIMEOUT,
+                 ping_interval=CLICKHOUSE_PING_INTERVAL):
+        self._create = create
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = Condition()
+
+    def _is_healthy(self, connection, idle_since):
+        """
+        Check if idle connection can be reused
+
+        Parameters
+        ----------
+        connection : clickhouse_driver.Client
+            Idle connection
+        idle_since : float
+            Time of connection release
+
+        Returns
+        -------
+        bool
+            True if connection is alive or was used recently
+        """
+        if not connection.connection.connected:
+            return True
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            return connection.connection.ping()
+        except Exception:
+            return False
+
+    def acquire(self):
+        """
+        Take connection from pool, create a new one if pool is not full
+
+        Waits for a released connection if pool is full
+
+        Returns
+        -------
+        clickhouse_driver.Client
+            Connection to a clickhouse
+
+        Raises
+        ------
+        PoolTimeoutError
+            If no connection was released in timeout seconds
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                    if self._is_healthy(connection, idle_since):
+                        return connection
+                    connection.disconnect()
+                    self._size -= 1
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError("No clickhouse connection released in {} seconds".format(self.timeout))
+                self._condition.wait(remaining)
+        try:
+            return self._create()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection, reusable=True):
+        """
+        Return connection to pool
+
+        Parameters
+        ----------
+        connection : clickhouse_driver.Client
+            Connection taken from pool
+        reusable : bool
+            False if connection is in unknown state (for example, after interrupted query)
+        """
+        with self._condition:
+            if reusable and not self._closed:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                connection.disconnect()
+                self._size -= 1
+            self._condition.notify()
+
+    def close(self):
+        """
+        Disconnect idle connections and stop giving out new ones
+
+        Connections in use are disconnected when released
+        """
+        with self._condition:
+            self._closed = True
+            for connection, _ in self._idle:
+                connection.disconnect()
+            self._size -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+
+def get_pool():
+    """
+    Get connection pool shared by all clickhouse clients of current process
+
+    Each forked process gets its own pool, so connections are never shared between processes
+
+    Returns
+    -------
+    ConnectionPool
+        Shared pool
+    """
+    pid = os.getpid()
+    if pid not in _pools:
+        _pools[pid] = ConnectionPool()
+    return _pools[pid]
+
+
+def close_pool():
+    """
+    Disconnect pooled connections of current process
+    """
+    pool = _pools.pop(os.getpid(), None)
+    if pool:
+        pool.close()
+
+
+atexit.register(close_pool)
+
+
+class PooledClient:
+    """
+    Drop-in replacement of clickhouse_driver.Client which takes a pooled connection for each query
+    """
+    def __init__(self, pool=None):
+        self._pool = pool
+
+    @property
+    def pool(self):
+        return self._pool or get_pool()
+
+    def execute(self, *args, **kwargs):
+        pool = self.pool
+        connection = pool.acquire()
+        reusable = False
+        try:
+            result = connection.execute(*args, **kwargs)
+            reusable = True
+            return result
+        except ServerException:
+            reusable = True
+            raise
+        finally:
+            pool.release(connection, reusable)
+
+    def execute_iter(self, *args, **kwargs):
+        """
+        Stream query results, connection is kept until the generator is exhausted or closed
+        """
+        pool = self.pool
+        connection = pool.acquire()
+        reusable = False
+        try:
+            yield from connection.execute_iter(*args, **kwargs)
+            reusable = True
+        finally:
+            pool.release(connection, reusable)
@@ -1,34 +1,189 @@
-from clickhouse_driver import Client
+from clients.clickhouse_pool import PooledClient
 from utils import split_on_chunks
-from config import NUMBER_OF_JOBS, MAX_CHUNK_SIZE
+from config import NUMBER_OF_JOBS, MAX_CHUNK_SIZE, MAX_CHUNK_ROWS, ITERATE_COUNT
 from clients.custom_client import CustomClient
 from tqdm import tqdm
 import json
-from config import MAX_MEMORY_USAGE
-import sys
+import re
+import numpy as np
+from datetime import datetime
+from threading import Thread
+
+
+def _convert_string(value):
+    if (value is None) or (type(value) is str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, bytes):
+        return value
+    return str(value)
+
+
+def _convert_int(value):
+    if (value is None) or (type(value) is int):
+        return value
+    if isinstance(value, str):
+        return int(value, 0)
+    return int(value)
+
+
+def _convert_float(value):
+    if (value is None) or (type(value) is float):
+        return value
+    return float(value)
+
+
+def _convert_datetime(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return value
+
+
+def _create_converter(field_type):
+    """
+    Create function that converts python value to a type of clickhouse column
+
+    Parameters
+    ----------
+    field_type : str
+        Clickhouse type of column, i.e. Nullable(Int32)
+
+    Returns
+    -------
+    function
+        Function that returns converted value.
+        None if values of this type are passed to clickhouse as is
+    """
+    if field_type.startswith("Nullable("):
+        return _create_converter(field_type[len("Nullable("):-1])
+    if field_type.startswith("Array("):
+        element_converter = _create_converter(field_type[len("Array("):-1])
+        if element_converter:
+            return lambda value: [element_converter(element) for element in value] if value is not None else value
+        return None
+    if field_type in ("String", "UUID") or field_type.startswith("FixedString"):
+        return _convert_string
+    if field_type.startswith("Int") or field_type.startswith("UInt"):
+        return _convert_int
+    if field_type.startswith("Float"):
+        return _convert_float
+    if field_type.startswith("DateTime"):
+        return _convert_datetime
+    return None
+
+
+def _get_varint_size(number):
+    size = 1
+    while number >= 128:
+        number >>= 7
+        size += 1
+    return size
+
+
+def _estimate_size(value):
+    """
+    Estimate size of value in clickhouse native format by its python type
+
+    Parameters
+    ----------
+    value
+        Value of any type
+
+    Returns
+    -------
+    int
+        Number of bytes
+    """
+    if isinstance(value, (str, bytes)):
+        return _get_varint_size(len(value)) + len(value)
+    if isinstance(value, (bool, type(None))):
+        return 1
+    if isinstance(value, (list, tuple)):
+        return 8 + sum(_estimate_size(element) for element in value)
+    if isinstance(value, dict):
+        return _estimate_size(json.dumps(value))
+    if isinstance(value, np.generic):
+        return value.nbytes
+    return 8
+
+
+FIXED_TYPE_SIZES = {"Date": 2, "DateTime": 4, "DateTime64": 8, "UUID": 16, "Enum8": 1, "Enum16": 2}
+
+
+def _get_fixed_size(field_type):
+    """
+    Get size of fixed-width clickhouse type
+
+    Parameters
+    ----------
+    field_type : str
+        Clickhouse type of column, i.e. UInt8
+
+    Returns
+    -------
+    int
+        Number of bytes. None for types with variable width
+    """
+    match = re.fullmatch(r"U?Int(\d+)|Float(\d+)|Decimal(\d+)", field_type)
+    if match:
+        return int(next(bits for bits in match.groups() if bits)) // 8
+    match = re.fullmatch(r"FixedString\((\d+)\)", field_type)
+    if match:
+        return int(match.group(1))
+    return FIXED_TYPE_SIZES.get(field_type.split("(")[0])
+
+
+def _create_size_estimator(field_type):
+    """
+    Create function that estimates size of value in a column of clickhouse native format
+
+    Fixed-width types are measured by the type, other types by the value
+
+    Parameters
+    ----------
+    field_type : str
+        Clickhouse type of column, i.e. Nullable(Int32)
+
+    Returns
+    -------
+    function
+        Function that returns number of bytes
+    """
+    if field_type.startswith("LowCardinality("):
+        return _create_size_estimator(field_type[len("LowCardinality("):-1])
+    if field_type.startswith("Nullable("):
+        element_estimator = _create_size_estimator(field_type[len("Nullable("):-1])
+        return lambda value: 1 + element_estimator(value)
+    if field_type.startswith("Array("):
+        element_estimator = _create_size_estimator(field_type[len("Array("):-1])
+        return lambda value: 8 + sum(element_estimator(element) for element in value or [])
+    fixed_size = _get_fixed_size(field_type)
+    if fixed_size:
+        return lambda value: fixed_size
+    return _estimate_size
+
+
+SCHEMA_CHANGING_STATEMENTS = ("CREATE", "DROP", "ALTER", "RENAME")
+
 
 class CustomClickhouse(CustomClient):
+    _schemas = {}
+
     def _create_client(self):
         """
-        Create clickhouse connection and set initial parameters (for example, max memory usage)
+        Create clickhouse client which takes connections from the process-wide pool
 
         Returns
         -------
-        client : clickhouse_driver.Client
-            Initialized connection to a clickhouse
+        client : clients.clickhouse_pool.PooledClient
+            Client with the interface of clickhouse_driver.Client
         """
-        # TODO wait for clickhouse port
-        client = Client('localhost', send_receive_timeout=10000)
-        client.execute("SET max_memory_usage = {}".format(MAX_MEMORY_USAGE))
-        # client.execute("SET joined_subquery_requires_alias=0")
-        return client
+        return PooledClient()
 
     def __init__(self):
         self.client = self._create_client()
 
-    def __del__(self):
-        self.client.disconnect()
-
     def _create_sql_query(self, index, query, fields, final=True):
         fields_string = ",".join(fields)
         sql = 'SELECT {} FROM {}'.format(fields_string, index)
@@ -92,7 +247,64 @@ class CustomClickhouse(CustomClient):
         sql = self._create_sql_query(index, query, ["COUNT(*)"], final)
         return self.client.execute(sql)[0][0]
 
-    def iterate(self, index, fields, query=None, per=NUMBER_OF_JOBS, return_id=True, final=True):
+    def estimate_count(self, index, query=None, final=True, **kwargs):
+        """
+        Estimate number of records in a given table without a full scan
+
+        Uses EXPLAIN ESTIMATE of the query, falls back to the number of rows
+        in active parts of the table if the query can't be estimated
+
+        Parameters
+        -------
+        index : str
+            Name of table
+        query : str
+            Last part of query
+        final : bool
+            To skip or not to skip repeating records in tables with updated records
+
+        Returns
+        -------
+        int
+            Estimated number of records in database
+        """
+        sql = self._create_sql_query(index, query, ["COUNT(*)"], final)
+        try:
+            return sum(row[-1] for row in self.client.execute("EXPLAIN ESTIMATE " + sql))
+        except Exception:
+            parts_sql = "SELECT sum(rows) FROM system.parts " \
+                        "WHERE active AND database = currentDatabase() AND table = '{}'".format(index)
+            return self.client.execute(parts_sql)[0][0]
+
+    def _count_in_background(self, index, query, final, progress_bar):
+        """
+        Count records in a separate thread, then set total of progress bar
+
+        Parameters
+        -------
+        index : str
+            Name of table
+        query : str
+            Last part of query
+        final : bool
+            To skip or not to skip repeating records in tables with updated records
+        progress_bar : tqdm.tqdm
+            Progress bar to update
+
+        Returns
+        -------
+        threading.Thread
+            Started counting thread
+        """
+        def count():
+            sql = self._create_sql_query(index, query, ["COUNT(*)"], final)
+            progress_bar.total = self.client.execute(sql)[0][0]
+            progress_bar.refresh()
+        thread = Thread(target=count, daemon=True)
+        thread.start()
+        return thread
+
+    def iterate(self, index, fields, query=None, per=NUMBER_OF_JOBS, return_id=True, final=True, count=ITERATE_COUNT):
         """
         Iterate over records in a table
 
@@ -110,31 +322,46 @@ class CustomClickhouse(CustomClient):
             To return id in _id field of document
         final : bool
             To skip or not to skip repeating records in tables with updated records
+        count : str
+            How to get total of progress bar:
+            None to skip counting, "estimate" to estimate it without a full scan,
+            "parallel" to run exact count in a separate connection during iteration
 
         Returns
         -------
         int
             Number of records in database
         """
-        iterate_client = self._create_client()
         if return_id:
             fields += ["id"]
         settings = {'max_block_size': per}
         sql = self._create_sql_query(index, query, fields, final)
-        generator = iterate_client.execute_iter(sql, settings=settings)
-        count = self.count(index, query, final)
-        progress_bar = tqdm(total=count)
-        for chunk in split_on_chunks(generator, per):
-            progress_bar.update(per)
-            yield self._convert_values_to_dict(chunk, fields)
-
-    def _prepare_fields(self, docs, fields):
+        generator = self.client.execute_iter(sql, settings=settings)
+        total = self.estimate_count(index, query, final) if count == "estimate" else None
+        progress_bar = tqdm(total=total)
+        if count == "parallel":
+            self._count_in_background(index, query, final, progress_bar)
+        try:
+            for chunk in split_on_chunks(generator, per):
+                progress_bar.update(len(chunk))
+                yield self._convert_values_to_dict(chunk, fields)
+        finally:
+            progress_bar.close()
+
+    def _prepare_fields(self, docs, fields, converters={}):
+        converters = {field: converters[field] for field in fields if converters.get(field)}
         for document in docs:
             for field in fields:
                 if field not in document:
                     document[field] = None
-                elif type(document[field]) == dict:
-                    document[field] = json.dumps(document[field])
+            for field, convert in converters.items():
+                document[field] = convert(document[field])
+
+    def _prepare_columns(self, columns, converters):
+        for field, values in columns.items():
+            convert = converters.get(field)
+            if convert:
+                columns[field] = [convert(value) for value in values]
 
     def _set_id(self, docs, id_field):
         for document in docs:
@@ -142,28 +369,186 @@ class CustomClickhouse(CustomClient):
             del document[id_field]
             document["id"] = id
 
+    def _get_schema(self, index):
+        """
+        Get names and types of table columns
+
+        Schema is loaded from database once and shared by all clients within a process
+
+        Parameters
+        -------
+        index : str
+            Name of table
+
+        Returns
+        -------
+        dict
+            Set of column names in "fields", column types in "types",
+            functions to convert values to column types in "converters"
+            and functions to estimate size of values in "sizes"
+        """
+        if index not in self._schemas:
+            types = {field[0]: field[1] for field in self.client.execute("DESCRIBE TABLE {}".format(index))}
+            self._schemas[index] = {
+                "fields": frozenset(types.keys()),
+                "types": types,
+                "converters": {field: _create_converter(field_type) for field, field_type in types.items()},
+                "sizes": {field: _create_size_estimator(field_type) for field, field_type in types.items()}
+            }
+        return self._schemas[index]
+
+    def refresh_schema(self, index=None):
+        """
+        Forget loaded schema of a table, so it will be loaded again before next insert
+
+        Should be called after each change of table structure
+
+        Parameters
+        -------
+        index : str
+            Name of table. Schemas of all tables will be forgotten if not specified
+        """
+        if index is None:
+            self._schemas.clear()
+        else:
+            self._schemas.pop(index, None)
+
+    def _get_table_fields(self, index):
+        return self._get_schema(index)["fields"]
+
     def _filter_schema(self, docs, index):
-        fields = self.client.execute("DESCRIBE TABLE {}".format(index))
-        whitelist = [field[0] for field in fields]
+        whitelist = self._get_table_fields(index)
         for document in docs:
             blacklisted_keys = set([key for key in document if key not in whitelist])
             for key in blacklisted_keys:
                 del document[key]
 
-    def _split_records(self, records, max_bytes=MAX_CHUNK_SIZE):
-        buffer = []
-        current_bytes = 0
-        for record in records:
-            record_bytes = sys.getsizeof(record)
-            if current_bytes + record_bytes > max_bytes:
-                if current_bytes >= 2 * max_bytes:
-                    print("The size of chunk is much bigger then the limit")
-                yield buffer
-                buffer = []
-                current_bytes = 0
-            current_bytes += record_bytes
-            buffer.append(record)
-        yield buffer
+    def _split_rows(self, row_sizes, max_bytes=MAX_CHUNK_SIZE, max_rows=MAX_CHUNK_ROWS):
+        """
+        Split rows onto consecutive chunks limited by estimated size and number of rows
+
+        Sizes of chosen chunks are saved to chunk_sizes attribute
+
+        Parameters
+        -------
+        row_sizes : numpy.ndarray
+            Estimated size of each row
+        max_bytes : int
+            Max size of chunk, a chunk with one row can be bigger
+        max_rows : int
+            Max number of rows in chunk
+
+        Returns
+        -------
+        list
+            List of (start, end) pairs of row indices
+        """
+        cumulative_sizes = np.cumsum(row_sizes)
+        bounds = []
+        start = 0
+        while start < len(row_sizes):
+            offset = cumulative_sizes[start - 1] if start else 0
+            end = int(np.searchsorted(cumulative_sizes, offset + max_bytes, side="right"))
+            end = min(max(end, start + 1), start + max_rows)
+            bounds.append((start, end))
+            start = end
+        self.chunk_sizes = [(end - start, int(row_sizes[start:end].sum())) for start, end in bounds]
+        for rows, chunk_bytes in self.chunk_sizes:
+            if chunk_bytes >= 2 * max_bytes:
+                print("The size of chunk is much bigger then the limit")
+        return bounds
+
+    def _split_records(self, records, sizes={}, max_bytes=MAX_CHUNK_SIZE, max_rows=MAX_CHUNK_ROWS):
+        """
+        Split records onto chunks by estimated size in clickhouse native format
+
+        Parameters
+        -------
+        records : list
+            List of records
+        sizes : dict
+            Functions to estimate size of value for each field
+        max_bytes : int
+            Max size of chunk
+        max_rows : int
+            Max number of rows in chunk
+
+        Returns
+        -------
+        generator
+            Generator that returns list of records on each iteration
+        """
+        row_sizes = np.array([
+            sum(sizes.get(field, _estimate_size)(value) for field, value in record.items())
+            for record in records
+        ], dtype=np.int64)
+        for start, end in self._split_rows(row_sizes, max_bytes, max_rows):
+            yield records[start:end]
+
+    def _get_column_sizes(self, values, size=_estimate_size):
+        return np.fromiter((size(value) for value in values), dtype=np.int64, count=len(values))
+
+    def _split_columns(self, columns, sizes=[], max_bytes=MAX_CHUNK_SIZE, max_rows=MAX_CHUNK_ROWS):
+        """
+        Split columns onto chunks by estimated size in clickhouse native format
+
+        Parameters
+        -------
+        columns : list
+            List of columns with the same length
+        sizes : list
+            Functions to estimate size of value for each column
+        max_bytes : int
+            Max size of chunk
+        max_rows : int
+            Max number of rows in chunk
+
+        Returns
+        -------
+        generator
+            Generator that returns list of columns slices on each iteration
+        """
+        sizes = list(sizes) or [_estimate_size] * len(columns)
+        row_sizes = np.zeros(len(columns[0]), dtype=np.int64)
+        for values, size in zip(columns, sizes):
+            row_sizes += self._get_column_sizes(values, size)
+        for start, end in self._split_rows(row_sizes, max_bytes, max_rows):
+            yield [values[start:end] for values in columns]
+
+    def _set_columns_id(self, columns, id_field):
+        columns = dict(columns)
+        columns["id"] = [str(id) for id in columns.pop(id_field)]
+        return columns
+
+    def bulk_index_columns(self, index, columns, id_field="id", **kwargs):
+        """
+        Add given columns to a table within one query
+
+        Values are sent in columnar form without creation of a dict for each record
+
+        Parameters
+        -------
+        index : str
+            Name of table
+        columns : dict
+            Field names and lists of values with the same length
+        id_field : str
+            Name of field with record id
+        """
+        columns = self._set_columns_id(columns, id_field)
+        schema = self._get_schema(index)
+        columns = {field: values for field, values in columns.items() if field in schema["fields"]}
+        if not len(columns["id"]):
+            return
+        self._prepare_columns(columns, schema["converters"])
+        fields_string = ",".join(columns.keys())
+        sizes = [schema["sizes"][field] for field in columns.keys()]
+        for chunk in self._split_columns(list(columns.values()), sizes):
+            self.client.execute(
+                'INSERT INTO {} ({}) VALUES'.format(index, fields_string),
+                chunk,
+                columnar=True
+            )
 
     def bulk_index(self, index, docs, id_field="id", **kwargs):
         """
@@ -181,27 +566,34 @@ class CustomClickhouse(CustomClient):
         self._set_id(docs, id_field)
         self._filter_schema(docs, index)
         fields = list(set([field for doc in docs for field in doc.keys()]))
-        self._prepare_fields(docs, fields)
+        schema = self._get_schema(index)
+        self._prepare_fields(docs, fields, schema["converters"])
         fields_string = ",".join(fields)
-        for chunk in self._split_records(docs):
+        for chunk in self._split_records(docs, schema["sizes"]):
             self.client.execute(
                 'INSERT INTO {} ({}) VALUES'.format(index, fields_string),
                 chunk
             )
 
-    def send_sql_request(self, sql):
+    def send_sql_request(self, sql, settings=None):
         """
         Send sql query and return result as scalar table
 
+        Loaded table schemas are forgotten after queries which can change table structure
+
         Parameters
         -------
         sql : str
             Query to send
+        settings : dict
+            Clickhouse settings of the query
 
         Returns
         -------
         Content of the first cell of returned table
         """
-        result = self.client.execute(sql)
+        result = self.client.execute(sql, settings=settings)
+        if sql.lstrip().upper().startswith(SCHEMA_CHANGING_STATEMENTS):
+            self.refresh_schema()
         if result:
             return result[0][0]
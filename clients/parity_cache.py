@@ -0,0 +1,624 @@
+import os
+import time
+import json
+import zlib
+import mmap
+import bisect
+from threading import Lock
+from config import PARITY_CACHE_PATH
+
+SEGMENT_MAX_SIZE = 2 ** 28
+
+BLOCK_PARAMETERS = {
+    "trace_block": lambda params: params[0],
+    "eth_getBlockByNumber": lambda params: params[0],
+    "eth_getLogs": lambda params: params[0].get("toBlock")
+}
+
+_caches = {}
+
+
+def get_key(request):
+    """
+    Get cache key of JSON RPC request
+
+    Only requests to specific blocks are cached,
+    requests with block tags like "latest" can return different results
+
+    Parameters
+    ----------
+    request : dict
+        JSON RPC request
+
+    Returns
+    -------
+    str
+        Method and parameters of request, None if request can't be cached
+    """
+    get_block = BLOCK_PARAMETERS.get(request.get("method"))
+    if not get_block:
+        return None
+    try:
+        int(get_block(request["params"]), 16)
+    except (TypeError, ValueError, KeyError, IndexError, AttributeError):
+        return None
+    return request["method"] + json.dumps(request["params"], sort_keys=True, separators=(",", ":"))
+
+
+def get_block(request):
+    """
+    Get last block affected by cached JSON RPC request
+
+    Parameters
+    ----------
+    request : dict
+        JSON RPC request with a cache key
+
+    Returns
+    -------
+    int
+        Block number
+    """
+    return int(BLOCK_PARAMETERS[request["method"]](request["params"]), 16)
+
+
+def get_logs_range(request):
+    """
+    Get block range of eth_getLogs request without address and topics filters
+
+    Parameters
+    ----------
+    request : dict
+        JSON RPC request
+
+    Returns
+    -------
+    tuple
+        Start and end of block range (end is not included), None for other requests
+    """
+    if request.get("method") != "eth_getLogs" or get_key(request) is None:
+        return None
+    log_filter = request["params"][0]
+    if set(log_filter.keys()) != {"fromBlock", "toBlock"}:
+        return None
+    return int(log_filter["fromBlock"], 16), int(log_filter["toBlock"], 16) + 1
+
+
+def _parse_key(key):
+    """
+    Get method and block of cache key
+
+    Parameters
+    ----------
+    key : str
+        Cache key
+
+    Returns
+    -------
+    tuple
+        Method name and block number
+    """
+    params_start = key.index("[")
+    method = key[:params_start]
+    return method, get_block({"method": method, "params": json.loads(key[params_start:])})
+
+
+def _make_index_line(method, block, key, offset=None, length=None):
+    """
+    Make line of segment index
+
+    Lines start with method and zero-padded block, so sorted lines are ordered by block within each method
+
+    Parameters
+    ----------
+    method : str
+        Method of request
+    block : int
+        Block of request
+    key : str
+        Cache key
+    offset : int
+        Offset of record in segment, None to make a prefix for search
+    length : int
+        Length of compressed record
+
+    Returns
+    -------
+    str
+        Line of index
+    """
+    line = "{}\t{:012d}\t{}\t".format(method, block, key)
+    if offset is not None:
+        line += "{}\t{}\n".format(offset, length)
+    return line
+
+
+def _parse_index_line(line):
+    """
+    Parse line of segment index
+
+    Parameters
+    ----------
+    line : str
+        Line of index, lines with only key, offset and length are also supported
+
+    Returns
+    -------
+    tuple
+        Method, block, key, offset and length of record, None if line was not completely written
+    """
+    fields = line.rstrip("\n").split("\t")
+    try:
+        if len(fields) == 3:
+            key, offset, length = fields
+            method, block = _parse_key(key)
+        else:
+            method, block, key, offset, length = fields
+            block = int(block)
+        return method, block, key, int(offset), int(length)
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def _get_logs_key_range(key):
+    return get_logs_range({"method": "eth_getLogs", "params": json.loads(key[len("eth_getLogs"):])})
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SegmentIndex:
+    """
+    Sorted index of a finished segment
+
+    Index file is memory-mapped on the first lookup and searched by binary search,
+    so its lines are never loaded into memory. Blocks range of segment is kept in a small meta file
+    and checked before the index is opened
+    """
+    def __init__(self, path, segment, meta):
+        self.path = path
+        self.segment = segment
+        self.min_block = meta["min_block"]
+        self.max_block = meta["max_block"]
+        self.max_logs_range_size = meta["max_logs_range_size"]
+        self._map = None
+        self._lock = Lock()
+
+    def _get_map(self):
+        with self._lock:
+            if self._map is None:
+                with open(os.path.join(self.path, self.segment[:-len(".seg")] + ".sidx"), "rb") as index_file:
+                    self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map
+
+    def _bisect(self, prefix):
+        """
+        Find the first line which is not less than prefix
+
+        Parameters
+        ----------
+        prefix : bytes
+            Beginning of line
+
+        Returns
+        -------
+        int
+            Offset of line in index file
+        """
+        data = self._get_map()
+        low, high = 0, len(data)
+        while low < high:
+            middle = (low + high) // 2
+            line_start = data.rfind(b"\n", 0, middle) + 1
+            line_end = data.find(b"\n", line_start)
+            if data[line_start:line_end] < prefix:
+                low = line_end + 1
+            else:
+                high = line_start
+        return low
+
+    def iterate_lines(self, start_prefix, end_prefix):
+        """
+        Iterate over index lines between two prefixes
+
+        Parameters
+        ----------
+        start_prefix : str
+            First line prefix
+        end_prefix : str
+            Line prefix to stop at, not included
+
+        Returns
+        -------
+        generator
+            Generator that returns tuples with method, block, key, offset and length of records
+        """
+        data = self._get_map()
+        position = self._bisect(start_prefix.encode())
+        end_prefix = end_prefix.encode()
+        while position < len(data):
+            line_end = data.find(b"\n", position)
+            line = data[position:line_end]
+            if line >= end_prefix:
+                return
+            yield _parse_index_line(line.decode())
+            position = line_end + 1
+
+    def get(self, method, block, key):
+        """
+        Get location of record
+
+        Parameters
+        ----------
+        method : str
+            Method of request
+        block : int
+            Block of request
+        key : str
+            Cache key
+
+        Returns
+        -------
+        tuple
+            Segment name, offset and length of compressed record, None if there is no such record
+        """
+        if self.min_block is None or not self.min_block <= block <= self.max_block:
+            return None
+        prefix = _make_index_line(method, block, key)
+        for record in self.iterate_lines(prefix, prefix[:-1] + "\n"):
+            return (self.segment,) + record[3:]
+
+    def iterate_logs_ranges(self, block):
+        """
+        Iterate over stored eth_getLogs block ranges that cover a block
+
+        Parameters
+        ----------
+        block : int
+            Block number
+
+        Returns
+        -------
+        generator
+            Generator that returns tuples with start, end and location of records
+        """
+        if self.min_block is None or not self.max_logs_range_size:
+            return
+        last_block = block + self.max_logs_range_size - 1
+        if self.max_block < block or self.min_block > last_block:
+            return
+        lines = self.iterate_lines(
+            _make_index_line("eth_getLogs", block, ""), _make_index_line("eth_getLogs", last_block + 1, "")
+        )
+        for method, line_block, key, offset, length in lines:
+            logs_range = _get_logs_key_range(key)
+            if logs_range and logs_range[0] <= block:
+                yield logs_range + ((self.segment, offset, length),)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+
+class ResponseCache:
+    """
+    Append-only on-disk store of JSON RPC results
+
+    Results are compressed and appended to segment files.
+    Each segment has an index file with method, block, key, offset and length of each record.
+    Each process writes to its own segments, segments of other processes are only read.
+    When a segment is finished, its index is sorted and the range of its blocks is saved to a meta file,
+    so only meta files are read on start and lookups search sorted indices of segments with a matching block.
+    Only indices of segments which are still written are kept in memory
+    """
+    def __init__(self, path, segment_max_size=SEGMENT_MAX_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_max_size = segment_max_size
+        self._index = {}
+        self._logs_ranges = []
+        self._max_logs_range_size = 0
+        self._segments = []
+        self._files = {}
+        self._segment = None
+        self._segment_index = None
+        self._segment_records = None
+        self._segments_count = 0
+        self._lock = Lock()
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Read meta files of finished segments and indices of segments which are still written
+
+        Segments left unfinished by stopped processes are finished.
+        Records which were not completely written are skipped
+        """
+        file_names = set(os.listdir(self.path))
+        for file_name in sorted(file_names):
+            if not file_name.endswith(".seg"):
+                continue
+            name = file_name[:-len(".seg")]
+            if name + ".meta" in file_names:
+                self._add_segment(file_name)
+            elif name + ".idx" in file_names:
+                try:
+                    records = self._read_segment_index(file_name)
+                    if _is_process_alive(int(name.split("-")[1])):
+                        for record in records:
+                            self._add_to_index(record[2], (file_name,) + record[3:])
+                    else:
+                        self._finish_segment(file_name, records)
+                except FileNotFoundError:
+                    # Segment was finished by another process meanwhile
+                    self._add_segment(file_name)
+
+    def _read_segment_index(self, segment):
+        """
+        Read unsorted index of segment
+
+        Parameters
+        ----------
+        segment : str
+            Segment name
+
+        Returns
+        -------
+        list
+            Tuples with method, block, key, offset and length of completely written records
+        """
+        segment_size = os.path.getsize(os.path.join(self.path, segment))
+        records = []
+        with open(os.path.join(self.path, segment[:-len(".seg")] + ".idx")) as index_file:
+            for line in index_file:
+                record = _parse_index_line(line)
+                if record and line.endswith("\n") and record[3] + record[4] <= segment_size:
+                    records.append(record)
+        return records
+
+    def _finish_segment(self, segment, records):
+        """
+        Save sorted index and meta file of segment and start searching it on disk
+
+        Files are replaced atomically, the meta file is written last,
+        so segments are used only with complete sorted indices
+
+        Parameters
+        ----------
+        segment : str
+            Segment name
+        records : list
+            Tuples with method, block, key, offset and length of records
+        """
+        name = os.path.join(self.path, segment[:-len(".seg")])
+        logs_ranges = [_get_logs_key_range(record[2]) for record in records if record[0] == "eth_getLogs"]
+        meta = {
+            "min_block": min((record[1] for record in records), default=None),
+            "max_block": max((record[1] for record in records), default=None),
+            "max_logs_range_size": max((end - start for start, end in filter(None, logs_ranges)), default=0)
+        }
+        temp_suffix = ".{}.tmp".format(os.getpid())
+        with open(name + ".sidx" + temp_suffix, "w") as index_file:
+            index_file.writelines(sorted(set(_make_index_line(*record) for record in records)))
+        os.replace(name + ".sidx" + temp_suffix, name + ".sidx")
+        with open(name + ".meta" + temp_suffix, "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(name + ".meta" + temp_suffix, name + ".meta")
+        try:
+            os.remove(name + ".idx")
+        except FileNotFoundError:
+            pass
+        self._add_segment(segment)
+
+    def _add_segment(self, segment):
+        with open(os.path.join(self.path, segment[:-len(".seg")] + ".meta")) as meta_file:
+            meta = json.load(meta_file)
+        if meta["min_block"] is not None:
+            self._segments.append(SegmentIndex(self.path, segment, meta))
+
+    def _add_to_index(self, key, location):
+        """
+        Add location of a record to in-memory index
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        location : tuple
+            Segment name, offset and length of compressed record
+        """
+        if key not in self._index and key.startswith("eth_getLogs"):
+            logs_range = _get_logs_key_range(key)
+            if logs_range:
+                bisect.insort(self._logs_ranges, logs_range + (key,))
+                self._max_logs_range_size = max(self._max_logs_range_size, logs_range[1] - logs_range[0])
+        self._index[key] = location
+
+    def _remove_from_index(self, segment):
+        """
+        Remove records of a segment from in-memory index
+
+        Parameters
+        ----------
+        segment : str
+            Segment name
+        """
+        self._index = {key: location for key, location in self._index.items() if location[0] != segment}
+        self._logs_ranges = [logs_range for logs_range in self._logs_ranges if logs_range[2] in self._index]
+
+    def _read(self, location):
+        segment, offset, length = location
+        with self._lock:
+            if segment not in self._files:
+                self._files[segment] = os.open(os.path.join(self.path, segment), os.O_RDONLY)
+            file = self._files[segment]
+        return zlib.decompress(os.pread(file, length, offset)).decode()
+
+    def _get_location(self, key):
+        location = self._index.get(key)
+        if location:
+            return location
+        method, block = _parse_key(key)
+        for segment in self._segments:
+            location = segment.get(method, block, key)
+            if location:
+                return location
+
+    def get(self, key):
+        """
+        Get stored result
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+
+        Returns
+        -------
+        str
+            JSON of result, None if there is no such record
+        """
+        location = self._get_location(key)
+        if location:
+            return self._read(location)
+
+    def _get_covering_logs_ranges(self, block):
+        """
+        Get stored eth_getLogs block ranges that cover a block
+
+        Parameters
+        ----------
+        block : int
+            Block number
+
+        Returns
+        -------
+        list
+            Tuples with start, end and location of records
+        """
+        position = bisect.bisect_right(self._logs_ranges, (block, float("inf")))
+        first_position = bisect.bisect_left(self._logs_ranges, (block - self._max_logs_range_size,))
+        covering_ranges = [
+            (start, end, self._index[key]) for start, end, key in self._logs_ranges[first_position:position]
+            if end > block
+        ]
+        for segment in self._segments:
+            covering_ranges += segment.iterate_logs_ranges(block)
+        return covering_ranges
+
+    def get_logs(self, start, end):
+        """
+        Get stored logs of block range from records of any block ranges that cover it
+
+        Parameters
+        ----------
+        start : int
+            First block
+        end : int
+            Last block, not included
+
+        Returns
+        -------
+        list
+            Logs of block range, None if block range is not covered by stored records
+        """
+        logs = []
+        block = start
+        while block < end:
+            covering_ranges = self._get_covering_logs_ranges(block)
+            if not covering_ranges:
+                return None
+            range_start, range_end, location = max(covering_ranges, key=lambda logs_range: logs_range[1])
+            range_end = min(range_end, end)
+            logs += [
+                log for log in json.loads(self._read(location))
+                if block <= int(log["blockNumber"], 16) < range_end
+            ]
+            block = range_end
+        return logs
+
+    def _close_segment(self):
+        """
+        Finish current segment of this process
+        """
+        segment = os.path.basename(self._segment.name)
+        self._segment.close()
+        self._segment_index.close()
+        self._finish_segment(segment, self._segment_records)
+        self._remove_from_index(segment)
+        self._segment = None
+
+    def _open_segment(self):
+        """
+        Start a new segment of current process
+        """
+        if self._segment:
+            self._close_segment()
+        self._segments_count += 1
+        name = "{}-{}-{}".format(int(time.time() * 1000), os.getpid(), self._segments_count)
+        self._segment = open(os.path.join(self.path, name + ".seg"), "ab")
+        self._segment_index = open(os.path.join(self.path, name + ".idx"), "a")
+        self._segment_records = []
+
+    def put(self, key, result):
+        """
+        Store result
+
+        Record is written before its index line,
+        so the index never points to an incomplete record
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        result : str
+            JSON of result
+        """
+        method, block = _parse_key(key)
+        record = zlib.compress(result.encode())
+        with self._lock:
+            if not self._segment or self._segment.tell() >= self.segment_max_size:
+                self._open_segment()
+            offset = self._segment.tell()
+            self._segment.write(record)
+            self._segment.flush()
+            self._segment_index.write(_make_index_line(method, block, key, offset, len(record)))
+            self._segment_index.flush()
+            self._segment_records.append((method, block, key, offset, len(record)))
+            self._add_to_index(key, (os.path.basename(self._segment.name), offset, len(record)))
+
+    def close(self):
+        with self._lock:
+            if self._segment:
+                self._close_segment()
+            for file in self._files.values():
+                os.close(file)
+            self._files = {}
+            for segment in self._segments:
+                segment.close()
+
+
+def get_cache():
+    """
+    Get response cache of current process
+
+    Returns
+    -------
+    ResponseCache
+        Cache stored in PARITY_CACHE_PATH, None if cache is disabled
+    """
+    if not PARITY_CACHE_PATH:
+        return None
+    pid = os.getpid()
+    if pid not in _caches:
+        _caches[pid] = ResponseCache(PARITY_CACHE_PATH)
+    return _caches[pid]
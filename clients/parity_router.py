@@ -0,0 +1,239 @@
+import os
+import time
+from threading import Lock
+from config import PARITY_EJECT_ERRORS, PARITY_EJECT_TIME
+
+LATENCY_SMOOTHING = 0.2
+
+_routers = {}
+
+
+def get_urls(parity_hosts, block):
+    """
+    Get urls of all parity JSON RPC APIs that serve specified block
+
+    Parameters
+    ----------
+    parity_hosts : list
+        List of tuples with each parity JSON RPC url and used block range
+    block : int
+        Block number
+
+    Returns
+    -------
+    tuple
+        Urls in order of parity_hosts
+    """
+    return tuple(
+        url
+        for bottom_line, upper_bound, url in parity_hosts
+        if ((not bottom_line) or (block >= bottom_line)) and ((not upper_bound) or (block < upper_bound))
+    )
+
+
+def get_groups(parity_hosts):
+    """
+    Get all distinct sets of parity urls that serve the same blocks
+
+    Parameters
+    ----------
+    parity_hosts : list
+        List of tuples with each parity JSON RPC url and used block range
+
+    Returns
+    -------
+    list
+        List of tuples with urls
+    """
+    bounds = {0} | {bound for host in parity_hosts for bound in host[0:2] if bound}
+    groups = []
+    for bound in sorted(bounds):
+        urls = get_urls(parity_hosts, bound)
+        if urls and urls not in groups:
+            groups.append(urls)
+    return groups
+
+
+class NodeState:
+    """
+    Load and health of a parity node
+    """
+    def __init__(self):
+        self.outstanding = 0
+        self.latency = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejected_until = 0.0
+
+
+class ParityRouter:
+    """
+    Thread-safe balancer of requests between parity nodes that serve the same blocks
+
+    Each request is sent to a node with the least number of outstanding requests,
+    nodes with lower latency are preferred among equally loaded ones.
+    A node is ejected for PARITY_EJECT_TIME seconds after PARITY_EJECT_ERRORS failed requests in a row.
+    Failed requests are retried on other nodes
+    """
+    def __init__(self, eject_errors=PARITY_EJECT_ERRORS, eject_time=PARITY_EJECT_TIME):
+        self.eject_errors = eject_errors
+        self.eject_time = eject_time
+        self.nodes = {}
+        self._lock = Lock()
+
+    def _get_node(self, url):
+        if url not in self.nodes:
+            self.nodes[url] = NodeState()
+        return self.nodes[url]
+
+    def _acquire(self, urls):
+        """
+        Choose node for a request and count the request as outstanding
+
+        If all nodes are ejected, a node which is ejected for the shortest time is chosen
+
+        Parameters
+        ----------
+        urls : list
+            Urls of nodes that can serve the request
+
+        Returns
+        -------
+        str
+            Url of chosen node
+        """
+        with self._lock:
+            now = time.monotonic()
+            healthy_urls = [url for url in urls if self._get_node(url).ejected_until <= now]
+            if healthy_urls:
+                url = min(healthy_urls, key=lambda url: (self.nodes[url].outstanding, self.nodes[url].latency))
+            else:
+                url = min(urls, key=lambda url: self.nodes[url].ejected_until)
+            self.nodes[url].outstanding += 1
+            return url
+
+    def _release(self, url, duration, failed):
+        """
+        Record result of a request sent to a node
+
+        Parameters
+        ----------
+        url : str
+            Url of node
+        duration : float
+            Duration of request in seconds
+        failed : bool
+            True if request failed because of the node
+        """
+        with self._lock:
+            node = self.nodes[url]
+            node.outstanding -= 1
+            node.requests += 1
+            if failed:
+                node.errors += 1
+                node.consecutive_errors += 1
+                if node.consecutive_errors >= self.eject_errors:
+                    node.ejected_until = time.monotonic() + self.eject_time
+                    node.consecutive_errors = 0
+            else:
+                node.consecutive_errors = 0
+                if node.latency:
+                    node.latency += LATENCY_SMOOTHING * (duration - node.latency)
+                else:
+                    node.latency = duration
+
+    def is_ejected(self, url):
+        """
+        Check if a node is ejected now
+
+        Parameters
+        ----------
+        url : str
+            Url of node
+
+        Returns
+        -------
+        bool
+            True if node is ejected
+        """
+        with self._lock:
+            return self._get_node(url).ejected_until > time.monotonic()
+
+    def call(self, urls, send, passthrough_errors=()):
+        """
+        Send request to one of specified nodes, retry it on other nodes if it fails
+
+        Parameters
+        ----------
+        urls : list
+            Urls of nodes that can serve the request
+        send : function
+            Function that sends request to given url and returns the result
+        passthrough_errors : tuple
+            Exception types which are raised without retries and aren't counted as node failures
+
+        Returns
+        -------
+        object
+            Result of send function
+
+        Raises
+        ------
+        Exception
+            Error of the last attempt if request failed on all nodes
+        """
+        remaining_urls = list(urls)
+        while True:
+            url = self._acquire(remaining_urls)
+            start_time = time.monotonic()
+            try:
+                result = send(url)
+            except passthrough_errors:
+                self._release(url, time.monotonic() - start_time, False)
+                raise
+            except Exception:
+                self._release(url, time.monotonic() - start_time, True)
+                remaining_urls.remove(url)
+                if not remaining_urls:
+                    raise
+                continue
+            self._release(url, time.monotonic() - start_time, False)
+            return result
+
+    def get_stats(self):
+        """
+        Get load and health of known nodes
+
+        Returns
+        -------
+        dict
+            Urls and dicts with number of outstanding requests, average latency in seconds,
+            error rate and ejection flag
+        """
+        with self._lock:
+            now = time.monotonic()
+            return {
+                url: {
+                    "outstanding": node.outstanding,
+                    "latency": node.latency,
+                    "error_rate": node.errors / node.requests if node.requests else 0,
+                    "ejected": node.ejected_until > now
+                }
+                for url, node in self.nodes.items()
+            }
+
+
+def get_router():
+    """
+    Get router shared by all parity calls of current process
+
+    Returns
+    -------
+    ParityRouter
+        Shared router
+    """
+    pid = os.getpid()
+    if pid not in _routers:
+        _routers[pid] = ParityRouter()
+    return _routers[pid]
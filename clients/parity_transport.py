@@ -0,0 +1,306 @@
+import os
+import time
+import json
+import codecs
+import itertools
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3, HTTPProvider
+from clients import parity_cache
+from config import PARITY_POOL_SIZE, PARITY_GZIP, PARITY_REQUEST_TIMEOUT, PARITY_CACHE_CONFIRMATIONS
+
+_sessions = {}
+
+_confirmed_blocks = {}
+
+STREAM_CHUNK_SIZE = 2 ** 20
+ERROR_BODY_SIZE = 1000
+
+CONFIRMED_BLOCK_TTL = 60
+
+
+def create_session(pool_size=PARITY_POOL_SIZE, gzip=PARITY_GZIP):
+    """
+    Create HTTP session with keep-alive connections to parity nodes
+
+    Parameters
+    ----------
+    pool_size : int
+        Max number of connections kept open for each parity host
+    gzip : bool
+        Ask parity to compress responses
+
+    Returns
+    -------
+    requests.Session
+        Session with connection pool attached to http and https urls
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "content-type": "application/json",
+        "accept-encoding": "gzip, deflate" if gzip else "identity"
+    })
+    return session
+
+
+def get_session():
+    """
+    Get HTTP session shared by all parity calls of current process
+
+    Each forked process gets its own session, so connections are never shared between processes
+
+    Returns
+    -------
+    requests.Session
+        Shared session
+    """
+    pid = os.getpid()
+    if pid not in _sessions:
+        _sessions[pid] = create_session()
+    return _sessions[pid]
+
+
+def post(parity_url, data, timeout=PARITY_REQUEST_TIMEOUT, stream=False):
+    """
+    Send JSON RPC request to parity node through the shared session
+
+    Parameters
+    ----------
+    parity_url : str
+        URL of parity node JSONRPC API
+    data : str
+        JSON string with request
+    timeout : int
+        Request timeout in seconds
+    stream : bool
+        Don't download response body until it is read
+
+    Returns
+    -------
+    requests.Response
+        Response of parity node
+    """
+    return get_session().post(parity_url, data=data, timeout=timeout, stream=stream)
+
+
+def iterate_json_array(response, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Parse JSON array from a streamed response element by element
+
+    Only one element is kept in memory as a string, so responses to JSON RPC batches
+    can be processed without loading the whole body. Incomplete element is parsed again
+    when its part in buffer doubles, so big elements are parsed in linear time
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response received with stream=True
+    chunk_size : int
+        Size of chunks read from response
+
+    Returns
+    -------
+    generator
+        Generator that returns each element of array and size of its JSON string
+
+    Raises
+    ------
+    ValueError
+        If response is not a JSON array, for example a single error object, or is incomplete
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    next_attempt = 0
+    chunks = itertools.chain(response.iter_content(chunk_size), [None])
+    for chunk in chunks:
+        if chunk is None:
+            buffer += text_decoder.decode(b"", final=True)
+            next_attempt = 0
+        else:
+            buffer += text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    body = buffer[position:]
+                    for rest in chunks:
+                        if rest is None or len(body) >= ERROR_BODY_SIZE:
+                            break
+                        body += text_decoder.decode(rest)
+                    raise ValueError("JSON RPC response is not an array: {}".format(body[:ERROR_BODY_SIZE]))
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            if len(buffer) - position < next_attempt:
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                next_attempt = 2 * (len(buffer) - position)
+                break
+            next_attempt = 0
+            yield element, end - position
+            position = end
+        buffer = buffer[position:]
+    raise ValueError("JSON RPC response is incomplete")
+
+
+def _iterate_jsonrpc_responses(parity_url, request):
+    """
+    Send batch of JSON RPC requests to parity node and parse responses one by one
+
+    Parameters
+    ----------
+    parity_url : str
+        URL of parity node JSONRPC API
+    request : list
+        JSON RPC requests
+
+    Returns
+    -------
+    generator
+        Generator that returns each response and size of its JSON
+    """
+    response = post(parity_url, json.dumps(request), stream=True)
+    try:
+        yield from iterate_json_array(response)
+    finally:
+        response.close()
+
+
+def _get_confirmed_block(parity_url):
+    """
+    Get last block with PARITY_CACHE_CONFIRMATIONS confirmations
+
+    Block number is requested from parity node at most once in CONFIRMED_BLOCK_TTL seconds
+
+    Parameters
+    ----------
+    parity_url : str
+        URL of parity node JSONRPC API
+
+    Returns
+    -------
+    int
+        Block number
+    """
+    block, requested_at = _confirmed_blocks.get(parity_url, (None, 0))
+    if time.monotonic() - requested_at > CONFIRMED_BLOCK_TTL:
+        request = {"jsonrpc": "2.0", "id": "block_number", "method": "eth_blockNumber", "params": []}
+        last_block = int(post(parity_url, json.dumps(request)).json()["result"], 16)
+        block = last_block - PARITY_CACHE_CONFIRMATIONS
+        _confirmed_blocks[parity_url] = (block, time.monotonic())
+    return block
+
+
+def _get_cached_response(cache, request):
+    """
+    Get response to JSON RPC request from response cache
+
+    Parameters
+    ----------
+    cache : clients.parity_cache.ResponseCache
+        Response cache
+    request : dict
+        JSON RPC request
+
+    Returns
+    -------
+    tuple
+        Response and size of its JSON, None if response is not cached
+    """
+    key = parity_cache.get_key(request)
+    if key is None:
+        return None
+    result = cache.get(key)
+    if result is None:
+        logs_range = parity_cache.get_logs_range(request)
+        logs = cache.get_logs(*logs_range) if logs_range else None
+        if logs is None:
+            return None
+        result = json.dumps(logs)
+    return {"jsonrpc": "2.0", "id": request["id"], "result": json.loads(result)}, len(result)
+
+
+def iterate_jsonrpc_responses(parity_url, request):
+    """
+    Get responses to a batch of JSON RPC requests
+
+    If response cache is enabled, responses for specific blocks are taken from the cache.
+    Other requests are sent to parity node, their results are stored in the cache
+    if requested blocks have at least PARITY_CACHE_CONFIRMATIONS confirmations
+
+    Parameters
+    ----------
+    parity_url : str
+        URL of parity node JSONRPC API
+    request : list
+        JSON RPC requests
+
+    Returns
+    -------
+    generator
+        Generator that returns each response and size of its JSON
+    """
+    cache = parity_cache.get_cache()
+    if cache is None:
+        yield from _iterate_jsonrpc_responses(parity_url, request)
+        return
+    missed_requests = {}
+    for request_item in request:
+        cached_response = _get_cached_response(cache, request_item)
+        if cached_response:
+            yield cached_response
+        else:
+            missed_requests[request_item["id"]] = request_item
+    if not missed_requests:
+        return
+    confirmed_block = _get_confirmed_block(parity_url)
+    for response, size in _iterate_jsonrpc_responses(parity_url, list(missed_requests.values())):
+        request_item = missed_requests.get(response.get("id"))
+        if request_item and response.get("result") is not None and "error" not in response:
+            key = parity_cache.get_key(request_item)
+            if key and parity_cache.get_block(request_item) <= confirmed_block:
+                cache.put(key, json.dumps(response["result"]))
+        yield response, size
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """
+    Web3 HTTP provider that sends requests through the shared parity session
+    """
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        raw_response = get_session().post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+        raw_response.raise_for_status()
+        return self.decode_rpc_response(raw_response.content)
+
+
+def create_web3(parity_url, timeout=PARITY_REQUEST_TIMEOUT):
+    """
+    Create Web3 instance attached to the shared parity session
+
+    Parameters
+    ----------
+    parity_url : str
+        URL of parity node JSONRPC API
+    timeout : int
+        Request timeout in seconds
+
+    Returns
+    -------
+    web3.Web3
+        Web3 instance
+    """
+    return Web3(PooledHTTPProvider(parity_url, request_kwargs={"timeout": timeout}))
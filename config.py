@@ -1,7 +1,8 @@
 from datetime import datetime
 
 # URLs of parity APIs.
-# You can specify block range for each URL to use different nodes for each request
+# You can specify block range for each URL to use different nodes for each request.
+# Requests for blocks served by several nodes are balanced between them
 # Make sure you have the same config as in dockerfile.yml for each node:
 # --tracing=on
 # --jsonrpc-interface=all
@@ -9,6 +10,29 @@ PARITY_HOSTS = [
     (None, None, "http://localhost:8545")
 ]
 
+# Number of failed requests in a row after which parity node is not used for PARITY_EJECT_TIME seconds
+PARITY_EJECT_ERRORS = 3 # recommended
+
+# Number of seconds for which failing parity node is not used
+PARITY_EJECT_TIME = 30 # recommended
+
+# Max number of keep-alive connections to each parity node
+PARITY_POOL_SIZE = 12 # recommended, twice the number of batches in flight
+
+# Ask parity nodes to compress responses. Helps when nodes are not in the local network
+PARITY_GZIP = False
+
+# Timeout for each request to parity in seconds
+PARITY_REQUEST_TIMEOUT = 100
+
+# Directory of on-disk cache of parity responses, None to disable cache.
+# trace_block, eth_getBlockByNumber and eth_getLogs results of confirmed blocks are stored there
+# and reused instead of requests to parity, for example during re-extraction
+PARITY_CACHE_PATH = None
+
+# Number of confirmations after which parity responses for a block are stored in cache
+PARITY_CACHE_CONFIRMATIONS = 100 # recommended
+
 # Dictionary of table names in database.
 # Meaning of each table explained in Schema
 INDICES = {
@@ -21,6 +45,8 @@ INDICES = {
     "block": "eth_block",
     "price": "eth_token_price",
     "block_flag": "eth_block_flag",
+    "block_range": "eth_block_range",
+    "block_lease": "eth_block_lease",
     "contract_abi": "eth_contract_abi",
     "contract_block": "eth_contract_block",
     "transaction_input": "eth_transaction_input",
@@ -41,18 +67,93 @@ BATCH_SIZE = 1000 # recommended
 # Max size of chunk inserted into Clickhouse
 MAX_CHUNK_SIZE = 20000000 # recommended, average size of block
 
-# Number of chunks processed simultaneously while extracting transactions from parity
-PARITY_EXTRACTION_PROCESSES = 3 # recommended
+# Max number of rows in chunk inserted into Clickhouse
+MAX_CHUNK_ROWS = 100000 # recommended
+
+# Number of JSON RPC batches sent simultaneously to each parity host while extracting transactions
+PARITY_BATCHES_IN_FLIGHT = 6 # recommended
+
+# Number of blocks requested from parity within the first JSON RPC batch while extracting transactions.
+# Next batches are sized to contain about PARITY_BATCH_WEIGHT transactions
+PARITY_BLOCKS_PER_BATCH = 3 # recommended
+
+# Expected number of transactions (plus one per block) within one JSON RPC batch while extracting transactions.
+# Number of transactions in a block is estimated from recently extracted blocks
+PARITY_BATCH_WEIGHT = 600 # recommended
+
+# Max number of blocks requested from parity within one JSON RPC batch while extracting transactions
+PARITY_MAX_BLOCKS_PER_BATCH = 100 # recommended
+
+# Number of block headers requested from parity within one JSON RPC batch while extracting blocks
+PARITY_HEADERS_PER_BATCH = 100 # recommended
+
+# Number of chunks waiting between fetch, transform and insert stages while extracting transactions
+PIPELINE_QUEUE_SIZE = 2 # recommended
+
+# Max size of parity responses in bytes collected into one chunk while extracting transactions.
+# Chunk of traces takes several times more memory than its JSON
+TRACES_CHUNK_MAX_SIZE = 200000000 # recommended
+
+# Number of dump files imported simultaneously by import-traces operation
+TRACES_IMPORT_PROCESSES = 4 # recommended
+
+# Number of blocks from dump file inserted at once by import-traces operation
+TRACES_IMPORT_CHUNK_SIZE = 1000 # recommended
 
 # Number of chunks processed simultaneously during input parsing
 INPUT_PARSING_PROCESSES = 10 # recommended
 
-# Number of blocks processed simultaneously during events extraction
+# Number of blocks requested within the first eth_getLogs call during events extraction.
+# Next ranges are resized to get about EVENTS_TARGET_COUNT events in EVENTS_TARGET_TIME seconds
 EVENTS_RANGE_SIZE = 5 # recommended
 
+# Max number of blocks requested within one eth_getLogs call
+EVENTS_MAX_RANGE_SIZE = 10000 # recommended
+
+# Desired number of events returned by one eth_getLogs call
+EVENTS_TARGET_COUNT = 5000 # recommended
+
+# Desired duration of one eth_getLogs call in seconds
+EVENTS_TARGET_TIME = 2 # recommended
+
+# Number of eth_getLogs calls sent simultaneously during events extraction
+EVENTS_RANGES_IN_FLIGHT = 6 # recommended
+
+# Initial interval in seconds between checks of new blocks in follow operation.
+# The interval is doubled up to FOLLOW_MAX_POLL_INTERVAL while there are no new blocks
+FOLLOW_POLL_INTERVAL = 1 # recommended
+
+# Max interval in seconds between checks of new blocks in follow operation
+FOLLOW_MAX_POLL_INTERVAL = 8 # recommended
+
+# Number of last blocks which hashes are compared with parity before each iteration of follow operation.
+# Data of blocks replaced by a chain reorganization is deleted and extracted again
+CONFIRMATION_DEPTH = 12 # recommended
+
+# Number of blocks in each partition of blocks, traces, events, contracts and token transactions tables.
+# Rollback of a chain reorganization drops partitions after the first replaced block
+# and deletes rows only within its partition. Tables created before partitioning are rolled back by full scans
+BLOCKS_PER_PARTITION = 1000000 # recommended
+
+# Number of blocks in each range claimed by an extractor instance during traces and events extraction.
+# Instances connected to the same database share unprocessed blocks, None to disable claiming
+BLOCK_LEASE_SIZE = None # 10000 recommended for several instances
+
+# Number of seconds after which blocks claimed by a stopped extractor instance can be claimed by another one
+BLOCK_LEASE_TIME = 300 # recommended
+
 # Max memory usage for clickhouse
 MAX_MEMORY_USAGE = 1000000000 # recommended
 
+# Max number of clickhouse connections opened by each process
+CLICKHOUSE_POOL_SIZE = 8 # recommended
+
+# Seconds to wait for a free clickhouse connection
+CLICKHOUSE_POOL_TIMEOUT = 600
+
+# Idle clickhouse connections are checked with ping after this number of seconds
+CLICKHOUSE_PING_INTERVAL = 30
+
 # API key for etherscan.io ABI extraction
 ETHERSCAN_API_KEY = "YourApiKeyToken"
 
@@ -64,3 +165,6 @@ ETHEREUM_START_DATE = datetime(2015, 7, 30)
 TEST_PARITY_NODE = "http://localhost:8545/"
 
 NUMBER_OF_JOBS = BATCH_SIZE
+
+# Total of progress bar in iterations: None, "estimate" or "parallel"
+ITERATE_COUNT = None # recommended
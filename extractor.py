@@ -8,12 +8,18 @@ OPERATIONS = {
         ("prepare-database", clickhouse.prepare_indices_and_views),
         ("start", clickhouse.synchronize),
         ("start-full", clickhouse.synchronize_full),
+        ("follow", clickhouse.follow),
         ("prepare-indices", clickhouse.prepare_indices),
+        ("migrate-block-flags", clickhouse.migrate_block_flags),
+        ("rollback", click.argument("block", type=int)(clickhouse.rollback)),
         ("prepare-erc-transactions-view", clickhouse.extract_token_transactions),
         ("prepare-bancor-trades-view", clickhouse.prepare_bancor_trades),
         ("prepare-contracts-view", clickhouse.prepare_contracts_view),
         ("extract-blocks", clickhouse.prepare_blocks),
         ("extract-traces", clickhouse.extract_traces),
+        ("import-traces", click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))(
+            clickhouse.import_traces
+        )),
         ("extract-events", clickhouse.extract_events),
         ("extract-tokens", clickhouse.extract_tokens),
         ("download-contracts-abi", clickhouse.extract_contracts_abi),
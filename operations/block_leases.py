@@ -0,0 +1,300 @@
+import os
+import time
+import uuid
+import socket
+from threading import Event, Lock, Thread
+from config import BLOCK_LEASE_SIZE, BLOCK_LEASE_TIME, NUMBER_OF_JOBS
+from operations.block_ranges import intersect_bounds
+from utils import split_on_chunks
+
+LEASE_SETTLE_TIME = 2
+HEARTBEATS_PER_LEASE = 3
+
+
+def get_owner():
+    """
+    Get unique name of extractor instance
+
+    Returns
+    -------
+    str
+        Host name, process id and random suffix
+    """
+    return "{}.{}.{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class ClickhouseBlockLeases:
+    """
+    Ranges of blocks claimed by extractor instances that process the same stage
+
+    Blocks are split into units of size blocks. An instance claims a unit with unprocessed blocks
+    by inserting a lease row stamped with server time, waits LEASE_SETTLE_TIME seconds
+    and reads all active leases of the unit back. The earliest lease wins,
+    so concurrent claims are resolved the same way by all instances without transactions.
+    Claimed units are renewed by a heartbeat thread while the leases are used as a context manager
+    and expire after lease_time seconds if the instance stops.
+    A lost race only duplicates work, because all extracted rows are replaced by id
+    """
+    def __init__(self, block_ranges, size=BLOCK_LEASE_SIZE, lease_time=BLOCK_LEASE_TIME, owner=None):
+        self.block_ranges = block_ranges
+        self.name = block_ranges.name
+        self.indices = block_ranges.indices
+        self.client = block_ranges.client
+        self.size = size
+        self.lease_time = lease_time
+        self.settle_time = LEASE_SETTLE_TIME
+        self.owner = owner or get_owner()
+        self.leases = {}
+        self._claims_count = 0
+        self._lock = Lock()
+        self._stop = Event()
+        self._heartbeat = None
+
+    def _write_lease(self, lease_id, start, claimed_at="toUInt32(now())", released=0):
+        """
+        Insert lease row which expires lease_time seconds after now by server time
+
+        Parameters
+        ----------
+        lease_id : str
+            Id of lease
+        start : int
+            First block of claimed unit
+        claimed_at : object
+            Timestamp of claim or SQL expression to get it
+        released : int
+            1 if lease is released
+        """
+        self.client.send_sql_request("""
+            INSERT INTO {} (id, name, start_block, owner, claimed_at, expires_at, released)
+            SELECT '{}', '{}', {}, '{}', {}, toUInt32(now()) + {}, {}
+        """.format(
+            self.indices["block_lease"], lease_id, self.name, start, self.owner, claimed_at, self.lease_time, released
+        ))
+
+    def _get_active_leases(self, start=None, owner=None):
+        """
+        Get leases that are not released and not expired
+
+        Parameters
+        ----------
+        start : int
+            First block of unit, None for all units
+        owner : str
+            Owner of leases, None for all owners
+
+        Returns
+        -------
+        list
+            Leases ordered by claim time, the first lease of each unit holds the unit
+        """
+        query = "WHERE name = '{}' AND released = 0 AND expires_at > toUInt32(now())".format(self.name)
+        if start is not None:
+            query += " AND start_block = {}".format(start)
+        if owner is not None:
+            query += " AND owner = '{}'".format(owner)
+        return self.client.search(
+            index=self.indices["block_lease"],
+            fields=["start_block", "owner", "claimed_at"],
+            query=query + " ORDER BY claimed_at, owner, id"
+        )
+
+    def _get_unit_bounds(self, start, bounds):
+        """
+        Get parts of bounds within a unit
+
+        Parameters
+        ----------
+        start : int
+            First block of unit
+        bounds : list
+            List of (start, end) tuples, None means no bound
+
+        Returns
+        -------
+        list
+            List of (start, end) tuples
+        """
+        return intersect_bounds(bounds, [(start, start + self.size)])
+
+    def _iterate_unit_starts(self, ranges):
+        """
+        Iterate over first blocks of units that intersect block ranges
+
+        Parameters
+        ----------
+        ranges : list
+            Sorted list of (start, end) tuples
+
+        Returns
+        -------
+        generator
+            Generator that returns first blocks of units in ascending order
+        """
+        last_start = None
+        for start, end in ranges:
+            for unit_start in range(start - start % self.size, end, self.size):
+                if unit_start != last_start:
+                    last_start = unit_start
+                    yield unit_start
+
+    def _try_claim(self, start):
+        """
+        Claim a unit if no other instance claimed it earlier
+
+        Parameters
+        ----------
+        start : int
+            First block of unit
+
+        Returns
+        -------
+        bool
+            True if unit was claimed
+        """
+        self._claims_count += 1
+        lease_id = "{}.{}.{}.{}".format(self.name, start, self.owner, self._claims_count)
+        self._write_lease(lease_id, start)
+        time.sleep(self.settle_time)
+        leases = self._get_active_leases(start)
+        if leases and leases[0]["_id"] == lease_id:
+            with self._lock:
+                self.leases[lease_id] = (start, leases[0]["_source"]["claimed_at"])
+            return True
+        self._write_lease(lease_id, start, released=1)
+        return False
+
+    def claim(self, max_block, bounds=[(None, None)]):
+        """
+        Claim the first unit with unprocessed blocks which is not claimed by any instance
+
+        Parameters
+        ----------
+        max_block : int
+            Last block to process
+        bounds : list
+            List of (start, end) tuples to search in, None means no bound
+
+        Returns
+        -------
+        int
+            First block of claimed unit, None if there are no units to claim
+        """
+        unprocessed_ranges = self.block_ranges.get_unprocessed_ranges(max_block, bounds)
+        claimed_starts = {lease["_source"]["start_block"] for lease in self._get_active_leases()}
+        for start in self._iterate_unit_starts(unprocessed_ranges):
+            if start not in claimed_starts and self._try_claim(start):
+                return start
+
+    def renew(self):
+        """
+        Extend all leases of this instance by lease_time seconds
+
+        Leases that expired or were released meanwhile are forgotten,
+        as their units could already be claimed by other instances
+        """
+        with self._lock:
+            active_ids = {lease["_id"] for lease in self._get_active_leases(owner=self.owner)}
+            for lease_id, (start, claimed_at) in list(self.leases.items()):
+                if lease_id in active_ids:
+                    self._write_lease(lease_id, start, claimed_at)
+                else:
+                    del self.leases[lease_id]
+
+    def _release_leases(self, lease_ids):
+        with self._lock:
+            for lease_id in lease_ids:
+                if lease_id in self.leases:
+                    start, claimed_at = self.leases.pop(lease_id)
+                    self._write_lease(lease_id, start, claimed_at, released=1)
+
+    def release_processed(self, max_block, bounds=[(None, None)]):
+        """
+        Release leases of units without unprocessed blocks
+
+        Parameters
+        ----------
+        max_block : int
+            Last block to process
+        bounds : list
+            List of (start, end) tuples, None means no bound
+        """
+        self._release_leases([
+            lease_id for lease_id, (start, claimed_at) in list(self.leases.items())
+            if not self.block_ranges.get_unprocessed_ranges(max_block, self._get_unit_bounds(start, bounds))
+        ])
+
+    def release(self):
+        """
+        Release all leases of this instance
+        """
+        self._release_leases(list(self.leases.keys()))
+
+    def _run_heartbeat(self):
+        while not self._stop.wait(self.lease_time / HEARTBEATS_PER_LEASE):
+            try:
+                self.renew()
+            except Exception:
+                # Leases are renewed on the next heartbeat, long failures only let other instances duplicate work
+                pass
+
+    def __enter__(self):
+        self._stop.clear()
+        self._heartbeat = Thread(target=self._run_heartbeat, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._heartbeat.join()
+        self.release()
+
+    def iterate_unprocessed_ranges(self, max_block, bounds=[(None, None)]):
+        """
+        Claim units one by one and iterate over their unprocessed blocks
+
+        Next unit is claimed only when ranges of previous units are consumed.
+        Claimed units stay leased until their blocks are processed or leases are released
+
+        Parameters
+        ----------
+        max_block : int
+            Last block to process
+        bounds : list
+            List of (start, end) tuples to search in, None means no bound
+
+        Returns
+        -------
+        generator
+            Generator that returns (start, end) tuples
+        """
+        while True:
+            self.release_processed(max_block, bounds)
+            start = self.claim(max_block, bounds)
+            if start is None:
+                return
+            unit_bounds = self._get_unit_bounds(start, bounds)
+            for block_range in self.block_ranges.get_unprocessed_ranges(max_block, unit_bounds):
+                yield block_range
+
+    def iterate_unprocessed_blocks(self, max_block, bounds=[(None, None)], per=NUMBER_OF_JOBS):
+        """
+        Iterate over unprocessed blocks of claimed units
+
+        Parameters
+        ----------
+        max_block : int
+            Last block to process
+        bounds : list
+            List of (start, end) tuples to search in, None means no bound
+        per : int
+            Number of blocks in chunk
+
+        Returns
+        -------
+        generator
+            Generator that returns list of block numbers on each iteration
+        """
+        ranges = self.iterate_unprocessed_ranges(max_block, bounds)
+        blocks = (block for start, end in ranges for block in range(start, end))
+        return split_on_chunks(blocks, per)
@@ -0,0 +1,294 @@
+from clients.custom_clickhouse import CustomClickhouse
+from config import INDICES, NUMBER_OF_JOBS
+from utils import split_on_chunks
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent block ranges
+
+    Parameters
+    ----------
+    ranges : list
+        List of (start, end) tuples, end is not included
+
+    Returns
+    -------
+    list
+        Sorted list of disjoint non-adjacent ranges
+    """
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if start >= end:
+            continue
+        if merged_ranges and start <= merged_ranges[-1][1]:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(merged_ranges[-1][1], end))
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+
+def subtract_ranges(ranges, removed_ranges):
+    """
+    Remove block ranges from other block ranges
+
+    Parameters
+    ----------
+    ranges : list
+        List of (start, end) tuples
+    removed_ranges : list
+        List of (start, end) tuples to remove
+
+    Returns
+    -------
+    list
+        Sorted list of disjoint ranges
+    """
+    removed_ranges = merge_ranges(removed_ranges)
+    result = []
+    for start, end in merge_ranges(ranges):
+        for removed_start, removed_end in removed_ranges:
+            if removed_end <= start or removed_start >= end:
+                continue
+            if removed_start > start:
+                result.append((start, removed_start))
+            start = max(start, removed_end)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def intersect_bounds(bounds, other_bounds):
+    """
+    Get intersection of two lists of block bounds
+
+    Parameters
+    ----------
+    bounds : list
+        List of (start, end) tuples, None means no bound
+    other_bounds : list
+        List of (start, end) tuples, None means no bound
+
+    Returns
+    -------
+    list
+        List of non-empty (start, end) tuples, start is never None
+    """
+    intersection = []
+    for start, end in bounds:
+        for other_start, other_end in other_bounds:
+            new_start = max(start or 0, other_start or 0)
+            new_end = other_end if end is None else end if other_end is None else min(end, other_end)
+            if new_end is None or new_start < new_end:
+                intersection.append((new_start, new_end))
+    return intersection
+
+
+def blocks_to_ranges(blocks):
+    """
+    Convert block numbers to merged block ranges
+
+    Parameters
+    ----------
+    blocks : list
+        List of block numbers
+
+    Returns
+    -------
+    list
+        Sorted list of disjoint non-adjacent ranges
+    """
+    return merge_ranges([(int(block), int(block) + 1) for block in blocks])
+
+
+class ClickhouseBlockRanges:
+    """
+    Progress of a stage stored as ranges of processed blocks
+
+    Each range is a row with id "<name>.<start_block>.<end_block>" that is never changed
+    except for being replaced with an empty one on removal. New ranges are appended
+    as separate rows and merged on read, so concurrent writers never overwrite
+    ranges saved by each other
+    """
+    def __init__(self, name, indices=INDICES, client=None):
+        self.name = name
+        self.indices = indices
+        self.client = client or CustomClickhouse()
+
+    def _get_range_id(self, start, end):
+        return "{}.{}.{}".format(self.name, start, end)
+
+    def _get_stored_ranges(self):
+        """
+        Get non-empty block ranges as they are stored in a database
+
+        Returns
+        -------
+        dict
+            Row ids and attached (start, end) tuples
+        """
+        ranges = self.client.search(
+            index=self.indices["block_range"],
+            fields=["start_block", "end_block"],
+            query="WHERE name = '{}' AND end_block > start_block".format(self.name)
+        )
+        return {range["_id"]: (range["_source"]["start_block"], range["_source"]["end_block"]) for range in ranges}
+
+    def get_ranges(self):
+        """
+        Get processed block ranges from a database
+
+        Returns
+        -------
+        list
+            Sorted list of (start, end) tuples, end is not included
+        """
+        return merge_ranges(self._get_stored_ranges().values())
+
+    def _save_ranges(self, ranges, removed_ids=[]):
+        """
+        Save new ranges to a database
+
+        Parameters
+        ----------
+        ranges : list
+            List of (start, end) tuples to append
+        removed_ids : list
+            Ids of stored ranges to replace with empty ones
+        """
+        docs = [
+            {"id": range_id, "name": self.name, "start_block": 0, "end_block": 0}
+            for range_id in removed_ids
+        ] + [
+            {"id": self._get_range_id(start, end), "name": self.name, "start_block": start, "end_block": end}
+            for start, end in ranges
+        ]
+        if docs:
+            self.client.bulk_index(index=self.indices["block_range"], docs=docs)
+
+    def add(self, ranges):
+        """
+        Mark block ranges as processed
+
+        Only blocks that are not processed yet are appended,
+        stored ranges are left untouched
+
+        Parameters
+        ----------
+        ranges : list
+            List of (start, end) tuples
+        """
+        stored_ranges = self._get_stored_ranges().values()
+        self._save_ranges(subtract_ranges(ranges, stored_ranges))
+
+    def add_blocks(self, blocks):
+        """
+        Mark blocks as processed
+
+        Parameters
+        ----------
+        blocks : list
+            List of block numbers
+        """
+        self.add(blocks_to_ranges(blocks))
+
+    def remove(self, ranges):
+        """
+        Mark block ranges as unprocessed
+
+        Parameters
+        ----------
+        ranges : list
+            List of (start, end) tuples
+        """
+        stored_ranges = self._get_stored_ranges()
+        removed_ids = [
+            range_id for range_id, (start, end) in stored_ranges.items()
+            if subtract_ranges([(start, end)], ranges) != [(start, end)]
+        ]
+        remaining_ranges = subtract_ranges([stored_ranges[range_id] for range_id in removed_ids], ranges)
+        self._save_ranges(remaining_ranges, removed_ids)
+
+    def get_max_block(self):
+        """
+        Get last processed block
+
+        Returns
+        -------
+        int
+            Block number, None if there are no processed blocks
+        """
+        ranges = self.get_ranges()
+        if ranges:
+            return ranges[-1][1] - 1
+
+    def get_last_block(self):
+        """
+        Get last block extracted to blocks table
+
+        Returns
+        -------
+        int
+            Block number, None if there are no blocks
+        """
+        return self.client.send_sql_request(
+            "SELECT max(number) FROM {} HAVING count() > 0".format(self.indices["block"])
+        )
+
+    def get_unprocessed_ranges(self, max_block, bounds=[(None, None)]):
+        """
+        Get ranges of unprocessed blocks
+
+        Parameters
+        ----------
+        max_block : int
+            Last block to process
+        bounds : list
+            List of (start, end) tuples to search in, None means no bound
+
+        Returns
+        -------
+        list
+            Sorted list of (start, end) tuples
+        """
+        bounds = [(start or 0, max_block + 1 if end is None else min(end, max_block + 1)) for start, end in bounds]
+        return subtract_ranges(bounds, self.get_ranges())
+
+    def iterate_unprocessed_blocks(self, max_block, bounds=[(None, None)], per=NUMBER_OF_JOBS):
+        """
+        Iterate over unprocessed blocks
+
+        Parameters
+        ----------
+        max_block : int
+            Last block to process
+        bounds : list
+            List of (start, end) tuples to search in, None means no bound
+        per : int
+            Number of blocks in chunk
+
+        Returns
+        -------
+        generator
+            Generator that returns list of block numbers on each iteration
+        """
+        ranges = self.get_unprocessed_ranges(max_block, bounds)
+        blocks = (block for start, end in ranges for block in range(start, end))
+        return split_on_chunks(blocks, per)
+
+    def migrate_flags(self):
+        """
+        Convert flags with the name of this stage from block_flag table to block ranges
+        """
+        flags = self.client.iterate(
+            index=self.indices["block_flag"],
+            fields=["toInt64(id) AS number"],
+            query="WHERE name = '{}' AND value = 1".format(self.name),
+            return_id=False
+        )
+        ranges = []
+        for flags_chunk in flags:
+            ranges = merge_ranges(ranges + blocks_to_ranges([flag["_source"]["number"] for flag in flags_chunk]))
+        self.add(ranges)
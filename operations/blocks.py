@@ -1,13 +1,37 @@
-from config import INDICES, PARITY_HOSTS, NUMBER_OF_JOBS, ETHEREUM_START_DATE
+from config import INDICES, PARITY_HOSTS, NUMBER_OF_JOBS, ETHEREUM_START_DATE, PARITY_BATCHES_IN_FLIGHT, \
+    PARITY_HEADERS_PER_BATCH, PIPELINE_QUEUE_SIZE
 from clients.custom_clickhouse import CustomClickhouse
-import requests
-import json
+from clients import parity_transport
+from operations.internal_transactions import _send_jsonrpc_request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import utils
 from tqdm import tqdm
-from web3 import Web3, HTTPProvider
 import datetime
 
-BLOCKS_PER_CHUNK = NUMBER_OF_JOBS
+BLOCKS_PER_CHUNK = NUMBER_OF_JOBS * 10
+
+
+def _make_headers_request(blocks):
+    """
+    Create JSON RPC requests to get headers of specified blocks without transactions
+
+    Parameters
+    ----------
+    blocks : list
+        Block numbers
+
+    Returns
+    -------
+    list
+        List of requests
+    """
+    return [{
+        "jsonrpc": "2.0",
+        "id": "header_{}".format(block_number),
+        "method": "eth_getBlockByNumber",
+        "params": [hex(block_number), False]
+    } for block_number in blocks]
 
 
 class Blocks:
@@ -15,7 +39,8 @@ class Blocks:
         self.indices = indices
         self.client = client
         self.parity_host = parity_host
-        self.w3 = Web3(HTTPProvider(parity_host))
+        self.w3 = parity_transport.create_web3(parity_host)
+        self.executor = ThreadPoolExecutor(max_workers=PARITY_BATCHES_IN_FLIGHT)
 
     def _get_max_parity_block(self):
         """
@@ -49,32 +74,75 @@ class Blocks:
         else:
             return -1
 
-    def _extract_block_timestamp(self, block_number):
+    def _get_headers(self, blocks):
+        """
+        Get headers of specified blocks from parity within one JSON RPC batch
+
+        Parameters
+        ----------
+        blocks : list
+            Block numbers
+
+        Returns
+        -------
+        list
+            List of block headers. Blocks that are not in parity are skipped
+        """
+        headers = _send_jsonrpc_request(self.parity_host, _make_headers_request(blocks), lambda x: [x.get("result")])
+        return [header for header in headers if header]
+
+    def _extract_blocks_timestamps(self, blocks):
         """
-        Get block timestamp from parity
+        Get timestamps of specified blocks from parity
+
+        Blocks are requested in batches of PARITY_HEADERS_PER_BATCH,
+        PARITY_BATCHES_IN_FLIGHT batches are sent simultaneously
 
         Parameters
         ----------
-        block_number : int
-            Block number
+        blocks : list
+            Block numbers
 
         Returns
         -------
-        datetime
-            Timestamp of a block
-            None if no such block in parity
+        list
+            Timestamps of blocks in the same order.
+            None for blocks that are not in parity
+        """
+        batches = utils.split_on_chunks(blocks, PARITY_HEADERS_PER_BATCH)
+        timestamps = {
+            int(header["number"], 0): datetime.datetime.fromtimestamp(int(header["timestamp"], 0))
+            for headers in self.executor.map(self._get_headers, batches)
+            for header in headers
+        }
+        timestamps[0] = ETHEREUM_START_DATE
+        return [timestamps.get(block) for block in blocks]
+
+    def _save_blocks(self, blocks, timestamps):
         """
-        if block_number == 0:
-            return ETHEREUM_START_DATE
-        block = self.w3.eth.getBlock(block_number)
-        if block != None:
-            timestamp = block.timestamp
-            return datetime.datetime.fromtimestamp(timestamp)
-
-    def _create_blocks(self, start, end, max_blocks=NUMBER_OF_JOBS*10):
+        Save blocks with timestamps to a database
+
+        Parameters
+        ----------
+        blocks : list
+            Block numbers
+        timestamps : list
+            Timestamps of blocks
+        """
+        columns = {
+            "id": blocks,
+            "number": blocks,
+            "timestamp": timestamps
+        }
+        self.client.bulk_index_columns(index=self.indices["block"], columns=columns)
+
+    def _create_blocks(self, start, end):
         """
         Create blocks from start to end. Extract timestamps for each block
 
+        Timestamps of the next chunk are downloaded while the previous chunk is saved.
+        Stops before the first block that is not in parity, so saved blocks have no gaps
+
         Parameters
         ----------
         start : int
@@ -82,16 +150,19 @@ class Blocks:
         end : int
             End block number
         """
-        end = min(end, start + max_blocks - 1)
-        docs = [{
-            "number": i,
-            'id': i,
-        } for i in range(start, end + 1)]
-        if docs:
-            for chunk in tqdm(list(utils.split_on_chunks(docs, BLOCKS_PER_CHUNK))):
-                for doc in chunk:
-                    doc.update({'timestamp': self._extract_block_timestamp(doc['number'])})
-                self.client.bulk_index(docs=chunk, index=self.indices["block"], doc_type="b", refresh=True)
+        chunks = utils.split_on_chunks(range(start, end + 1), BLOCKS_PER_CHUNK)
+        stages = [lambda blocks: (blocks, self._extract_blocks_timestamps(blocks))]
+        progress_bar = tqdm(total=max(end - start + 1, 0))
+        with closing(utils.run_pipeline(chunks, stages, PIPELINE_QUEUE_SIZE)) as results:
+            for blocks, timestamps in results:
+                if None in timestamps:
+                    missing_block_index = timestamps.index(None)
+                    self._save_blocks(blocks[:missing_block_index], timestamps[:missing_block_index])
+                    print("Block {} is not found in parity".format(blocks[missing_block_index]))
+                    break
+                self._save_blocks(blocks, timestamps)
+                progress_bar.update(len(blocks))
+        progress_bar.close()
 
     def create_blocks(self):
         """
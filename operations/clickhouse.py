@@ -9,10 +9,15 @@ from operations.token_holders import ClickhouseTokenHolders
 from operations.token_prices import ClickhouseTokenPrices
 from operations.contract_methods import ClickhouseContractMethods
 from operations.bancor_trades import ClickhouseBancorTrades
+from operations.block_ranges import ClickhouseBlockRanges
+from operations.follow import ClickhouseFollower
+from operations.reorgs import ClickhouseReorgs
 from time import sleep
 import os
 from utils import repeat_on_exception
 
+BLOCK_FLAGS = ["traces_extracted", "events_extracted"]
+
 
 def prepare_indices():
     """
@@ -50,6 +55,15 @@ def extract_traces():
     internal_transactions.extract_traces()
 
 
+def import_traces(paths):
+    """
+    Import internal transactions from dump files
+    """
+    print("Importing internal transactions...")
+    internal_transactions = ClickhouseInternalTransactions()
+    internal_transactions.import_traces(paths)
+
+
 def extract_contracts_abi():
     """
     Extract ABI description from etherscan.io
@@ -132,6 +146,25 @@ def prepare_bancor_trades():
     trades.extract_trades()
 
 
+def migrate_block_flags():
+    """
+    Convert traces_extracted and events_extracted flags of blocks to ranges of processed blocks
+    """
+    print("Migrating block flags...")
+    prepare_indices()
+    for name in BLOCK_FLAGS:
+        ClickhouseBlockRanges(name).migrate_flags()
+
+
+def rollback(block):
+    """
+    Delete data of specified block and all following blocks to extract them again
+    """
+    print("Rolling back blocks since {}...".format(block))
+    reorgs = ClickhouseReorgs()
+    reorgs.rollback(block)
+
+
 def prepare_indices_and_views():
     """
     Prepare all indices and views in database
@@ -142,8 +175,8 @@ def prepare_indices_and_views():
 
 
 def _fill_database():
-    prepare_blocks()
     extract_traces()
+    prepare_blocks()
     extract_events()
     extract_tokens()
 
@@ -159,6 +192,19 @@ def synchronize():
     sleep(10)
 
 
+def follow():
+    """
+    Run continuous synchronization of the database.
+
+    Will extract all unprocessed blocks, then extract new blocks, internal transactions,
+    events and token descriptions as soon as new blocks appear in parity
+    """
+    prepare_indices()
+    print("Following new blocks...")
+    follower = ClickhouseFollower()
+    follower.follow()
+
+
 def synchronize_full():
     """
     Run full synchronization of the database
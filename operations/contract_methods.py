@@ -1,5 +1,4 @@
 import re
-from web3 import Web3, HTTPProvider
 from config import INDICES, PARITY_HOSTS
 import json
 import math
@@ -7,6 +6,7 @@ from decimal import Decimal
 import os
 import utils
 from clients.custom_clickhouse import CustomClickhouse
+from clients import parity_transport
 
 CURRENT_DIR = os.getcwd()
 MAX_TOTAL_SUPPLY = 1 << 63 - 1
@@ -53,7 +53,7 @@ class ClickhouseContractMethods:
     def __init__(self, indices=INDICES, parity_hosts=PARITY_HOSTS):
         self.indices = indices
         self.client = CustomClickhouse()
-        self.w3 = Web3(HTTPProvider(parity_hosts[0][2]))
+        self.w3 = parity_transport.create_web3(parity_hosts[0][2])
         self.standard_token_abi = standard_token_abi
         self._set_external_links()
 
@@ -1,5 +1,6 @@
 from clients.custom_clickhouse import CustomClickhouse
 from config import INDICES
+from operations.indices import make_partition_key
 from web3 import Web3
 
 
@@ -100,7 +101,7 @@ class ClickhouseContractTransactions:
         This function is an entry point for prepare-erc-transactions-view operation
         """
         fields_string = self._get_fields()
-        engine_string = 'ENGINE = ReplacingMergeTree() ORDER BY id'
+        engine_string = 'ENGINE = ReplacingMergeTree() PARTITION BY {} ORDER BY id'.format(make_partition_key("blockNumber"))
         condition = "type = 'create' AND error IS NULL AND parent_error IS NULL"
         sql = "CREATE MATERIALIZED VIEW IF NOT EXISTS {} {} POPULATE AS (SELECT {} FROM {} WHERE {})".format(
             self.indices["contract"],
@@ -1,43 +1,168 @@
 from clients.custom_clickhouse import CustomClickhouse
-from config import EVENTS_RANGE_SIZE, INDICES, PARITY_HOSTS
-from web3 import Web3, HTTPProvider
+from config import EVENTS_RANGE_SIZE, EVENTS_MAX_RANGE_SIZE, EVENTS_TARGET_COUNT, EVENTS_TARGET_TIME, \
+    EVENTS_RANGES_IN_FLIGHT, INDICES, PARITY_HOSTS, BLOCK_LEASE_SIZE
+from clients import parity_transport, parity_router
+from operations.block_ranges import ClickhouseBlockRanges
+from operations.block_leases import ClickhouseBlockLeases
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import utils
+import time
+import requests
+
+
+class LogsRequestError(Exception):
+    """
+    Parity refused to return events of a block range, for example because of too many results
+    """
+    pass
 
 
 class ClickhouseEvents:
     def __init__(self, indices=INDICES, parity_hosts=PARITY_HOSTS):
         self.client = CustomClickhouse()
         self.indices = indices
-        self.web3 = Web3(HTTPProvider(parity_hosts[0][-1], request_kwargs={'timeout': 100}))
+        self.parity_hosts = parity_hosts
+        self.range_size = EVENTS_RANGE_SIZE
+        self.block_ranges = ClickhouseBlockRanges("events_extracted", self.indices, self.client)
+        self.block_leases = ClickhouseBlockLeases(self.block_ranges) if BLOCK_LEASE_SIZE else None
+        self.executor = ThreadPoolExecutor(max_workers=EVENTS_RANGES_IN_FLIGHT)
+
+    def _get_next_host_bound(self, block):
+        """
+        Get first block after specified one which is served by another parity host
+
+        Parameters
+        ----------
+        block : int
+            Block number
 
-    def _iterate_block_ranges(self, range_size=EVENTS_RANGE_SIZE):
+        Returns
+        -------
+        int
+            Block number, None if all next blocks are served by the same host
+        """
+        bounds = [
+            bound
+            for host in self.parity_hosts
+            for bound in host[0:2]
+            if bound is not None and bound > block
+        ]
+        if bounds:
+            return min(bounds)
+
+    def _iterate_block_ranges(self, bounds=None):
         """
-        Iterate over unprocessed block ranges with given size
+        Iterate over unprocessed block ranges
+
+        Size of each range is taken from range_size attribute at the moment of iteration,
+        so it can be adapted while ranges are processed. Ranges don't cross bounds of parity hosts.
+        If BLOCK_LEASE_SIZE is set and bounds are not specified, only blocks claimed by this instance are returned
 
         Parameters
         ----------
-        range_size : list
-            Size of each block range
+        bounds : list
+            List of (start, end) tuples to search unprocessed blocks in, None to search in all blocks
+
         Returns
         -------
         generator
             Generator that iterates through unprocessed block ranges
         """
-        range_query = "distinct(toInt32(floor(number / {}))) AS range".format(range_size)
-        flags_query = "ANY LEFT JOIN (SELECT id, value FROM {} FINAL WHERE name = 'events_extracted') USING id WHERE value IS NULL".format(
-            self.indices["block_flag"])
-        for ranges_chunk in self.client.iterate(index=self.indices["block"], fields=[range_query], query=flags_query,
-                                                return_id=False):
-            for range in ranges_chunk:
-                range_bounds = (
-                    range["_source"]["range"] * range_size,
-                    (range["_source"]["range"] + 1) * range_size
-                )
-                yield range_bounds
+        max_block = self.block_ranges.get_last_block()
+        if max_block is None:
+            return
+        if bounds is not None:
+            unprocessed_ranges = self.block_ranges.get_unprocessed_ranges(max_block, bounds)
+        elif self.block_leases:
+            unprocessed_ranges = self.block_leases.iterate_unprocessed_ranges(max_block)
+        else:
+            unprocessed_ranges = self.block_ranges.get_unprocessed_ranges(max_block)
+        for start, end in unprocessed_ranges:
+            range_start = start
+            while range_start < end:
+                range_end = min(range_start + self.range_size, end)
+                host_bound = self._get_next_host_bound(range_start)
+                if host_bound is not None:
+                    range_end = min(range_end, host_bound)
+                yield (range_start, range_end)
+                range_start = range_end
+
+    def _get_logs(self, block_range):
+        """
+        Send eth_getLogs request to parity
+
+        Parameters
+        ----------
+        block_range : tuple
+            Start and end of block range
+
+        Returns
+        -------
+        list
+            Logs inside given block range (not including end block) as they are returned by parity
+
+        Raises
+        ------
+        LogsRequestError
+            If parity returned an error or all nodes that serve the range didn't answer in time
+        """
+        request = [{
+            "jsonrpc": "2.0",
+            "id": "logs",
+            "method": "eth_getLogs",
+            "params": [{"fromBlock": hex(block_range[0]), "toBlock": hex(block_range[1] - 1)}]
+        }]
+        errors = []
+
+        def send(parity_url):
+            try:
+                return list(parity_transport.iterate_jsonrpc_responses(parity_url, request))
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        try:
+            (response, size), = parity_router.get_router().call(
+                parity_router.get_urls(self.parity_hosts, block_range[0]), send
+            )
+        except requests.exceptions.Timeout as e:
+            if all(isinstance(error, requests.exceptions.Timeout) for error in errors):
+                raise LogsRequestError(e)
+            raise
+        if "error" in response:
+            raise LogsRequestError(response["error"])
+        return response["result"]
+
+    def _adapt_range_size(self, block_range, events_count, duration):
+        """
+        Resize next block ranges according to density of events in processed range
+
+        Range can't grow more than twice at once and is limited by EVENTS_MAX_RANGE_SIZE
+
+        Parameters
+        ----------
+        block_range : tuple
+            Start and end of processed block range
+        events_count : int
+            Number of events in processed range
+        duration : float
+            Duration of eth_getLogs call in seconds
+        """
+        blocks_count = block_range[1] - block_range[0]
+        range_sizes = [2 * self.range_size, EVENTS_MAX_RANGE_SIZE]
+        if events_count:
+            range_sizes.append(EVENTS_TARGET_COUNT * blocks_count / events_count)
+        if duration > 0:
+            range_sizes.append(EVENTS_TARGET_TIME * blocks_count / duration)
+        self.range_size = max(1, int(min(range_sizes)))
 
     def _get_events(self, block_range):
         """
         Get events from parity for given block range
 
+        Ranges rejected by parity are split in halves until each half is accepted
+
         Parameters
         ----------
         block_range : tuple
@@ -47,8 +172,18 @@ class ClickhouseEvents:
         list
             Events inside given block range (not including end block)
         """
-        event_filter = self.web3.eth.filter({"fromBlock": block_range[0], "toBlock": block_range[1] - 1})
-        events = event_filter.get_all_entries()
+        start_time = time.monotonic()
+        try:
+            events = self._get_logs(block_range)
+        except LogsRequestError as e:
+            start, end = block_range
+            if end - start <= 1:
+                raise
+            middle = (start + end) // 2
+            print("Splitting block range {}-{}: {}".format(start, end, e))
+            self.range_size = max(1, min(self.range_size, middle - start))
+            return self._get_events((start, middle)) + self._get_events((middle, end))
+        self._adapt_range_size(block_range, len(events), time.monotonic() - start_time)
         return events
 
     def _save_events(self, events):
@@ -62,7 +197,7 @@ class ClickhouseEvents:
         """
         events = [self._process_event(event) for event in events]
         if events:
-            self.client.bulk_index(index=self.indices["event"], docs=events)
+            self.client.bulk_index_columns(index=self.indices["event"], columns=utils.make_columns(events))
 
     def _process_event(self, event):
         """
@@ -79,37 +214,88 @@ class ClickhouseEvents:
             Prepared event
         """
         processed_event = event.copy()
-        processed_event["transactionLogIndex"] = int(event["transactionLogIndex"], 0)
-        processed_event["id"] = "{}.{}".format(event['transactionHash'].hex(), processed_event["transactionLogIndex"])
+        for field in ["blockNumber", "logIndex", "transactionIndex", "transactionLogIndex"]:
+            processed_event[field] = int(event[field], 0)
+        processed_event["id"] = "{}.{}".format(event["transactionHash"], processed_event["transactionLogIndex"])
         processed_event["address"] = event["address"].lower()
-        processed_event["blockHash"] = event["blockHash"].hex()
-        processed_event["transactionHash"] = event["transactionHash"].hex()
-        processed_event["topics"] = [topic.hex() for topic in event["topics"]]
         return processed_event
 
-    def _save_processed_blocks(self, block_range):
+    def _save_processed_blocks(self, block_ranges):
         """
-        Save events_extracted flag for processed blocks
+        Mark processed block ranges
 
         Parameters
         ----------
-        block_range : tuple
-            Start and end of processed block range
+        block_ranges : list
+            Starts and ends of processed block ranges
         """
-        block_flags = [{
-            "id": block,
-            "name": "events_extracted",
-            "value": 1
-        } for block in range(*block_range)]
-        self.client.bulk_index(index=self.indices["block_flag"], docs=block_flags)
+        self.block_ranges.add(block_ranges)
 
-    def extract_events(self):
+    def _commit_ranges(self, fetches, wait):
+        """
+        Save events of the first fetched block ranges and mark these ranges as processed
+
+        Ranges are committed in order of fetching.
+        Events of all fetched ranges are saved before ranges are marked,
+        so a range is never marked before its events are stored.
+        Ranges fetched before a failed one are committed before the exception is raised
+
+        Parameters
+        ----------
+        fetches : deque
+            Block ranges and futures with their events in order of fetching.
+            Committed ranges are removed from the deque
+        wait : bool
+            Wait for the first fetch to finish
+        """
+        block_ranges = []
+        events = []
+        error = None
+        while fetches and (fetches[0][1].done() or (wait and not block_ranges)):
+            block_range, future = fetches[0]
+            try:
+                events += future.result()
+            except Exception as e:
+                error = e
+                break
+            block_ranges.append(block_range)
+            fetches.popleft()
+        if block_ranges:
+            self._save_events(events)
+            self._save_processed_blocks(block_ranges)
+        if error:
+            raise error
+
+    def extract_events(self, bounds=None):
         """
         Extract parity events to a database
 
+        EVENTS_RANGES_IN_FLIGHT block ranges are fetched simultaneously,
+        fetched ranges are saved in order of block ranges
+
+        If BLOCK_LEASE_SIZE is set and bounds are not specified,
+        blocks are claimed in ranges shared with other extractor instances
+
         This function is an entry point for extract-events operation
+
+        Parameters
+        ----------
+        bounds : list
+            List of (start, end) tuples to search unprocessed blocks in, None to search in all blocks
         """
-        for block_range in self._iterate_block_ranges():
-            events = self._get_events(block_range)
-            self._save_events(events)
-            self._save_processed_blocks(block_range)
+        if self.block_leases and bounds is None:
+            with self.block_leases:
+                return self._extract_events()
+        return self._extract_events(bounds)
+
+    def _extract_events(self, bounds=None):
+        fetches = deque()
+        try:
+            for block_range in self._iterate_block_ranges(bounds):
+                fetches.append((block_range, self.executor.submit(self._get_events, block_range)))
+                self._commit_ranges(fetches, wait=len(fetches) >= EVENTS_RANGES_IN_FLIGHT)
+            while fetches:
+                self._commit_ranges(fetches, wait=True)
+        finally:
+            for block_range, future in fetches:
+                future.cancel()
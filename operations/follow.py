@@ -0,0 +1,119 @@
+from config import FOLLOW_POLL_INTERVAL, FOLLOW_MAX_POLL_INTERVAL
+from operations.internal_transactions import ClickhouseInternalTransactions
+from operations.blocks import ClickhouseBlocks
+from operations.events import ClickhouseEvents
+from operations.contract_methods import ClickhouseContractMethods
+from operations.reorgs import ClickhouseReorgs
+from time import sleep
+
+
+class ClickhouseFollower:
+    """
+    Long-running synchronization of the database with the head of the chain
+
+    All unprocessed blocks are extracted on start, then parity is polled for new blocks
+    and only blocks between the previous and the new head are passed through each stage.
+    Before each iteration last CONFIRMATION_DEPTH blocks are checked for chain reorganizations,
+    replaced blocks are rolled back and extracted again within the same iteration.
+    Stages keep their connections between iterations
+    """
+    def __init__(self, poll_interval=FOLLOW_POLL_INTERVAL, max_poll_interval=FOLLOW_MAX_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.internal_transactions = ClickhouseInternalTransactions()
+        self.blocks = ClickhouseBlocks()
+        self.events = ClickhouseEvents()
+        self.contract_methods = ClickhouseContractMethods()
+        self.reorgs = ClickhouseReorgs()
+        self.head = None
+
+    def _get_head(self):
+        """
+        Get last block available in parity hosts
+
+        Returns
+        -------
+        int
+            Block number
+        """
+        return self.internal_transactions._get_max_parity_block()
+
+    def wait_for_head(self):
+        """
+        Poll parity until a block after the last processed head appears
+
+        The interval between polls starts from poll_interval and is doubled up to max_poll_interval
+        while there are no new blocks or parity is not available
+
+        Returns
+        -------
+        int
+            Number of the new head
+        """
+        interval = self.poll_interval
+        while True:
+            try:
+                head = self._get_head()
+                if self.head is None or head > self.head:
+                    return head
+            except Exception as e:
+                print("Exception: ", e)
+            sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def _roll_back_reorg(self, bounds):
+        """
+        Roll back blocks replaced by a chain reorganization since the last processed head
+
+        Parameters
+        ----------
+        bounds : list
+            List of (start, end) tuples with new blocks to process
+
+        Returns
+        -------
+        list
+            Bounds extended with rolled back blocks
+        """
+        fork_block = self.reorgs.find_fork_block(self.head)
+        if fork_block is None:
+            return bounds
+        print("Rolling back blocks since {} after chain reorganization".format(fork_block))
+        self.reorgs.rollback(fork_block)
+        return [(fork_block, bounds[-1][1])]
+
+    def process(self, bounds):
+        """
+        Pass blocks through all stages of synchronization
+
+        Parameters
+        ----------
+        bounds : list
+            List of (start, end) tuples with blocks to process, None to process all unprocessed blocks
+        """
+        self.internal_transactions.extract_traces(bounds)
+        self.blocks.create_blocks()
+        self.events.extract_events(bounds)
+        self.contract_methods.search_methods()
+
+    def follow(self):
+        """
+        Process new blocks as soon as they appear in parity
+
+        Failed iterations are repeated after max_poll_interval seconds,
+        blocks which were processed before a failure are skipped
+
+        This function is an entry point for follow operation
+        """
+        while True:
+            head = self.wait_for_head()
+            bounds = None if self.head is None else [(self.head + 1, head + 1)]
+            try:
+                if self.head is not None:
+                    bounds = self._roll_back_reorg(bounds)
+                self.process(bounds)
+            except Exception as e:
+                print("Exception: ", e)
+                sleep(self.max_poll_interval)
+                continue
+            self.head = head
@@ -1,4 +1,4 @@
-from config import INDICES
+from config import INDICES, BLOCKS_PER_PARTITION
 from clients.custom_clickhouse import CustomClickhouse
 from schema.schema import SCHEMA
 
@@ -9,13 +9,36 @@ PRIMARY_KEYS = {
     "contract_block": ["id", "name"]
 }
 
+PARTITION_FIELDS = {
+    "block": "number",
+    "internal_transaction": "blockNumber",
+    "event": "blockNumber"
+}
+
+
+def make_partition_key(field):
+    """
+    Get partition key of a table with block data
+
+    Parameters
+    ----------
+    field : str
+        Name of field with block number
+
+    Returns
+    -------
+    str
+        SQL expression that splits blocks into partitions of BLOCKS_PER_PARTITION blocks
+    """
+    return "intDiv({}, {})".format(field, BLOCKS_PER_PARTITION)
+
 
 class ClickhouseIndices:
     def __init__(self, indices=INDICES):
         self.client = CustomClickhouse()
         self.indices = indices
 
-    def _create_index(self, index, fields={}, primary_key=["id"]):
+    def _create_index(self, index, fields={}, primary_key=["id"], partition_field=None):
         """
         Create specified index in database with specified field types and primary key
 
@@ -27,14 +50,34 @@ class ClickhouseIndices:
             Fields and their types and index
         primary_key : list
             All possible primary keys in index
+        partition_field : str
+            Field with block number to partition index by, None to create index without partitions
         """
         fields["id"] = "String"
         fields_string = ", ".join(["{} {}".format(name, type) for name, type in fields.items()])
         primary_key_string = ",".join(primary_key)
+        partition_string = "PARTITION BY {} ".format(make_partition_key(partition_field)) if partition_field else ""
         create_sql = """
-            CREATE TABLE IF NOT EXISTS {} ({}) ENGINE = ReplacingMergeTree() ORDER BY ({})
-        """.format(index, fields_string, primary_key_string)
+            CREATE TABLE IF NOT EXISTS {} ({}) ENGINE = ReplacingMergeTree() {}ORDER BY ({})
+        """.format(index, fields_string, partition_string, primary_key_string)
         self.client.send_sql_request(create_sql)
+        self._add_missing_fields(index, fields)
+
+    def _add_missing_fields(self, index, fields):
+        """
+        Add fields which appeared in schema after creation of specified index
+
+        Parameters
+        ----------
+        index : str
+            Name of index
+        fields : dict
+            Fields and their types
+        """
+        existing_fields = self.client._get_schema(index)["fields"]
+        for name, type in fields.items():
+            if name not in existing_fields:
+                self.client.send_sql_request("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(index, name, type))
 
     def prepare_indices(self):
         """
@@ -44,4 +87,4 @@ class ClickhouseIndices:
         """
         for key, index in self.indices.items():
             if key in INDEX_FIELDS:
-                self._create_index(index, INDEX_FIELDS[key], PRIMARY_KEYS.get(key, ["id"]))
+                self._create_index(index, INDEX_FIELDS[key], PRIMARY_KEYS.get(key, ["id"]), PARTITION_FIELDS.get(key))
@@ -1,4 +1,5 @@
 import json
+import itertools
 from ethereum.abi import (
     decode_abi,
     normalize_name as normalize_abi_method_name,
@@ -11,17 +12,92 @@ from clients.custom_clickhouse import CustomClickhouse
 
 NUMBER_OF_PROCESSES = INPUT_PARSING_PROCESSES
 
+_contracts_abi = {}
+_contracts_abi_version = None
+_contracts_abi_versions = itertools.count(1)
+_compiled_abis = {}
 
-def _decode_input(contract_abi, call_data):
+
+def _update_worker_abis(version, contracts_abi):
     """
-    Decode input data of a transaction according to a contract ABI
+    Store contracts ABI in a worker process
 
-    Solution from https://ethereum.stackexchange.com/questions/20897/how-to-decode-input-data-from-tx-using-python3?rq=1
+    ABI of contracts from the current batch is sent with each task,
+    compiled ABIs are dropped once a task with a new registry version arrives
+
+    Parameters
+    ----------
+    version : int
+        Version of contracts ABI registry, taken from _contracts_abi_versions
+        on each ClickhouseInputs._set_contracts_abi call
+    contracts_abi : dict
+        Contract addresses and attached lists of methods specifications
+    """
+    global _contracts_abi_version
+    if version != _contracts_abi_version:
+        _contracts_abi_version = version
+        _contracts_abi.clear()
+        _compiled_abis.clear()
+    _contracts_abi.update(contracts_abi)
+
+
+def _compile_abi(contract_abi):
+    """
+    Build an index of contract methods and events by their 4-byte selectors
+
+    Events are found by the first 4 bytes of topic0, which are placed
+    at the start of the input by ClickhouseEventsInputs
 
     Parameters
     ----------
     contract_abi : list
         List of contract methods specifications
+
+    Returns
+    -------
+    dict
+        Selectors and lists of tuples with normalized name and argument types in order of ABI
+    """
+    compiled_abi = {}
+    for description in contract_abi:
+        if description.get('type') not in ['function', 'event']:
+            continue
+        method_name = normalize_abi_method_name(description['name'])
+        arg_types = [item['type'] for item in description['inputs']]
+        method_signature = zpad(encode_int(get_abi_method_id(method_name, arg_types)), 4)
+        compiled_abi.setdefault(method_signature, []).append((method_name, arg_types))
+    return compiled_abi
+
+
+def _get_compiled_abi(address):
+    """
+    Get compiled ABI of a contract, compile it on the first call in current process
+
+    Parameters
+    ----------
+    address : str
+        Contract address with ABI stored by _update_worker_abis
+
+    Returns
+    -------
+    dict
+        Compiled ABI, see _compile_abi
+    """
+    if address not in _compiled_abis:
+        _compiled_abis[address] = _compile_abi(_contracts_abi[address])
+    return _compiled_abis[address]
+
+
+def _decode_input(compiled_abi, call_data):
+    """
+    Decode input data of a transaction according to a contract ABI
+
+    Solution from https://ethereum.stackexchange.com/questions/20897/how-to-decode-input-data-from-tx-using-python3?rq=1
+
+    Parameters
+    ----------
+    compiled_abi : dict
+        Contract ABI compiled by _compile_abi
     call_data : str
         Input of transaction in a form of 0x(4 bytes of method)(arguments),
         i.e. 0x12345678000000000000....
@@ -34,61 +110,80 @@ def _decode_input(contract_abi, call_data):
     """
     call_data_bin = decode_hex(call_data)
     method_signature = call_data_bin[:4]
-    for description in contract_abi:
-        if description.get('type') not in ['function', 'event']:
+    for method_name, arg_types in compiled_abi.get(method_signature, []):
+        try:
+            args = decode_abi(arg_types, call_data_bin[4:])
+            args = [{'type': arg_types[index], 'value': str(value)} for index, value in enumerate(args)]
+        except AssertionError:
             continue
-        method_name = normalize_abi_method_name(description['name'])
-        arg_types = [item['type'] for item in description['inputs']]
-        method_id = get_abi_method_id(method_name, arg_types)
-        if zpad(encode_int(method_id), 4) == method_signature:
-            try:
-                args = decode_abi(arg_types, call_data_bin[4:])
-                args = [{'type': arg_types[index], 'value': str(value)} for index, value in enumerate(args)]
-            except AssertionError:
-                continue
-            return {
-                'name': method_name,
-                'params.type': [arg["type"] for arg in args],
-                'params.value': [arg["value"] for arg in args]
-            }
-
-
-def _decode_inputs_batch_sync(encoded_params):
+        return {
+            'name': method_name,
+            'params.type': [arg["type"] for arg in args],
+            'params.value': [arg["value"] for arg in args]
+        }
+
+
+def _decode_inputs_batch_sync(encoded_params, version, contracts_abi):
     """
     Decode inputs for transactions inputs batch
 
     Parameters
     ----------
-    encoded_params : dict
-        Transaction hashes and attached tuples with contract ABI and transaction input
+    encoded_params : list
+        Tuples with transaction hash, contract address and transaction input
+    version : int
+        Version of contracts ABI registry
+    contracts_abi : dict
+        ABI of contracts from the batch
 
     Returns
     -------
     dict
         Contract addresses and attached lists of parsed parameters
     """
+    _update_worker_abis(version, contracts_abi)
     return {
-        hash: _decode_input(contract_abi, call_data)
-        for hash, (contract_abi, call_data) in encoded_params.items()
+        hash: _decode_input(_get_compiled_abi(address), call_data)
+        for hash, address, call_data in encoded_params
     }
 
 
 class ClickhouseInputs(utils.ClickhouseContractTransactionsIterator):
     _contracts_abi = {}
+    _contracts_abi_version = None
     block_prefix = "inputs_decoded"
 
     def __init__(self, indices=INDICES, parity_hosts=PARITY_HOSTS):
         self.indices = indices
         self.client = CustomClickhouse()
-        self.pool = Pool(processes=NUMBER_OF_PROCESSES)
+        self.pool = None
         self.parity_hosts = parity_hosts
 
+    def _create_pool(self):
+        """
+        Create pool of input parsing processes
+
+        Returns
+        -------
+        multiprocessing.Pool
+            Pool of NUMBER_OF_PROCESSES processes
+        """
+        return Pool(processes=NUMBER_OF_PROCESSES)
+
     def _set_contracts_abi(self, abis):
-        """Sets current contracts ABI for this object"""
+        """
+        Sets current contracts ABI for this object
+
+        Input parsing pool is created on the first call and reused afterwards,
+        new ABI reaches workers with the next decoded batches
+        """
         self._contracts_abi = {
             address: json.loads(abi)
             for address, abi in abis.items()
         }
+        self._contracts_abi_version = next(_contracts_abi_versions)
+        if not self.pool:
+            self.pool = self._create_pool()
 
     def _split_on_chunks(self, iterable, size):
         """
@@ -102,17 +197,21 @@ class ClickhouseInputs(utils.ClickhouseContractTransactionsIterator):
 
         Parameters
         ----------
-        encoded_params : dict
-            Transaction hashes and attached tuples with contract ABI and transaction input
+        encoded_params : list
+            Tuples with transaction hash, contract address and transaction input
 
         Returns
         -------
         dict
             Transaction hashes and parsed inputs for each transaction
         """
-        chunks = list(self._split_on_chunks(list(encoded_params.items()), NUMBER_OF_PROCESSES))
-        chunks = [dict(chunk) for chunk in chunks]
-        decoded_inputs = self.pool.map(_decode_inputs_batch_sync, chunks)
+        chunks = list(self._split_on_chunks(encoded_params, NUMBER_OF_PROCESSES))
+        tasks = [(
+            chunk,
+            self._contracts_abi_version,
+            {address: self._contracts_abi[address] for _, address, _ in chunk}
+        ) for chunk in chunks]
+        decoded_inputs = self.pool.starmap(_decode_inputs_batch_sync, tasks)
         return {hash: input for chunk in decoded_inputs for hash, input in chunk.items()}
 
     def _get_range_query(self):
@@ -180,13 +279,10 @@ class ClickhouseInputs(utils.ClickhouseContractTransactionsIterator):
         """
         for transactions in self._iterate_transactions_by_targets(contracts, max_block):
             try:
-                inputs = {
-                    transaction["_id"]: (
-                        self._contracts_abi[transaction["_source"][self.contract_field]],
-                        transaction["_source"]["input"]
-                    )
+                inputs = [
+                    (transaction["_id"], transaction["_source"][self.contract_field], transaction["_source"]["input"])
                     for transaction in transactions
-                }
+                ]
                 decoded_inputs = self._decode_inputs_batch(inputs)
                 self._add_id_to_inputs(decoded_inputs)
                 self.client.bulk_index(index=self.indices[self.input_index], docs=list(decoded_inputs.values()))
@@ -1,17 +1,25 @@
-import requests
+import os
 import json
+import gzip
+import asyncio
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from multiprocessing import Pool
-from itertools import repeat
-from config import PARITY_HOSTS, GENESIS, INDICES, PARITY_EXTRACTION_PROCESSES
+from config import PARITY_HOSTS, GENESIS, INDICES, PARITY_BATCHES_IN_FLIGHT, PARITY_BLOCKS_PER_BATCH, \
+    PIPELINE_QUEUE_SIZE, TRACES_CHUNK_MAX_SIZE, ETHEREUM_START_DATE, TRACES_IMPORT_PROCESSES, \
+    TRACES_IMPORT_CHUNK_SIZE, PARITY_BATCH_WEIGHT, PARITY_MAX_BLOCKS_PER_BATCH, \
+    BLOCK_LEASE_SIZE
 from clients.custom_clickhouse import CustomClickhouse
-import pygtrie as trie
+from operations.block_ranges import ClickhouseBlockRanges, blocks_to_ranges, intersect_bounds
+from operations.block_leases import ClickhouseBlockLeases
+from clients import parity_transport, parity_router
+from schema.schema import SCHEMA
+from operator import itemgetter
+from datetime import datetime
 import utils
-from pyelasticsearch import bulk_chunks
 import pdb
 
-BYTES_PER_CHUNK = 1000000
-NUMBER_OF_PROCESSES = PARITY_EXTRACTION_PROCESSES
-
 INPUT_TRANSACTION = 0
 INTERNAL_TRANSACTION = 1
 OUTPUT_TRANSACTION = 2
@@ -19,26 +27,12 @@ OTHER_TRANSACTION = 3
 
 MAX_BLOCKS_NUMBER = 10000000
 
+BLOCK_WEIGHT_SMOOTHING = 0.5
 
-def _get_parity_url_by_block(parity_hosts, block):
-    """
-    Get url of a parity JSON RPC API for specified block
-
-    Parameters
-    ----------
-    parity_hosts : list
-        List of tuples with each parity JSON RPC url and used block range
-    block : int
-        Block number
+NESTED_TRACE_FIELDS = ["action", "result"]
+COMPUTED_TRACE_FIELDS = ["parent_error"]
 
-    Returns
-    -------
-    str
-        Url of parity API that will serve specified block
-    """
-    for bottom_line, upper_bound, url in parity_hosts:
-        if ((not bottom_line) or (block >= bottom_line)) and ((not upper_bound) or (block < upper_bound)):
-            return url
+_importer = None
 
 
 def _make_requests(parity_hosts, blocks, request):
@@ -54,14 +48,14 @@ def _make_requests(parity_hosts, blocks, request):
     Returns
     -------
     dict
-        Urls and lists of requests attached to it
+        Tuples of urls that serve the same blocks and lists of requests attached to them
     """
     requests = {}
     for block_number in blocks:
-        parity_url = _get_parity_url_by_block(parity_hosts, block_number)
-        if parity_url not in requests.keys():
-            requests[parity_url] = []
-        requests[parity_url].append(request(block_number))
+        parity_urls = parity_router.get_urls(parity_hosts, block_number)
+        if parity_urls not in requests.keys():
+            requests[parity_urls] = []
+        requests[parity_urls].append(request(block_number))
     return requests
 
 
@@ -131,9 +125,124 @@ def _merge_block(internal_transactions, transactions, whitelist):
     return internal_transactions
 
 
-def _send_jsonrpc_request(parity_url, request, getter):
+def _make_block_header(block):
     """
-    Send a bunch of requests to parity node
+    Convert block from eth_getBlockByNumber response to a record of blocks table
+
+    Parameters
+    ----------
+    block : dict
+        Block with transactions or transaction hashes
+
+    Returns
+    -------
+    dict
+        Block number, hash, timestamp, miner, used gas, gas limit, difficulty, base fee and number of transactions
+    """
+    number = int(block["number"], 0)
+    base_fee = block.get("baseFeePerGas")
+    return {
+        "id": number,
+        "number": number,
+        "hash": block["hash"],
+        "timestamp": datetime.fromtimestamp(int(block["timestamp"], 0)) if number else ETHEREUM_START_DATE,
+        "miner": block["miner"],
+        "gasUsed": int(block["gasUsed"], 0),
+        "gasLimit": int(block["gasLimit"], 0),
+        "difficulty": int(block["difficulty"], 0),
+        "baseFeePerGas": int(base_fee, 0) if base_fee is not None else None,
+        "transactionsCount": len(block["transactions"])
+    }
+
+
+def _parse_hex(value):
+    """
+    Parse hex string of integer field, other values are kept as is
+    """
+    if isinstance(value, str):
+        return int(value[2:] or "0", 16)
+    return value
+
+
+def _parse_ether(value):
+    """
+    Convert hex string with amount of wei to ether, empty values are kept as is
+    """
+    if value:
+        return int(value[2:] or "0", 16) / 1e18
+    return value
+
+
+def _compile_trace_schema(fields):
+    """
+    Prepare conversion of transactions to rows of internal transactions table
+
+    Float fields contain amounts of wei converted to ether, integer fields are parsed from hex.
+    Fields with nested objects and computed fields are skipped
+
+    Parameters
+    ----------
+    fields : dict
+        Fields and their types
+
+    Returns
+    -------
+    dict
+        List of field names in "fields", record with empty fields in "template",
+        function to get row of values from record in "getter"
+        and functions to parse values of fields in "parsers"
+    """
+    names = [field for field in fields.keys() if field not in NESTED_TRACE_FIELDS + COMPUTED_TRACE_FIELDS]
+    parsers = {}
+    for field in names:
+        if "Float" in fields[field]:
+            parsers[field] = _parse_ether
+        elif ("Int" in fields[field]) and not fields[field].startswith("Array"):
+            parsers[field] = _parse_hex
+    return {
+        "fields": names,
+        "template": dict.fromkeys(names),
+        "getter": itemgetter(*names),
+        "parsers": parsers
+    }
+
+
+TRACE_SCHEMA = _compile_trace_schema(SCHEMA["internal_transaction"])
+
+
+def _make_trace_columns(schema, rows, hashes, parent_errors):
+    """
+    Convert rows of transactions to columns and parse their values
+
+    Parameters
+    ----------
+    schema : dict
+        Compiled schema of internal transactions table
+    rows : list
+        List of tuples with values of schema fields
+    hashes : list
+        Hash of each transaction
+    parent_errors : list
+        parent_error flag of each transaction
+
+    Returns
+    -------
+    dict
+        Field names and lists of values
+    """
+    values = zip(*rows) if rows else [[] for _ in schema["fields"]]
+    columns = {}
+    for field, column in zip(schema["fields"], values):
+        parser = schema["parsers"].get(field)
+        columns[field] = [parser(value) for value in column] if parser else list(column)
+    columns["hash"] = hashes
+    columns["parent_error"] = parent_errors
+    return columns
+
+
+def _send_jsonrpc_request_with_size(parity_url, request, getter):
+    """
+    Send a bunch of requests to parity node and parse responses one by one as they are received
 
     Parameters
     ----------
@@ -146,32 +255,137 @@ def _send_jsonrpc_request(parity_url, request, getter):
 
     Returns
     -------
-    list
-        List of all responses.
-        Responses with errors will be skipped
+    tuple
+        List of all responses, responses with errors will be skipped.
+        Size of received JSON in bytes
     """
-    request_string = json.dumps(request)
-    responses = requests.post(
-        parity_url,
-        data=request_string,
-        headers={"content-type": "application/json"}
-    ).json()
     full_response = []
-    assert type(responses) == list
-    for response in responses:
+    size = 0
+    for response, response_size in parity_transport.iterate_jsonrpc_responses(parity_url, request):
+        size += response_size
         try:
             full_response += getter(response)
         except Exception as e:
             print("Exception while processing response:")
             print(e)
-    return full_response
+    return full_response, size
+
+
+def _send_jsonrpc_request(parity_url, request, getter):
+    """
+    Send a bunch of requests to parity node
+
+    Parameters
+    ----------
+    parity_url : str
+        URL of parity node JSONRPC API
+    request : list
+        All parity requests to send
+    getter : function
+        Function to get target field from response
+
+    Returns
+    -------
+    list
+        List of all responses.
+        Responses with errors will be skipped
+    """
+    return _send_jsonrpc_request_with_size(parity_url, request, getter)[0]
+
+
+def _send_jsonrpc_request_routed(parity_urls, request, getter):
+    """
+    Send a bunch of requests to one of parity nodes chosen by the router of current process
+
+    Request is retried on other nodes if it fails
+
+    Parameters
+    ----------
+    parity_urls : tuple
+        URLs of parity nodes that serve requested blocks
+    request : list
+        All parity requests to send
+    getter : function
+        Function to get target field from response
+
+    Returns
+    -------
+    tuple
+        List of all responses and size of received JSON, as in _send_jsonrpc_request_with_size
+    """
+    return parity_router.get_router().call(
+        parity_urls,
+        lambda parity_url: _send_jsonrpc_request_with_size(parity_url, request, getter)
+    )
 
 
-def _get_traces_sync(parity_hosts, blocks):
+async def _send_jsonrpc_request_async(parity_urls, request, getter, executor=None):
     """
-    Get traces for specified blocks in one array
+    Send a bunch of requests to parity nodes without blocking the event loop
+
+    Parameters
+    ----------
+    parity_urls : tuple
+        URLs of parity nodes that serve requested blocks
+    request : list
+        All parity requests to send
+    getter : function
+        Function to get target field from response
+    executor : concurrent.futures.Executor
+        Executor that performs blocking HTTP calls
+
+    Returns
+    -------
+    tuple
+        List of all responses and size of received JSON, as in _send_jsonrpc_request_with_size
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, _send_jsonrpc_request_routed, parity_urls, request, getter)
 
-    Will be extended with gasUsed and gasPrice info from transactions in chain
+
+async def _get_group_traces_async(parity_urls, trace_request, transactions_request, semaphore, executor=None):
+    """
+    Send requests with traces and chain blocks of one batch to a group of parity nodes
+
+    Waits for a free slot of the group before sending both requests,
+    so the number of batches in flight for each group is limited by the semaphore
+
+    Parameters
+    ----------
+    parity_urls : tuple
+        URLs of parity nodes that serve requested blocks
+    trace_request : list
+        Requests with traces
+    transactions_request : list
+        Requests with chain blocks
+    semaphore : asyncio.Semaphore
+        Semaphore attached to the group of parity nodes
+    executor : concurrent.futures.Executor
+        Executor that performs blocking HTTP calls
+
+    Returns
+    -------
+    list
+        Responses with traces and chain blocks, as in _send_jsonrpc_request_with_size
+    """
+    async with semaphore:
+        return await asyncio.gather(
+            _send_jsonrpc_request_async(parity_urls, trace_request, lambda x: x.get("result"), executor),
+            _send_jsonrpc_request_async(
+                parity_urls,
+                transactions_request,
+                lambda x: [x["result"]] if x.get("result") else [],
+                executor
+            )
+        )
+
+
+async def _get_traces_async(parity_hosts, blocks, semaphores, executor=None):
+    """
+    Get traces and headers for specified blocks
+
+    Requests with traces and requests with chain blocks are sent to each group of parity nodes at the same time.
+    Traces will be extended with gasUsed and gasPrice info from transactions in chain
 
     Parameters
     ----------
@@ -179,165 +393,442 @@ def _get_traces_sync(parity_hosts, blocks):
         List of tuples with each parity JSON RPC url and used block range. Can be found in conflg.py
     blocks : list
         Block numbers
+    semaphores : dict
+        Tuples of parity urls that serve the same blocks and attached semaphores
+        that limit number of batches in flight
+    executor : concurrent.futures.Executor
+        Executor that performs blocking HTTP calls
+
     Returns
     -------
-    list
-        List of transactions inside of specified blocks
+    tuple
+        List of transactions inside of specified blocks, list of block headers
+        and size of parity responses in bytes
     """
     trace_requests_dict = _make_trace_requests(parity_hosts, blocks)
     transactions_requests_dict = _make_transactions_requests(parity_hosts, blocks)
-    traces = []
-    for parity_url, trace_request in trace_requests_dict.items():
-        transactions_request = transactions_requests_dict[parity_url]
-        trace_response = _send_jsonrpc_request(
-            parity_url,
+    calls = [
+        _get_group_traces_async(
+            parity_urls,
             trace_request,
-            lambda x: x.get("result")
+            transactions_requests_dict[parity_urls],
+            semaphores[parity_urls],
+            executor
         )
-        transactions_response = _send_jsonrpc_request(
-            parity_url,
-            transactions_request,
-            lambda x: x.get("result", {"transactions": []}).get("transactions")
-        )
-        traces += _merge_block(trace_response, transactions_response, ["gasUsed", "gasPrice"])
-    return traces
+        for parity_urls, trace_request in trace_requests_dict.items()
+    ]
+    responses = await asyncio.gather(*calls)
+    traces = []
+    headers = []
+    size = sum(response_size for group_responses in responses for response, response_size in group_responses)
+    for (trace_response, _), (blocks_response, _) in responses:
+        transactions = [transaction for block in blocks_response for transaction in block["transactions"]]
+        traces += _merge_block(trace_response, transactions, ["gasUsed", "gasPrice"])
+        headers += [_make_block_header(block) for block in blocks_response]
+    return traces, headers, size
+
+
+def _open_dump(path):
+    """
+    Open dump file as text, decompress it according to its extension
+
+    Parameters
+    ----------
+    path : str
+        Path to plain, .gz or .zst file
+
+    Returns
+    -------
+    file
+        Text file object
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard package is required to import {}".format(path))
+        return zstandard.open(path, "rt")
+    return open(path)
+
+
+def _list_dump_files(paths):
+    """
+    Get dump files from specified files and directories
+
+    Parameters
+    ----------
+    paths : list
+        Paths to dump files or directories with dump files
+
+    Returns
+    -------
+    list
+        Sorted paths to dump files
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, file_name) for file_name in os.listdir(path)
+                      if os.path.isfile(os.path.join(path, file_name))]
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def _iterate_dump(path):
+    """
+    Iterate through records of JSONL dump file
+
+    Each line is a result of trace_block (list of traces)
+    or a result of eth_getBlockByNumber with transactions (block).
+    Lines with whole JSON RPC responses are also accepted
+
+    Parameters
+    ----------
+    path : str
+        Path to dump file
+
+    Returns
+    -------
+    generator
+        Generator that returns a tuple of traces list and block (one of them is None) for each line
+    """
+    with _open_dump(path) as dump:
+        for line in dump:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict) and ("result" in record):
+                record = record["result"]
+            if isinstance(record, list):
+                yield record, None
+            elif record:
+                yield None, record
+
+
+def _get_dump_record_block(record):
+    """
+    Get block number of dump record
+
+    Parameters
+    ----------
+    record : tuple
+        Traces list and block (one of them is None)
+
+    Returns
+    -------
+    int
+        Block number, None for empty traces list
+    """
+    block_traces, block = record
+    if block is not None:
+        return int(block["number"], 0)
+    if block_traces:
+        return block_traces[0]["blockNumber"]
+
+
+def _merge_dump_records(records):
+    """
+    Merge traces and blocks records of dump file
+
+    Parameters
+    ----------
+    records : list
+        Tuples of traces list and block (one of them is None)
+
+    Returns
+    -------
+    tuple
+        Sorted block numbers, traces extended with gasUsed and gasPrice and block headers
+    """
+    blocks = set()
+    traces = []
+    dump_blocks = []
+    for block_traces, block in records:
+        if block is None:
+            blocks.update(trace["blockNumber"] for trace in block_traces)
+            traces += block_traces
+        else:
+            blocks.add(int(block["number"], 0))
+            dump_blocks.append(block)
+    transactions = [
+        transaction
+        for block in dump_blocks
+        for transaction in block.get("transactions", [])
+        if isinstance(transaction, dict)
+    ]
+    traces = _merge_block(traces, transactions, ["gasUsed", "gasPrice"])
+    return sorted(blocks), traces, [_make_block_header(block) for block in dump_blocks]
+
+
+def _import_dump_file(path):
+    """
+    Import dump file in a worker process
+
+    Parameters
+    ----------
+    path : str
+        Path to dump file
+
+    Returns
+    -------
+    tuple
+        Path and ranges of imported blocks
+    """
+    global _importer
+    if _importer is None:
+        _importer = ClickhouseInternalTransactions()
+    return path, blocks_to_ranges(_importer._import_dump(path))
 
 
 class InternalTransactions:
     def __init__(self, indices, client, parity_hosts):
         self.indices = indices
         self.client = client
-        self.pool = Pool(processes=NUMBER_OF_PROCESSES)
         self.parity_hosts = parity_hosts
+        self.loop = asyncio.new_event_loop()
+        self.semaphores = self.loop.run_until_complete(self._create_semaphores())
+        self.executor = ThreadPoolExecutor(max_workers=2 * self._get_batches_in_flight())
+        self.block_weight = PARITY_BATCH_WEIGHT / PARITY_BLOCKS_PER_BATCH
+
+    async def _create_semaphores(self):
+        """
+        Create semaphores that limit number of batches in flight for each group of parity nodes
+
+        Each group of nodes that serve the same blocks gets PARITY_BATCHES_IN_FLIGHT slots for each node
+
+        Returns
+        -------
+        dict
+            Tuples of parity urls and attached semaphores
+        """
+        return {
+            parity_urls: asyncio.Semaphore(PARITY_BATCHES_IN_FLIGHT * len(parity_urls))
+            for parity_urls in parity_router.get_groups(self.parity_hosts)
+        }
+
+    def _get_batches_in_flight(self):
+        """
+        Get max number of batches in flight for all parity nodes
+
+        Returns
+        -------
+        int
+            Number of batches
+        """
+        return sum(PARITY_BATCHES_IN_FLIGHT * len(parity_urls) for parity_urls in self.semaphores)
 
     def _split_on_chunks(self, iterable, size):
         """Split given iterable onto chunks"""
         return utils.split_on_chunks(iterable, size)
 
-    def _get_traces(self, blocks):
+    def _update_block_weight(self, headers):
         """
-        Get traces for specified blocks in parallel mode
+        Update estimated weight of blocks with unknown weight by headers of extracted blocks
 
         Parameters
         ----------
-        blocks : list
+        headers : list
+            List of block headers
+        """
+        if headers:
+            weight = sum(header["transactionsCount"] + 1 for header in headers) / len(headers)
+            self.block_weight += BLOCK_WEIGHT_SMOOTHING * (weight - self.block_weight)
+
+    def _iterate_batches(self, blocks):
+        """
+        Split blocks into batches of about PARITY_BATCH_WEIGHT weight
+
+        Weight of a block is the number of its transactions plus one.
+        It is estimated from recently extracted blocks.
+        Batches are created lazily, so the estimation is updated while blocks are extracted
+
+        Parameters
+        ----------
+        blocks : iterable
             Block numbers
+
         Returns
         -------
-        list
-            List of transactions inside of specified blocks
+        generator
+            Generator that returns list of block numbers for each batch
         """
-        chunks = self._split_on_chunks(blocks, NUMBER_OF_PROCESSES)
-        arguments = list(zip(repeat(self.parity_hosts), chunks))
-        traces = self.pool.starmap(_get_traces_sync, arguments)
-        return [transaction for trace in traces for transaction in trace]
+        batch = []
+        batch_weight = 0
+        for block in blocks:
+            if batch and ((batch_weight + self.block_weight > PARITY_BATCH_WEIGHT)
+                          or (len(batch) >= PARITY_MAX_BLOCKS_PER_BATCH)):
+                yield batch
+                batch = []
+                batch_weight = 0
+            batch.append(block)
+            batch_weight += self.block_weight
+        if batch:
+            yield batch
 
-    def _set_trace_hashes(self, trace):
+    def _iterate_traces(self, blocks):
         """
-        Set hash for each transaction in trace based on Ethereum transaction hash
-        and position in trace for this transaction
+        Get traces for specified blocks in concurrent mode
+
+        Batches of blocks are sized by their weight. Each time a batch is received,
+        the next one is sent, so up to PARITY_BATCHES_IN_FLIGHT batches for each parity node
+        are always in flight and one heavy batch doesn't hold others.
+        Traces of each batch are returned as soon as it is received
 
         Parameters
         ----------
-        trace : list
-            List of transactions
+        blocks : iterable
+            Block numbers
+        Returns
+        -------
+        generator
+            Generator that returns block numbers, list of transactions, list of block headers
+            and size of parity responses for each completed batch
         """
-        traces_size = {}
-        for transaction in trace:
-            transaction_hash = transaction["transactionHash"] or transaction["blockHash"]
-            if transaction_hash not in traces_size.keys():
-                traces_size[transaction_hash] = 0
-            transaction["hash"] = "{}.{}".format(transaction_hash, traces_size[transaction_hash])
-            traces_size[transaction_hash] += 1
+        batches = self._iterate_batches(blocks)
+        max_pending = self._get_batches_in_flight()
+        tasks = {}
+        try:
+            while True:
+                for batch in islice(batches, max_pending - len(tasks)):
+                    task = self.loop.create_task(
+                        _get_traces_async(self.parity_hosts, batch, self.semaphores, self.executor)
+                    )
+                    tasks[task] = batch
+                if not tasks:
+                    break
+                done, _ = self.loop.run_until_complete(
+                    asyncio.wait(set(tasks), return_when=asyncio.FIRST_COMPLETED)
+                )
+                for task in done:
+                    batch = tasks.pop(task)
+                    traces, headers, size = task.result()
+                    self._update_block_weight(headers)
+                    yield batch, traces, headers, size
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
 
-    def _set_parent_errors(self, trace):
+    def _get_traces(self, blocks):
         """
-        Set parent_error flag for all transactions in branches finished with error in trace
+        Get traces and headers for specified blocks in concurrent mode
 
         Parameters
         ----------
-        trace : list
-            List of transactions
+        blocks : list
+            Block numbers
+        Returns
+        -------
+        tuple
+            List of transactions inside of specified blocks and list of block headers
         """
-        errors = {}
-        for transaction in trace:
-            if "error" in transaction.keys():
-                if transaction["transactionHash"] not in errors.keys():
-                    errors[transaction["transactionHash"]] = trie.Trie()
-                errors[transaction["transactionHash"]][transaction["traceAddress"]] = True
-        for transaction in trace:
-            if transaction["transactionHash"] in errors.keys():
-                prefix_exists = bool(
-                    errors[transaction["transactionHash"]].shortest_prefix(transaction["traceAddress"]))
-                is_node = errors[transaction["transactionHash"]].has_key(transaction["traceAddress"])
-                if prefix_exists and not is_node:
-                    transaction["parent_error"] = True
+        traces = []
+        headers = []
+        for batch_blocks, batch_traces, batch_headers, batch_size in self._iterate_traces(blocks):
+            traces += batch_traces
+            headers += batch_headers
+        return traces, headers
 
-    def _preprocess_internal_transaction(self, transaction):
+    def _iterate_traces_chunks(self, bounds=None):
         """
-        Preprocess specified transaction
+        Get traces of all unprocessed blocks
 
-        Flattens array fields, unhexes numeric fields
+        Unprocessed blocks are extracted as one stream, so batches of the next chunk of blocks
+        are sent while the last batches of the previous one are in flight.
+        A part is returned as soon as size of its parity responses exceeds TRACES_CHUNK_MAX_SIZE,
+        so memory used by traces waiting for transformation and insertion is limited
 
         Parameters
         ----------
-        transaction : dict
-            Transactions to process
+        bounds : list
+            List of (start, end) tuples to search unprocessed blocks in, None to search in all blocks
 
         Returns
         -------
-        dict
-            Processed transaction
+        generator
+            Generator that returns block numbers, list of transactions and list of block headers
         """
-        transaction = transaction.copy()
-        for field in ["action", "result"]:
-            if (field in transaction.keys()) and (transaction[field]):
-                transaction.update(transaction[field])
-                del transaction[field]
-        for field in ["value", "gasPrice", "gasUsed"]:
-            if (field in transaction.keys()) and (transaction[field]):
-                value_string = transaction[field][0:2] + "0" + transaction[field][2:]
-                transaction[field] = int(value_string, 0) / 1e18
-        if "gasUsed" in transaction:
-            transaction["gasUsed"] = int(transaction["gasUsed"] * 1e18)
-        return transaction
+        blocks = (block for chunk in self._iterate_blocks(bounds) for block in chunk)
+        part = ([], [], [])
+        part_size = 0
+        for batch_blocks, batch_traces, batch_headers, batch_size in self._iterate_traces(blocks):
+            part[0].extend(batch_blocks)
+            part[1].extend(batch_traces)
+            part[2].extend(batch_headers)
+            part_size += batch_size
+            if part_size >= TRACES_CHUNK_MAX_SIZE:
+                yield part
+                part = ([], [], [])
+                part_size = 0
+        if part[0]:
+            yield part
 
-    def _save_internal_transactions(self, blocks_traces):
+    def _set_parent_errors(self, trace):
         """
-        Save specified transactions to the database in multiple chunks
+        Set parent_error flag for all transactions in branches finished with error in trace
 
-        Save only those which are attached to an ethereum transaction
+        Transactions of each ethereum transaction with errors are walked in order of traceAddress,
+        so every branch goes right after its root and is marked while the root is remembered
 
         Parameters
         ----------
-        blocks_traces : list
-            List of transactions to save
+        trace : list
+            List of transactions
         """
-        docs = [
-            self._preprocess_internal_transaction(transaction)
-            for transaction in blocks_traces
-            if transaction["transactionHash"]
-        ]
-        if docs:
-            for chunk in bulk_chunks(docs, None, BYTES_PER_CHUNK):
-                self.client.bulk_index(docs=chunk, index=self.indices["internal_transaction"], doc_type="itx",
-                                       id_field="hash", refresh=True)
+        errors = {}
+        for transaction in trace:
+            if "error" in transaction:
+                errors.setdefault(transaction["transactionHash"], set()).add(tuple(transaction["traceAddress"]))
+        if not errors:
+            return
+        branches = {}
+        for transaction in trace:
+            if transaction["transactionHash"] in errors:
+                branches.setdefault(transaction["transactionHash"], []).append(transaction)
+        for transaction_hash, transactions in branches.items():
+            failed_addresses = errors[transaction_hash]
+            failed_root = None
+            for transaction in sorted(transactions, key=itemgetter("traceAddress")):
+                address = tuple(transaction["traceAddress"])
+                if (failed_root is not None) \
+                        and (len(address) > len(failed_root)) \
+                        and (address[:len(failed_root)] == failed_root):
+                    if address not in failed_addresses:
+                        transaction["parent_error"] = True
+                elif address in failed_addresses:
+                    failed_root = address
+                else:
+                    failed_root = None
 
-    def _save_miner_transactions(self, blocks_traces):
+    def _save_internal_transactions(self, columns):
         """
-        Save transactions to ElasticSearch.
+        Save columns of transactions attached to an ethereum transaction to the database
 
-        Save only those which are not attached to any ethereum transaction
+        Parameters
+        ----------
+        columns : dict
+            Field names and lists of values
+        """
+        if columns["hash"]:
+            self.client.bulk_index_columns(columns=columns, index=self.indices["internal_transaction"],
+                                           id_field="hash")
+
+    def _save_miner_transactions(self, columns):
+        """
+        Save columns of transactions which are not attached to any ethereum transaction to the database
 
         Parameters
         ----------
-        blocks_traces : list
-            List of transactions to save
+        columns : dict
+            Field names and lists of values
         """
-        docs = [self._preprocess_internal_transaction(transaction) for transaction in blocks_traces if
-                not transaction["transactionHash"]]
-        self.client.bulk_index(docs=docs, index=self.indices["miner_transaction"], doc_type="tx", id_field="hash",
-                               refresh=True)
+        if columns["hash"]:
+            self.client.bulk_index_columns(columns=columns, index=self.indices["miner_transaction"],
+                                           id_field="hash")
 
     def _save_genesis_block(self, genesis_file=GENESIS):
         """
@@ -360,72 +851,368 @@ class InternalTransactions:
         self.client.bulk_index(docs=genesis, index=self.indices["internal_transaction"], doc_type="itx",
                                id_field="hash", refresh=True)
 
-    def _extract_traces_chunk(self, blocks):
+    def _transform_traces(self, blocks_traces):
         """
-        Extract transactions from specified block numbers list
+        Convert trace to columns of internal and miner transactions within one pass
 
-        Add trace hashes for each one, parent_error field
-        Saves transactions as internal or miner (without ethereum transaction hash)
-        Then saves a flag for processed blocks to ElasticSearch
+        Sets hash from ethereum transaction hash (or block hash for miner transactions)
+        and position in trace, flattens action and result fields, parses numbers
+        and sets parent_error for transactions inside of failed branches.
+
+        Parent errors are tracked while walking each ethereum transaction in order of traceAddress,
+        as parity returns them. Copies of traces in other order are passed to _set_parent_errors,
+        so given traces are never changed
+
+        Parameters
+        ----------
+        blocks_traces : list
+            List of transactions
+
+        Returns
+        -------
+        tuple
+            Columns of internal transactions and columns of miner transactions
+        """
+        schema = TRACE_SCHEMA
+        template = schema["template"]
+        getter = schema["getter"]
+        rows = ([], [])
+        hashes = ([], [])
+        parent_errors = ([], [])
+        buffers = [(rows[table].append, hashes[table].append, parent_errors[table].append) for table in range(2)]
+        traces_size = {}
+        previous_hash = None
+        previous_address = None
+        failed_root = None
+        ordered = True
+        has_errors = False
+        for transaction in blocks_traces:
+            transaction_hash = transaction["transactionHash"]
+            trace_key = transaction_hash or transaction["blockHash"]
+            position = traces_size.get(trace_key, 0)
+            traces_size[trace_key] = position + 1
+            parent_error = None
+            if transaction_hash:
+                address = transaction["traceAddress"]
+                failed = "error" in transaction
+                has_errors = has_errors or failed
+                if transaction_hash != previous_hash:
+                    ordered = ordered and not position
+                    failed_root = None
+                elif address <= previous_address:
+                    ordered = False
+                if (failed_root is not None) \
+                        and (len(address) > len(failed_root)) \
+                        and (address[:len(failed_root)] == failed_root):
+                    if not failed:
+                        parent_error = True
+                elif failed:
+                    failed_root = address
+                else:
+                    failed_root = None
+                previous_hash = transaction_hash
+                previous_address = address
+                append_row, append_hash, append_parent_error = buffers[0]
+            else:
+                append_row, append_hash, append_parent_error = buffers[1]
+            row = template.copy()
+            row.update(transaction)
+            action = transaction.get("action")
+            if action:
+                row.update(action)
+            result = transaction.get("result")
+            if result:
+                row.update(result)
+            append_row(getter(row))
+            append_hash("{}.{}".format(trace_key, position))
+            append_parent_error(parent_error)
+        if has_errors and not ordered:
+            internal_traces = [dict(transaction) for transaction in blocks_traces if transaction["transactionHash"]]
+            self._set_parent_errors(internal_traces)
+            parent_errors[0][:] = [transaction.get("parent_error") for transaction in internal_traces]
+        return tuple(
+            _make_trace_columns(schema, rows[table], hashes[table], parent_errors[table])
+            for table in range(2)
+        )
+
+    def _save_headers(self, headers):
+        """
+        Save block headers to blocks table
+
+        Parameters
+        ----------
+        headers : list
+            List of block headers
+        """
+        if headers:
+            self.client.bulk_index_columns(index=self.indices["block"], columns=utils.make_columns(headers))
+
+    def _save_traces_chunk(self, blocks, traces_columns, headers=[]):
+        """
+        Save transactions as internal or miner (without ethereum transaction hash) and block headers
+        Then saves a flag for processed blocks to a database
 
         Parameters
         ----------
         blocks : list
             List of blocks numbers
+        traces_columns : tuple
+            Columns of internal and miner transactions inside of these blocks
+        headers : list
+            List of headers of these blocks
         """
+        internal_columns, miner_columns = traces_columns
         if 0 in blocks:
             self._save_genesis_block()
-        blocks_traces = self._get_traces(blocks)
-        self._set_trace_hashes(blocks_traces)
-        self._set_parent_errors(blocks_traces)
-        self._save_internal_transactions(blocks_traces)
-        self._save_miner_transactions(blocks_traces)
+        self._save_internal_transactions(internal_columns)
+        self._save_miner_transactions(miner_columns)
+        self._save_headers(headers)
         self._save_traces(blocks)
 
-    def extract_traces(self):
+    def _extract_traces_chunk(self, blocks):
+        """
+        Extract transactions from specified block numbers list
+
+        Add trace hashes for each one, parent_error field
+        Saves transactions as internal or miner (without ethereum transaction hash) and block headers
+        Then saves a flag for processed blocks to a database
+
+        Parameters
+        ----------
+        blocks : list
+            List of blocks numbers
         """
-        Extract traces to elasticsearch for all unprocessed blocks
+        blocks_traces, headers = self._get_traces(blocks)
+        traces_columns = self._transform_traces(blocks_traces)
+        self._save_traces_chunk(blocks, traces_columns, headers)
+
+    def extract_traces(self, bounds=None):
+        """
+        Extract traces to a database for all unprocessed blocks
+
+        Fetching of next chunk from parity, transformation and insertion of previous chunks
+        run concurrently, with at most PIPELINE_QUEUE_SIZE chunks waiting between stages.
+        Size of each chunk is limited by TRACES_CHUNK_MAX_SIZE
 
         This function is an entry point for extract-traces operation
+
+        Parameters
+        ----------
+        bounds : list
+            List of (start, end) tuples to search unprocessed blocks in, None to search in all blocks
+        """
+        stages = [
+            lambda chunk: (chunk[0], self._transform_traces(chunk[1]), chunk[2])
+        ]
+        chunks = self._iterate_traces_chunks(bounds)
+        with closing(utils.run_pipeline(chunks, stages, PIPELINE_QUEUE_SIZE)) as results:
+            for blocks, traces_columns, headers in results:
+                self._save_traces_chunk(blocks, traces_columns, headers)
+
+    def _iterate_dump_chunks(self, path, size=TRACES_IMPORT_CHUNK_SIZE):
+        """
+        Iterate through chunks of traces and blocks from dump file
+
+        Traces are extended with gasUsed and gasPrice from blocks found in the same chunk.
+        Records starting from the first trace or block whose pair is not in the chunk are carried over
+        to the next chunk once, so a chunk boundary between trace_block and eth_getBlockByNumber lines
+        of a block doesn't separate them
+
+        Parameters
+        ----------
+        path : str
+            Path to dump file
+        size : int
+            Number of traces and blocks records in chunk
+
+        Returns
+        -------
+        generator
+            Generator that returns block numbers, traces and block headers of each chunk
+        """
+        carried_records = []
+        for records in utils.split_on_chunks(_iterate_dump(path), size):
+            records = carried_records + records
+            traces_blocks = {_get_dump_record_block(record) for record in records if record[1] is None}
+            headers_blocks = {_get_dump_record_block(record) for record in records if record[1] is not None}
+            unmatched_positions = [
+                position for position, record in enumerate(records)
+                if position >= len(carried_records) and _get_dump_record_block(record) is not None
+                and _get_dump_record_block(record) not in (headers_blocks if record[1] is None else traces_blocks)
+            ]
+            split_position = unmatched_positions[0] if unmatched_positions else len(records)
+            chunk_records, carried_records = records[:split_position], records[split_position:]
+            if chunk_records:
+                yield _merge_dump_records(chunk_records)
+        if carried_records:
+            yield _merge_dump_records(carried_records)
+
+    def _import_dump(self, path):
         """
-        for blocks in self._iterate_blocks():
-            blocks = [block["_source"]["number"] for block in blocks]
-            self._extract_traces_chunk(blocks)
+        Save traces and block headers from dump file to a database
+
+        Traces are processed the same way as traces extracted from parity
+
+        Parameters
+        ----------
+        path : str
+            Path to dump file
+
+        Returns
+        -------
+        list
+            Numbers of imported blocks
+        """
+        imported_blocks = []
+        for blocks, blocks_traces, headers in self._iterate_dump_chunks(path):
+            internal_columns, miner_columns = self._transform_traces(blocks_traces)
+            if 0 in blocks:
+                self._save_genesis_block()
+            self._save_internal_transactions(internal_columns)
+            self._save_miner_transactions(miner_columns)
+            self._save_headers(headers)
+            imported_blocks += blocks
+        return imported_blocks
+
+    def import_traces(self, paths):
+        """
+        Import traces from JSONL dump files to a database
+
+        Files are imported by TRACES_IMPORT_PROCESSES processes.
+        Blocks of each file are marked as processed after the whole file is imported,
+        so only this process writes block ranges
+
+        This function is an entry point for import-traces operation
+
+        Parameters
+        ----------
+        paths : list
+            Paths to dump files (plain, .gz or .zst) or directories with dump files
+        """
+        files = _list_dump_files(paths)
+        with Pool(processes=TRACES_IMPORT_PROCESSES) as pool:
+            for path, ranges in pool.imap_unordered(_import_dump_file, files):
+                self._save_ranges(ranges)
+                print("Imported {}".format(path))
 
 
 class ClickhouseInternalTransactions(InternalTransactions):
     def __init__(self, indices=INDICES, parity_hosts=PARITY_HOSTS):
         super().__init__(indices, CustomClickhouse(), parity_hosts)
         self.indices["miner_transaction"] = self.indices["internal_transaction"]
+        self.block_ranges = ClickhouseBlockRanges("traces_extracted", self.indices, self.client)
+        self.block_leases = ClickhouseBlockLeases(self.block_ranges) if BLOCK_LEASE_SIZE else None
+
+    def _get_max_parity_block(self):
+        """
+        Get last block available in parity hosts within their block ranges
+
+        Nodes that serve the same blocks can be synchronized to different blocks,
+        so only blocks available in all nodes of a group are taken.
+        Requests are sent through the router of current process, so failed requests count against node health.
+        Ejected and failed nodes are skipped, as the router doesn't send other requests to them
+
+        Returns
+        -------
+        int
+            Last block number
+
+        Raises
+        ------
+        Exception
+            Error of the last failed node if no node is available
+        """
+        request = [{"jsonrpc": "2.0", "id": "block_number", "method": "eth_blockNumber", "params": []}]
+        router = parity_router.get_router()
+        max_blocks = {}
+        error = ConnectionError("All parity hosts are ejected")
+        for bottom_line, upper_bound, url in self.parity_hosts:
+            if router.is_ejected(url):
+                continue
+            try:
+                max_block, size = router.call(
+                    [url],
+                    lambda parity_url: _send_jsonrpc_request_with_size(parity_url, request, lambda x: [x["result"]])
+                )
+            except Exception as e:
+                error = e
+                continue
+            max_block = int(max_block[0], 0)
+            max_blocks[url] = max_block if upper_bound is None else min(max_block, upper_bound - 1)
+        groups_max_blocks = [
+            min(max_blocks[url] for url in parity_urls if url in max_blocks)
+            for parity_urls in parity_router.get_groups(self.parity_hosts)
+            if any(url in max_blocks for url in parity_urls)
+        ]
+        if not groups_max_blocks:
+            raise error
+        return max(groups_max_blocks)
 
-    def _iterate_blocks(self):
+    def _iterate_blocks(self, bounds=None):
         """
-        Iterate through unprocessed blocks
+        Iterate through unprocessed blocks up to the last block in parity
+
+        Headers of these blocks are saved during extraction,
+        so blocks don't have to be extracted to blocks table before.
+        If BLOCK_LEASE_SIZE is set and bounds are not specified,
+        only blocks claimed by this instance are returned
+
+        Parameters
+        ----------
+        bounds : list
+            List of (start, end) tuples to search unprocessed blocks in, None to search in all blocks
 
         Returns
         -------
         generator
-            Generator that returns next chunk of unprocessed blocks
+            Generator that returns next chunk of unprocessed blocks numbers
         """
         ranges = [host_tuple[0:2] for host_tuple in self.parity_hosts]
-        flags_sql = "SELECT id, value FROM {} FINAL WHERE name = 'traces_extracted'".format(self.indices["block_flag"])
-        return self.client.iterate(
-            index=self.indices["block"],
-            fields=["number"],
-            query="ANY LEFT JOIN ({}) USING id WHERE value IS NULL AND {}".format(
-                flags_sql,
-                utils.make_range_query('number', *ranges)
-            ),
-        )
+        if bounds is not None:
+            return self.block_ranges.iterate_unprocessed_blocks(
+                self._get_max_parity_block(), intersect_bounds(ranges, bounds)
+            )
+        if self.block_leases:
+            return self.block_leases.iterate_unprocessed_blocks(self._get_max_parity_block(), ranges)
+        return self.block_ranges.iterate_unprocessed_blocks(self._get_max_parity_block(), ranges)
+
+    def extract_traces(self, bounds=None):
+        """
+        Extract traces to a database for all unprocessed blocks
+
+        If BLOCK_LEASE_SIZE is set and bounds are not specified, blocks are claimed in ranges
+        shared with other extractor instances, claimed ranges are released when extraction stops
+
+        This function is an entry point for extract-traces operation
+
+        Parameters
+        ----------
+        bounds : list
+            List of (start, end) tuples to search unprocessed blocks in, None to search in all blocks
+        """
+        if not self.block_leases or bounds is not None:
+            return super().extract_traces(bounds)
+        with self.block_leases:
+            super().extract_traces()
 
     def _save_traces(self, blocks):
         """
-        Save traces_extracted flag for specified block to a database
+        Mark specified blocks as processed
 
         Parameters
         ----------
         blocks :
             List of blocks numbers
         """
-        docs = [{"id": block, "name": "traces_extracted", "value": True} for block in blocks]
-        self.client.bulk_index(index=self.indices["block_flag"], docs=docs)
+        self.block_ranges.add_blocks(blocks)
+
+    def _save_ranges(self, ranges):
+        """
+        Mark specified block ranges as processed
+
+        Parameters
+        ----------
+        ranges : list
+            List of (start, end) tuples
+        """
+        self.block_ranges.add(ranges)
@@ -0,0 +1,231 @@
+from config import INDICES, PARITY_HOSTS, CONFIRMATION_DEPTH
+from clients.custom_clickhouse import CustomClickhouse
+from clients import parity_router
+from operations.block_ranges import ClickhouseBlockRanges
+from operations.blocks import _make_headers_request
+from operations.internal_transactions import _send_jsonrpc_request_routed
+
+ROLLBACK_STAGES = ["traces_extracted", "events_extracted"]
+
+ROLLBACK_FIELDS = {
+    "block": "number",
+    "internal_transaction": "blockNumber",
+    "event": "blockNumber",
+    "token_transaction": "blockNumber",
+    "contract": "blockNumber"
+}
+
+ROLLBACK_INPUTS = {
+    "internal_transaction": "transaction_input",
+    "event": "event_input"
+}
+
+
+class ClickhouseReorgs:
+    """
+    Detection of chain reorganizations and rollback of orphaned blocks
+
+    Hashes of last blocks saved with block headers are compared with hashes of the same blocks in parity.
+    Rows of blocks after the first changed block are deleted and these blocks are marked as unprocessed,
+    so they are extracted again from the new chain
+    """
+    def __init__(self, indices=INDICES, parity_hosts=PARITY_HOSTS, depth=CONFIRMATION_DEPTH):
+        self.client = CustomClickhouse()
+        self.indices = indices
+        self.parity_hosts = parity_hosts
+        self.depth = depth
+        self.block_ranges = [ClickhouseBlockRanges(name, self.indices, self.client) for name in ROLLBACK_STAGES]
+
+    def _get_stored_hashes(self, start, end):
+        """
+        Get hashes of blocks saved to blocks table
+
+        Parameters
+        ----------
+        start : int
+            First block
+        end : int
+            Last block, not included
+
+        Returns
+        -------
+        dict
+            Block numbers and hashes. Blocks without hashes are skipped
+        """
+        blocks = self.client.search(
+            index=self.indices["block"],
+            fields=["number", "hash"],
+            query="WHERE number >= {} AND number < {} AND hash IS NOT NULL".format(start, end)
+        )
+        return {block["_source"]["number"]: block["_source"]["hash"] for block in blocks}
+
+    def _get_parity_hashes(self, blocks):
+        """
+        Get hashes of blocks in parity within one JSON RPC batch
+
+        Parameters
+        ----------
+        blocks : list
+            Sorted block numbers
+
+        Returns
+        -------
+        dict
+            Block numbers and hashes. Blocks that are not in parity are skipped
+        """
+        headers, size = _send_jsonrpc_request_routed(
+            parity_router.get_urls(self.parity_hosts, blocks[-1]),
+            _make_headers_request(blocks),
+            lambda x: [x.get("result")]
+        )
+        return {int(header["number"], 0): header["hash"] for header in headers if header}
+
+    def find_fork_block(self, head):
+        """
+        Find the first block replaced by a chain reorganization
+
+        Last depth blocks up to head are checked. If all of them are replaced,
+        previous depth blocks are checked until a block that is still in the chain
+
+        Parameters
+        ----------
+        head : int
+            Last extracted block
+
+        Returns
+        -------
+        int
+            Block number, None if saved blocks are still in the chain
+        """
+        fork_block = None
+        end = head + 1
+        while end > 0:
+            start = max(end - self.depth, 0)
+            stored_hashes = self._get_stored_hashes(start, end)
+            if not stored_hashes:
+                break
+            parity_hashes = self._get_parity_hashes(sorted(stored_hashes.keys()))
+            forked_blocks = [block for block, hash in stored_hashes.items() if parity_hashes.get(block) != hash]
+            if not forked_blocks:
+                break
+            fork_block = min(forked_blocks)
+            if fork_block > start:
+                break
+            end = start
+        return fork_block
+
+    def _table_exists(self, index):
+        return index in self.indices and self.client.send_sql_request("EXISTS TABLE {}".format(self.indices[index]))
+
+    def _get_storage(self, index):
+        """
+        Get table which stores rows of specified index
+
+        Rows of materialized views are stored in their inner tables
+
+        Parameters
+        ----------
+        index : str
+            Name of index
+
+        Returns
+        -------
+        tuple
+            Name and partition key of table, empty partition key if table is not partitioned
+        """
+        return self.client.send_sql_request("""
+            SELECT (name, partition_key) FROM system.tables
+            WHERE database = currentDatabase() AND engine != 'MaterializedView' AND (
+                name = '{0}' OR name = '.inner.{0}' OR name IN (
+                    SELECT concat('.inner_id.', toString(uuid)) FROM system.tables
+                    WHERE database = currentDatabase() AND name = '{0}'
+                )
+            )
+        """.format(index))
+
+    def _delete_rows(self, index, field, block):
+        """
+        Delete rows of specified block and all following blocks
+
+        Partitions after the partition of the block are dropped,
+        rows are deleted by ALTER TABLE ... DELETE mutation only within the partition of the block.
+        Tables without partitions are mutated entirely
+
+        Parameters
+        ----------
+        index : str
+            Name of index
+        field : str
+            Field with block number
+        block : int
+            First block to delete
+        """
+        storage = self._get_storage(index)
+        if not storage or not storage[1]:
+            self.client.send_sql_request("ALTER TABLE {} DELETE WHERE {} >= {}".format(index, field, block))
+            return
+        name, partition_key = storage
+        block_partition = self.client.send_sql_request("WITH {} AS {} SELECT {}".format(block, field, partition_key))
+        partitions = self.client.send_sql_request(
+            "SELECT groupUniqArray(partition) FROM system.parts "
+            "WHERE database = currentDatabase() AND table = '{}' AND active".format(name)
+        )
+        for partition in sorted(partitions, key=int):
+            if int(partition) > block_partition:
+                self.client.send_sql_request("ALTER TABLE {} DROP PARTITION {}".format(index, partition))
+        if str(block_partition) in partitions:
+            self.client.send_sql_request("ALTER TABLE {} DELETE IN PARTITION {} WHERE {} >= {}".format(
+                index, block_partition, field, block
+            ))
+
+    def _delete_inputs(self, index, field, block):
+        """
+        Delete decoded inputs of rows of specified block and all following blocks
+
+        Inputs are deleted by one mutation which selects ids of deleted rows by a subquery.
+        The mutation is awaited, so the subquery runs before the rows are deleted
+
+        Parameters
+        ----------
+        index : str
+            Name of index with transactions or events
+        field : str
+            Field with block number
+        block : int
+            First block to delete
+        """
+        self.client.send_sql_request(
+            "ALTER TABLE {} DELETE WHERE id IN (SELECT id FROM {} WHERE {} >= {})".format(
+                self.indices[ROLLBACK_INPUTS[index]], self.indices[index], field, block
+            ),
+            settings={"mutations_sync": 1}
+        )
+
+    def rollback(self, block):
+        """
+        Delete data of specified block and all following blocks and mark them as unprocessed
+
+        Decoded inputs of deleted transactions and events are deleted before them.
+        Blocks of contracts with parsed inputs are moved before the specified block,
+        so inputs are parsed again from the new chain.
+        Mutations and dropped partitions don't affect rows inserted after the rollback
+
+        Parameters
+        ----------
+        block : int
+            First block to roll back
+        """
+        for index, field in ROLLBACK_FIELDS.items():
+            if not self._table_exists(index):
+                continue
+            if index in ROLLBACK_INPUTS and self._table_exists(ROLLBACK_INPUTS[index]):
+                self._delete_inputs(index, field, block)
+            self._delete_rows(self.indices[index], field, block)
+        if self._table_exists("contract_block"):
+            self.client.send_sql_request("ALTER TABLE {} UPDATE value = {} WHERE value >= {}".format(
+                self.indices["contract_block"], block - 1, block
+            ))
+        for block_ranges in self.block_ranges:
+            max_block = block_ranges.get_max_block()
+            if max_block is not None and max_block >= block:
+                block_ranges.remove([(block, max_block + 1)])
@@ -1,5 +1,6 @@
 from config import INDICES
 from clients.custom_clickhouse import CustomClickhouse
+from operations.indices import make_partition_key
 import utils
 
 TRANSFER_EVENT = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
@@ -19,7 +20,7 @@ class ClickhouseTokenHolders():
         value_sql = utils.generate_sql_for_value("data")
         sql = """
       CREATE MATERIALIZED VIEW IF NOT EXISTS {index} 
-      ENGINE = ReplacingMergeTree() ORDER BY id
+      ENGINE = ReplacingMergeTree() PARTITION BY {partition_key} ORDER BY id
       POPULATE
       AS 
       (
@@ -43,6 +44,7 @@ class ClickhouseTokenHolders():
       )
     """.format(
             index=self.indices["token_transaction"],
+            partition_key=make_partition_key("blockNumber"),
             value_sql=value_sql,
             transfer_topic=TRANSFER_EVENT,
             event=self.indices["event"],
@@ -7,7 +7,7 @@ from pyelasticsearch import bulk_chunks
 from tqdm import *
 import numpy as np
 import pandas as pd
-from web3 import Web3, HTTPProvider
+from clients import parity_transport
 from utils import ClickhouseContractTransactionsIterator
 
 MOVING_AVERAGE_WINDOW = 5
@@ -21,7 +21,7 @@ class ClickhouseTokenPrices(ClickhouseContractTransactionsIterator):
     def __init__(self, indices=INDICES, parity_host=PARITY_HOSTS[0][-1]):
         self.indices = indices
         self.client = CustomClickhouse()
-        self.web3 = Web3(HTTPProvider(parity_host))
+        self.web3 = parity_transport.create_web3(parity_host)
 
     def _iterate_cc_tokens(self):
         """
@@ -1,7 +1,14 @@
 SCHEMA = {
     "block": {
         "number": "Int64",
-        "timestamp": "DateTime"
+        "timestamp": "DateTime",
+        "hash": "Nullable(String)",
+        "miner": "Nullable(String)",
+        "gasUsed": "Nullable(Int64)",
+        "gasLimit": "Nullable(Int64)",
+        "difficulty": "Nullable(UInt64)",
+        "baseFeePerGas": "Nullable(Int64)",
+        "transactionsCount": "Nullable(Int32)"
     },
     "internal_transaction": {
         "blockNumber": "Int64",
@@ -35,6 +42,19 @@ SCHEMA = {
         "name": "String",
         "value": "Nullable(UInt8)"
     },
+    "block_range": {
+        "name": "String",
+        "start_block": "Int64",
+        "end_block": "Int64"
+    },
+    "block_lease": {
+        "name": "String",
+        "start_block": "Int64",
+        "owner": "String",
+        "claimed_at": "UInt32",
+        "expires_at": "UInt32",
+        "released": "UInt8"
+    },
     "contract_abi": {
         "abi_extracted": "Nullable(UInt8)",
         "abi": "Nullable(String)"
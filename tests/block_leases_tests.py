@@ -0,0 +1,114 @@
+import unittest
+from operations.block_leases import ClickhouseBlockLeases
+from operations.block_ranges import subtract_ranges
+from unittest.mock import MagicMock
+
+TEST_INDICES = {
+    "block_range": "test_ethereum_block_range",
+    "block_lease": "test_ethereum_block_lease"
+}
+
+
+class ClickhouseBlockLeasesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.search.return_value = []
+        self.block_ranges = MagicMock()
+        self.block_ranges.name = "test"
+        self.block_ranges.indices = TEST_INDICES
+        self.block_ranges.client = self.client
+        self.processed_ranges = []
+        self.block_ranges.get_unprocessed_ranges.side_effect = self._get_unprocessed_ranges
+        self.block_leases = ClickhouseBlockLeases(self.block_ranges, size=10, lease_time=60, owner="owner")
+        self.block_leases.settle_time = 0
+
+    def _get_unprocessed_ranges(self, max_block, bounds=[(None, None)]):
+        bounds = [(start or 0, max_block + 1 if end is None else min(end, max_block + 1)) for start, end in bounds]
+        return subtract_ranges(bounds, self.processed_ranges)
+
+    def _make_lease(self, lease_id, start, owner="owner", claimed_at=1):
+        return {"_id": lease_id, "_source": {"start_block": start, "owner": owner, "claimed_at": claimed_at}}
+
+    def _get_written_leases(self):
+        return [
+            call_args[0][0].split("SELECT")[1].split(",")[0].strip().strip("'")
+            for call_args in self.client.send_sql_request.call_args_list
+        ]
+
+    def test_iterate_unit_starts(self):
+        test_ranges = [(5, 12), (15, 18), (25, 41)]
+        assert list(self.block_leases._iterate_unit_starts(test_ranges)) == [0, 10, 20, 30, 40]
+
+    def test_get_unit_bounds(self):
+        test_bounds = [(None, 15), (18, None)]
+        assert self.block_leases._get_unit_bounds(10, test_bounds) == [(10, 15), (18, 20)]
+        assert self.block_leases._get_unit_bounds(0, [(15, None)]) == []
+
+    def test_claim(self):
+        self.client.search.side_effect = [[], [self._make_lease("test.0.owner.1", 0, claimed_at=5)]]
+        assert self.block_leases.claim(100) == 0
+        assert self.block_leases.leases == {"test.0.owner.1": (0, 5)}
+        sql = self.client.send_sql_request.call_args[0][0]
+        assert "INSERT INTO test_ethereum_block_lease" in sql
+        assert "'test.0.owner.1', 'test', 0, 'owner', toUInt32(now()), toUInt32(now()) + 60, 0" in sql
+
+    def test_claim_skip_claimed_units(self):
+        self.processed_ranges = [(0, 5)]
+        self.client.search.side_effect = [
+            [self._make_lease("test.0.other.1", 0, "other")],
+            [self._make_lease("test.10.owner.1", 10)]
+        ]
+        assert self.block_leases.claim(100) == 10
+
+    def test_claim_lost_race(self):
+        self.client.search.side_effect = [
+            [],
+            [self._make_lease("test.0.other.1", 0, "other", 1), self._make_lease("test.0.owner.1", 0, "owner", 1)],
+            [self._make_lease("test.10.owner.2", 10)]
+        ]
+        assert self.block_leases.claim(100) == 10
+        assert self._get_written_leases() == ["test.0.owner.1", "test.0.owner.1", "test.10.owner.2"]
+        assert self.client.send_sql_request.call_args_list[1][0][0].strip().endswith(", 1")
+        assert list(self.block_leases.leases.keys()) == ["test.10.owner.2"]
+
+    def test_claim_nothing(self):
+        self.processed_ranges = [(0, 101)]
+        assert self.block_leases.claim(100) is None
+        self.client.send_sql_request.assert_not_called()
+
+    def test_renew(self):
+        self.block_leases.leases = {"lease1": (0, 5), "lease2": (10, 6)}
+        self.client.search.return_value = [self._make_lease("lease1", 0)]
+        self.block_leases.renew()
+        assert self.block_leases.leases == {"lease1": (0, 5)}
+        assert self._get_written_leases() == ["lease1"]
+        assert "'lease1', 'test', 0, 'owner', 5, toUInt32(now()) + 60, 0" in \
+               self.client.send_sql_request.call_args[0][0]
+
+    def test_release_processed(self):
+        self.block_leases.leases = {"lease1": (0, 5), "lease2": (10, 6)}
+        self.processed_ranges = [(0, 10), (10, 15)]
+        self.block_leases.release_processed(100)
+        assert self.block_leases.leases == {"lease2": (10, 6)}
+        assert self.client.send_sql_request.call_args[0][0].strip().endswith(", 1")
+
+    def test_release_processed_within_bounds(self):
+        self.block_leases.leases = {"lease1": (10, 5)}
+        self.processed_ranges = [(10, 15)]
+        self.block_leases.release_processed(100, [(None, 15)])
+        assert self.block_leases.leases == {}
+
+    def test_iterate_unprocessed_blocks(self):
+        claimed_units = [0, 20, None]
+        self.block_leases.claim = MagicMock(side_effect=claimed_units)
+        self.processed_ranges = [(3, 5)]
+        blocks = list(self.block_leases.iterate_unprocessed_blocks(100, per=5))
+        assert blocks == [[0, 1, 2, 5, 6], [7, 8, 9, 20, 21], [22, 23, 24, 25, 26], [27, 28, 29]]
+
+    def test_context_manager(self):
+        self.block_leases.leases = {"lease1": (0, 5)}
+        with self.block_leases:
+            assert self.block_leases._heartbeat.is_alive()
+        assert not self.block_leases._heartbeat.is_alive()
+        assert self.block_leases.leases == {}
+        self.client.send_sql_request.assert_called_once()
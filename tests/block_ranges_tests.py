@@ -0,0 +1,148 @@
+import unittest
+from operations.block_ranges import ClickhouseBlockRanges, merge_ranges, subtract_ranges, blocks_to_ranges, \
+    intersect_bounds
+from unittest.mock import MagicMock, ANY
+import random
+
+TEST_INDICES = {
+    "block": "test_ethereum_block",
+    "block_flag": "test_ethereum_block_flag",
+    "block_range": "test_ethereum_block_range"
+}
+
+
+class BlockRangesFunctionsTestCase(unittest.TestCase):
+    def test_merge_ranges(self):
+        test_ranges = [(5, 7), (0, 2), (2, 3), (1, 2), (8, 9), (4, 4)]
+        assert merge_ranges(test_ranges) == [(0, 3), (5, 7), (8, 9)]
+
+    def test_subtract_ranges(self):
+        test_ranges = [(0, 10), (20, 30)]
+        test_removed_ranges = [(2, 3), (5, 22), (29, 40)]
+        assert subtract_ranges(test_ranges, test_removed_ranges) == [(0, 2), (3, 5), (22, 29)]
+
+    def test_subtract_ranges_randomly(self):
+        random_generator = random.Random(0)
+        for _ in range(100):
+            ranges = [(start, start + random_generator.randint(0, 5)) for start in random_generator.sample(range(50), 5)]
+            removed_ranges = [(start, start + random_generator.randint(0, 5)) for start in
+                              random_generator.sample(range(50), 5)]
+            blocks = set(block for start, end in ranges for block in range(start, end))
+            removed_blocks = set(block for start, end in removed_ranges for block in range(start, end))
+            assert subtract_ranges(ranges, removed_ranges) == blocks_to_ranges(blocks - removed_blocks)
+
+    def test_intersect_bounds(self):
+        test_bounds = [(None, 10), (20, None)]
+        assert intersect_bounds(test_bounds, [(5, 25)]) == [(5, 10), (20, 25)]
+        assert intersect_bounds(test_bounds, [(15, None)]) == [(20, None)]
+        assert intersect_bounds([(None, None)], [(None, 5)]) == [(0, 5)]
+
+    def test_blocks_to_ranges(self):
+        assert blocks_to_ranges([5, 1, 2, 3, 7, 6]) == [(1, 4), (5, 8)]
+
+
+class ClickhouseBlockRangesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.block_ranges = ClickhouseBlockRanges("test", TEST_INDICES, self.client)
+
+    def _set_stored_ranges(self, ranges):
+        self.client.search.return_value = [
+            {"_id": "test.{}.{}".format(start, end), "_source": {"start_block": start, "end_block": end}}
+            for start, end in ranges
+        ]
+
+    def _get_saved_ranges(self):
+        docs = self.client.bulk_index.call_args[1]["docs"]
+        return {doc["id"]: (doc["start_block"], doc["end_block"]) for doc in docs}
+
+    def test_get_ranges(self):
+        self._set_stored_ranges([(5, 10), (0, 5), (20, 30)])
+        assert self.block_ranges.get_ranges() == [(0, 10), (20, 30)]
+        self.client.search.assert_called_with(index=TEST_INDICES["block_range"], fields=ANY, query=ANY)
+
+    def test_add(self):
+        self._set_stored_ranges([(0, 5), (10, 15), (20, 25)])
+        self.block_ranges.add([(3, 12), (30, 31)])
+        assert self._get_saved_ranges() == {
+            "test.5.10": (5, 10),
+            "test.30.31": (30, 31)
+        }
+
+    def test_add_interleaved(self):
+        stored_ranges = {"test.0.10": (0, 10), "test.10.20": (10, 20)}
+
+        def search(index, fields, query):
+            return [
+                {"_id": range_id, "_source": {"start_block": start, "end_block": end}}
+                for range_id, (start, end) in stored_ranges.items()
+                if end > start
+            ]
+
+        def bulk_index(index, docs):
+            stored_ranges.update({doc["id"]: (doc["start_block"], doc["end_block"]) for doc in docs})
+
+        self.client.search.side_effect = search
+        self.client.bulk_index.side_effect = bulk_index
+        other_client = MagicMock()
+        other_client.search.return_value = search(None, None, None)
+        other_client.bulk_index.side_effect = bulk_index
+        other_block_ranges = ClickhouseBlockRanges("test", TEST_INDICES, other_client)
+
+        self.block_ranges.add([(20, 30)])
+        other_block_ranges.add([(40, 50)])
+
+        assert self.block_ranges.get_ranges() == [(0, 30), (40, 50)]
+
+    def test_add_processed_ranges(self):
+        self._set_stored_ranges([(0, 5)])
+        self.block_ranges.add([(1, 3)])
+        self.client.bulk_index.assert_not_called()
+
+    def test_add_blocks(self):
+        self._set_stored_ranges([])
+        self.block_ranges.add_blocks([3, 1, 2, 5])
+        assert self._get_saved_ranges() == {"test.1.4": (1, 4), "test.5.6": (5, 6)}
+
+    def test_remove(self):
+        self._set_stored_ranges([(0, 10), (20, 25)])
+        self.block_ranges.remove([(0, 2), (5, 6), (20, 25)])
+        assert self._get_saved_ranges() == {
+            "test.0.10": (0, 0),
+            "test.2.5": (2, 5),
+            "test.6.10": (6, 10),
+            "test.20.25": (0, 0)
+        }
+
+    def test_remove_keep_untouched_ranges(self):
+        self._set_stored_ranges([(0, 10), (20, 25)])
+        self.block_ranges.remove([(12, 15)])
+        self.client.bulk_index.assert_not_called()
+
+    def test_get_max_block(self):
+        self._set_stored_ranges([])
+        assert self.block_ranges.get_max_block() is None
+        self._set_stored_ranges([(0, 10), (20, 25)])
+        assert self.block_ranges.get_max_block() == 24
+
+    def test_get_unprocessed_ranges(self):
+        self._set_stored_ranges([(0, 10), (20, 25)])
+        test_bounds = [(None, 22), (30, None)]
+        ranges = self.block_ranges.get_unprocessed_ranges(40, test_bounds)
+        assert ranges == [(10, 20), (30, 41)]
+
+    def test_iterate_unprocessed_blocks(self):
+        self._set_stored_ranges([(2, 4)])
+        chunks = list(self.block_ranges.iterate_unprocessed_blocks(6, per=3))
+        assert chunks == [[0, 1, 4], [5, 6]]
+
+    def test_migrate_flags(self):
+        self._set_stored_ranges([])
+        self.client.iterate.return_value = [
+            [{"_source": {"number": block}} for block in [5, 1, 2]],
+            [{"_source": {"number": block}} for block in [3, 7]]
+        ]
+        self.block_ranges.migrate_flags()
+        self.client.iterate.assert_called_with(index=TEST_INDICES["block_flag"], fields=ANY, query=ANY,
+                                               return_id=False)
+        assert self._get_saved_ranges() == {"test.1.4": (1, 4), "test.5.6": (5, 6), "test.7.8": (7, 8)}
@@ -4,7 +4,7 @@ from operations.indices import ClickhouseIndices
 from tests.test_utils import mockify, TestClickhouse, parity
 import httpretty
 import json
-from unittest.mock import MagicMock, Mock, call
+from unittest.mock import MagicMock, Mock, call, patch, ANY
 from datetime import datetime, timedelta
 from web3 import Web3, HTTPProvider
 from pprint import pprint
@@ -84,14 +84,22 @@ class ClickhouseBlocksTestCase(unittest.TestCase):
 
     def test_create_blocks_by_range(self):
         """Test create blocks in ElasticSearch by range"""
-        mockify(self.blocks, {}, "_create_blocks")
-        self.blocks._create_blocks(1, 5, max_blocks=3)
+        mockify(self.blocks, {}, ["_create_blocks", "_save_blocks"])
+        self.blocks._create_blocks(1, 3)
         blocks = self.client.search(index=TEST_BLOCKS_INDEX, doc_type="b", fields=["number"])
         blocks = [block["_source"]["number"] for block in blocks]
         self.assertCountEqual(blocks, [1, 2, 3])
 
+    def test_create_blocks_by_chunks(self):
+        test_blocks_per_chunk = 2
+        mockify(self.blocks, {}, ["_create_blocks"])
+        with patch("operations.blocks.BLOCKS_PER_CHUNK", test_blocks_per_chunk):
+            self.blocks._create_blocks(1, 5)
+        self.blocks._extract_blocks_timestamps.assert_has_calls([call([1, 2]), call([3, 4]), call([5])])
+        self.blocks._save_blocks.assert_has_calls([call([1, 2], ANY), call([3, 4], ANY), call([5], ANY)])
+
     def test_create_unique_blocks(self):
-        mockify(self.blocks, {}, "_create_blocks")
+        mockify(self.blocks, {}, ["_create_blocks", "_save_blocks"])
         self.blocks._create_blocks(1, 1)
         self.blocks._create_blocks(1, 1)
         blocks_number = self.client.count(index=TEST_BLOCKS_INDEX, doc_type="b")
@@ -105,38 +113,65 @@ class ClickhouseBlocksTestCase(unittest.TestCase):
             datetime.today() + timedelta(days=2)
         ]
         mockify(self.blocks, {
-            "_extract_block_timestamp": MagicMock(side_effect=test_datetimes)
-        }, "_create_blocks")
+            "_extract_blocks_timestamps": MagicMock(return_value=test_datetimes)
+        }, ["_create_blocks", "_save_blocks"])
 
         self.blocks._create_blocks(1, 3)
 
         blocks = self.client.search(index=TEST_BLOCKS_INDEX, fields=["timestamp"])
-        for block in [1, 2, 3]:
-            self.blocks._extract_block_timestamp.assert_any_call(block)
+        self.blocks._extract_blocks_timestamps.assert_called_with([1, 2, 3])
         blocks = [block["_source"]["timestamp"].date() for block in blocks]
         self.assertCountEqual(blocks, [d.date() for d in test_datetimes])
 
+    def test_create_blocks_stop_before_missing_block(self):
+        test_datetime = datetime.today()
+        mockify(self.blocks, {
+            "_extract_blocks_timestamps": MagicMock(return_value=[test_datetime, None, test_datetime])
+        }, ["_create_blocks"])
+
+        self.blocks._create_blocks(1, 3)
+
+        self.blocks._save_blocks.assert_called_once_with([1], [test_datetime])
+
+    @httpretty.activate
+    def test_extract_blocks_timestamps(self):
+        test_timestamp = 1438269988
+        httpretty.register_uri(
+            httpretty.POST,
+            TEST_PARITY_URL,
+            body=json.dumps([
+                {"id": "header_1", "jsonrpc": "2.0", "result": {"number": "0x1", "timestamp": hex(test_timestamp)}},
+                {"id": "header_2", "jsonrpc": "2.0", "result": None},
+                {"id": "header_0", "jsonrpc": "2.0", "result": {"number": "0x0", "timestamp": "0x0"}}
+            ])
+        )
+        timestamps = self.blocks._extract_blocks_timestamps([0, 1, 2])
+        request = json.loads(httpretty.last_request().body.decode())
+        assert request[0]["method"] == "eth_getBlockByNumber"
+        assert request[0]["params"] == ["0x0", False]
+        assert timestamps == [ETHEREUM_START_DATE, datetime.fromtimestamp(test_timestamp), None]
+
+    def test_extract_blocks_timestamps_by_batches(self):
+        test_batch_size = 2
+        self.blocks._get_headers = MagicMock(side_effect=lambda blocks: [
+            {"number": hex(block), "timestamp": hex(block)} for block in blocks
+        ])
+        with patch("operations.blocks.PARITY_HEADERS_PER_BATCH", test_batch_size):
+            timestamps = self.blocks._extract_blocks_timestamps([1, 2, 3])
+        self.blocks._get_headers.assert_has_calls([call([1, 2]), call([3])], any_order=True)
+        assert timestamps == [datetime.fromtimestamp(block) for block in [1, 2, 3]]
+
     @parity
-    def test_extract_block_timestamp(self):
+    def test_extract_blocks_timestamps_from_parity(self):
         # https://etherscan.io/block/10
-        block_time = self.blocks._extract_block_timestamp(10)
+        block_time = self.blocks._extract_blocks_timestamps([10])[0]
         print(block_time)
         assert block_time < datetime(2015, 7, 31)
         assert block_time > datetime(2015, 7, 30)
 
-    def test_extract_start_block_timestamp(self):
-        block_time = self.blocks._extract_block_timestamp(0)
-        print(block_time)
-        assert block_time == ETHEREUM_START_DATE
-        self.client.bulk_index(index=TEST_BLOCKS_INDEX, docs=[{
-            "id": "test",
-            "number": 0,
-            "timestamp": block_time
-        }])
-
     @parity
-    def test_extract_block_timestamp_no_such_block(self):
-        block_time = self.blocks._extract_block_timestamp(9999999)
+    def test_extract_blocks_timestamps_no_such_block(self):
+        block_time = self.blocks._extract_blocks_timestamps([99999999])[0]
         assert not block_time
 
     def test_create_no_blocks(self):
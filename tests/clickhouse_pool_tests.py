@@ -0,0 +1,118 @@
+import unittest
+from clients import clickhouse_pool
+from clients.clickhouse_pool import ConnectionPool, PooledClient, PoolTimeoutError, get_pool, close_pool
+from clickhouse_driver.errors import ServerException
+from unittest.mock import MagicMock, patch
+from threading import Thread
+import time
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.create = MagicMock(side_effect=lambda: MagicMock())
+        self.pool = ConnectionPool(create=self.create, max_size=2, timeout=0.1, ping_interval=10)
+
+    def test_acquire_reuse_connection(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        assert self.pool.acquire() is connection
+        self.create.assert_called_once_with()
+
+    def test_acquire_max_size(self):
+        self.pool.acquire()
+        self.pool.acquire()
+        with self.assertRaises(PoolTimeoutError):
+            self.pool.acquire()
+
+    def test_acquire_wait_for_release(self):
+        self.pool.timeout = 5
+        connection = self.pool.acquire()
+        self.pool.acquire()
+        Thread(target=lambda: time.sleep(0.1) or self.pool.release(connection)).start()
+        assert self.pool.acquire() is connection
+
+    def test_release_not_reusable(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection, reusable=False)
+        connection.disconnect.assert_called_with()
+        assert self.pool.acquire() is not connection
+
+    def test_acquire_check_health(self):
+        self.pool.ping_interval = 0
+        connection = self.pool.acquire()
+        connection.connection.ping.return_value = False
+        self.pool.release(connection)
+        assert self.pool.acquire() is not connection
+        connection.disconnect.assert_called_with()
+
+    def test_acquire_skip_check_for_recent_connections(self):
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.pool.acquire()
+        connection.connection.ping.assert_not_called()
+
+    def test_acquire_failed_creation(self):
+        self.create.side_effect = Exception()
+        for _ in range(3):
+            with self.assertRaises(Exception):
+                self.pool.acquire()
+        assert self.pool._size == 0
+
+    def test_close(self):
+        connection = self.pool.acquire()
+        used_connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.pool.close()
+        connection.disconnect.assert_called_with()
+        self.pool.release(used_connection)
+        used_connection.disconnect.assert_called_with()
+        with self.assertRaises(RuntimeError):
+            self.pool.acquire()
+
+    def test_get_pool(self):
+        pool = get_pool()
+        assert get_pool() is pool
+        with patch("os.getpid", return_value=-1):
+            assert get_pool() is not pool
+            pool = get_pool()
+            close_pool()
+            assert pool._closed
+        assert -1 not in clickhouse_pool._pools
+
+
+class PooledClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = MagicMock()
+        self.connection = self.pool.acquire.return_value
+        self.client = PooledClient(self.pool)
+
+    def test_execute(self):
+        self.connection.execute.return_value = [(1,)]
+        assert self.client.execute("SELECT 1") == [(1,)]
+        self.connection.execute.assert_called_with("SELECT 1")
+        self.pool.release.assert_called_with(self.connection, True)
+
+    def test_execute_server_exception(self):
+        self.connection.execute.side_effect = ServerException("")
+        with self.assertRaises(ServerException):
+            self.client.execute("SELECT 1")
+        self.pool.release.assert_called_with(self.connection, True)
+
+    def test_execute_connection_error(self):
+        self.connection.execute.side_effect = EOFError()
+        with self.assertRaises(EOFError):
+            self.client.execute("SELECT 1")
+        self.pool.release.assert_called_with(self.connection, False)
+
+    def test_execute_iter(self):
+        self.connection.execute_iter.return_value = iter([(1,), (2,)])
+        assert list(self.client.execute_iter("SELECT 1")) == [(1,), (2,)]
+        self.pool.release.assert_called_with(self.connection, True)
+
+    def test_execute_iter_interrupted(self):
+        self.connection.execute_iter.return_value = iter([(1,), (2,)])
+        generator = self.client.execute_iter("SELECT 1")
+        next(generator)
+        self.pool.release.assert_not_called()
+        generator.close()
+        self.pool.release.assert_called_with(self.connection, False)
@@ -1,8 +1,7 @@
 import unittest
 from clickhouse_driver import Client
-from clients.custom_clickhouse import CustomClickhouse
+from clients.custom_clickhouse import CustomClickhouse, _create_size_estimator
 import json
-import sys
 from unittest.mock import MagicMock, ANY, call
 
 
@@ -75,6 +74,40 @@ class ClickhouseTestCase(unittest.TestCase):
         result_record = next(result)[0]
         assert "y" in result_record["_source"]
 
+    def test_iterate_without_count(self):
+        self._add_records()
+        self.new_client.count = MagicMock()
+        self.new_client.estimate_count = MagicMock()
+        result = self.new_client.iterate(index="test", fields=["x"], count=None)
+        next(result)
+        self.new_client.count.assert_not_called()
+        self.new_client.estimate_count.assert_not_called()
+
+    def test_iterate_estimate_count(self):
+        self._add_records()
+        self.new_client.estimate_count = MagicMock(return_value=10)
+        result = self.new_client.iterate(index="test", fields=["x"], query="WHERE x < 4", count="estimate")
+        next(result)
+        self.new_client.estimate_count.assert_called_with("test", "WHERE x < 4", True)
+
+    def test_iterate_parallel_count(self):
+        formatted_documents = self._add_records()
+        self.new_client._count_in_background = MagicMock()
+        result = self.new_client.iterate(index="test", fields=["x"], count="parallel")
+        self.assertCountEqual(formatted_documents, next(result))
+        self.new_client._count_in_background.assert_called_once()
+
+    def test_count_in_background(self):
+        formatted_documents = self._add_records()
+        progress_bar = MagicMock()
+        self.new_client._count_in_background("test", None, True, progress_bar).join()
+        assert progress_bar.total == len(formatted_documents)
+
+    def test_estimate_count(self):
+        formatted_documents = self._add_records()
+        result = self.new_client.estimate_count(index="test")
+        assert result >= len(formatted_documents)
+
     def test_bulk_index(self):
         documents = [{"x": i} for i in range(10)]
         self.new_client.bulk_index(index="test", docs=[d.copy() for d in documents], id_field="x")
@@ -105,10 +138,87 @@ class ClickhouseTestCase(unittest.TestCase):
         self.new_client._filter_schema = MagicMock()
         self.new_client.bulk_index(index="test_index", docs=test_docs)
 
-        self.new_client._split_records.assert_called_with(test_docs)
+        self.new_client._split_records.assert_called_with(test_docs, ANY)
         calls = [call(ANY, records) for records in test_chunks]
         self.new_client.client.execute.assert_has_calls(calls)
 
+    def test_bulk_index_columns(self):
+        test_columns = {"x": list(range(10)), "dict": [str(i) for i in range(10)]}
+        self.new_client.bulk_index_columns(index="test", columns=test_columns, id_field="dict")
+        result = self.client.execute('SELECT id, x FROM test')
+        self.assertCountEqual(result, [(str(i), i) for i in range(10)])
+
+    def test_bulk_index_columns_check_schema(self):
+        self.new_client.bulk_index_columns(index="test", columns={"y": [1], "id": [1]})
+        result = self.client.execute('SELECT id FROM test')
+        self.assertCountEqual(result, [('1', )])
+
+    def test_bulk_index_columns_empty(self):
+        self.new_client.client.execute = MagicMock()
+        self.new_client._get_table_fields = MagicMock(return_value=["id"])
+        self.new_client.bulk_index_columns(index="test", columns={"id": []})
+        self.new_client.client.execute.assert_not_called()
+
+    def test_split_columns(self):
+        test_columns = [list(range(1, 6)), ["a"] * 5]
+        test_row_size = 8 + 2
+        chunks = list(self.new_client._split_columns(test_columns, max_bytes=test_row_size * 2))
+        self.assertSequenceEqual(chunks, [
+            [[1, 2], ["a", "a"]],
+            [[3, 4], ["a", "a"]],
+            [[5], ["a"]]
+        ])
+        assert self.new_client.chunk_sizes == [(2, 20), (2, 20), (1, 10)]
+
+    def test_split_columns_with_sizes(self):
+        test_columns = [list(range(4))]
+        chunks = list(self.new_client._split_columns(test_columns, [lambda value: 1], max_bytes=2))
+        self.assertSequenceEqual(chunks, [[[0, 1]], [[2, 3]]])
+
+    def test_split_columns_max_rows(self):
+        test_columns = [list(range(5))]
+        chunks = list(self.new_client._split_columns(test_columns, max_rows=2))
+        self.assertSequenceEqual(chunks, [[[0, 1]], [[2, 3]], [[4]]])
+
+    def test_create_size_estimator(self):
+        assert _create_size_estimator("UInt8")(1) == 1
+        assert _create_size_estimator("Int64")("0x1") == 8
+        assert _create_size_estimator("Nullable(Float32)")(None) == 5
+        assert _create_size_estimator("String")("a" * 200) == 202
+        assert _create_size_estimator("FixedString(3)")("abc") == 3
+        assert _create_size_estimator("Array(Int32)")([1, 2]) == 16
+        assert _create_size_estimator("DateTime")(None) == 4
+
+    def test_bulk_index_convert_values(self):
+        documents = [{"id": 1, "x": "0x10", "dict": 5}, {"id": 2, "x": 2.0, "dict": [1]}]
+        self.new_client.bulk_index(index="test", docs=documents)
+        result = self.client.execute('SELECT id, x, dict FROM test')
+        self.assertCountEqual(result, [("1", 16, "5"), ("2", 2, "[1]")])
+
+    def test_bulk_index_columns_convert_values(self):
+        self.new_client.bulk_index_columns(index="test", columns={"id": [1], "x": [True]})
+        result = self.client.execute('SELECT id, x FROM test')
+        self.assertCountEqual(result, [("1", 1)])
+
+    def test_get_schema(self):
+        self.new_client.refresh_schema("test")
+        schema = self.new_client._get_schema("test")
+        assert schema["fields"] == frozenset(["id", "x", "dict"])
+        assert schema["types"]["x"] == "Int32"
+
+    def test_get_schema_once(self):
+        self.new_client.refresh_schema()
+        execute = self.new_client.client.execute
+        self.new_client.client.execute = MagicMock(side_effect=execute)
+        self.new_client._get_schema("test")
+        CustomClickhouse()._get_schema("test")
+        self.new_client.client.execute.assert_called_once_with("DESCRIBE TABLE test")
+
+    def test_send_sql_request_refresh_schema(self):
+        self.new_client._get_schema("test")
+        self.new_client.send_sql_request("ALTER TABLE test ADD COLUMN y Int32")
+        assert "y" in self.new_client._get_schema("test")["fields"]
+
     def test_send_sql_request(self):
         formatted_documents = self._add_records()
         result = self.new_client.send_sql_request("SELECT max(x) FROM test")
@@ -116,21 +226,38 @@ class ClickhouseTestCase(unittest.TestCase):
 
     def test_split_records(self):
         test_record = {"test": "123"}
-        test_record_size = sys.getsizeof(test_record)
+        test_record_size = 4
         test_records = [test_record] * 5
         chunks = list(self.new_client._split_records(test_records, max_bytes=test_record_size * 2 + 1))
         self.assertSequenceEqual(chunks, [[test_record] * 2, [test_record] * 2, [test_record]])
 
     def test_split_records_one_record(self):
         test_record = {"test": "123"}
-        test_record_size = sys.getsizeof(test_record)
+        test_record_size = 4
         test_records = [test_record]
         chunks = list(self.new_client._split_records(test_records, max_bytes=test_record_size))
         self.assertSequenceEqual(chunks, [[test_record]])
 
+    def test_split_records_big_record(self):
+        test_records = [{"test": "1"}, {"test": "1" * 100}, {"test": "1"}]
+        chunks = list(self.new_client._split_records(test_records, max_bytes=10))
+        self.assertSequenceEqual(chunks, [[record] for record in test_records])
+        assert self.new_client.chunk_sizes == [(1, 2), (1, 101), (1, 2)]
+
+    def test_split_records_with_sizes(self):
+        test_records = [{"test": 1, "flag": 1}] * 4
+        test_sizes = {"flag": lambda value: 1}
+        chunks = list(self.new_client._split_records(test_records, test_sizes, max_bytes=18))
+        self.assertSequenceEqual([len(chunk) for chunk in chunks], [2, 2])
+
+    def test_split_records_max_rows(self):
+        test_records = [{"test": 1}] * 5
+        chunks = list(self.new_client._split_records(test_records, max_rows=2))
+        self.assertSequenceEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
     def test_split_records_same_chunk(self):
         test_record = {"test": "123"}
-        test_record_size = sys.getsizeof(test_record)
+        test_record_size = 4
         test_records = [test_record] * 6
         chunks = list(self.new_client._split_records(test_records, max_bytes=test_record_size * 2))
         self.assertSequenceEqual(chunks, [[test_record] * 2, [test_record] * 2, [test_record] * 2])
@@ -1,11 +1,12 @@
 import unittest
-import web3
-from web3 import Web3, HTTPProvider
 from tests.test_utils import TestClickhouse
-from operations.events import ClickhouseEvents as Events
+from operations.events import ClickhouseEvents as Events, LogsRequestError
+from operations.block_ranges import ClickhouseBlockRanges
+from config import EVENTS_MAX_RANGE_SIZE, EVENTS_TARGET_COUNT, EVENTS_TARGET_TIME
 import httpretty
-from hexbytes import HexBytes
-from unittest.mock import MagicMock, Mock, call
+import requests
+from clients import parity_router
+from unittest.mock import MagicMock, Mock, call, patch
 from tests.test_utils import mockify
 import json
 
@@ -18,6 +19,7 @@ class EventsTestCase(unittest.TestCase):
         self.indices = {
             "block": TEST_BLOCKS_INDEX,
             "block_flag": TEST_BLOCKS_TRACES_EXTRACTED_INDEX,
+            "block_range": TEST_BLOCK_RANGES_INDEX,
             "event": TEST_EVENTS_INDEX
         }
         self.client.prepare_indices(self.indices)
@@ -27,17 +29,17 @@ class EventsTestCase(unittest.TestCase):
     def _get_test_event(self):
         return {
             'address': '0x0F5D2fB29fb7d3CFeE444a200298f468908cC942',
-            'logIndex': 0,
-            'blockNumber': 4500000,
-            'blockHash': HexBytes('0x43340a6d232532c328211d8a8c0fa84af658dbff1f4906ab7a7d4e41f82fe3a3'),
-            'transactionHash': HexBytes('0x93159c656e7a4c11624b7935eb507125cf82f1aae9694fbacf5470bed7d84772'),
-            'transactionIndex': 2,
+            'logIndex': '0x0',
+            'blockNumber': hex(4500000),
+            'blockHash': '0x43340a6d232532c328211d8a8c0fa84af658dbff1f4906ab7a7d4e41f82fe3a3',
+            'transactionHash': '0x93159c656e7a4c11624b7935eb507125cf82f1aae9694fbacf5470bed7d84772',
+            'transactionIndex': '0x2',
             'type': 'mined',
             'transactionLogIndex': '0x0',
             'data': '0x000000000000000000000000000000000000000000000b3cb19896ad16d0c000',
-            'topics': [HexBytes('0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'),
-                       HexBytes('0x0000000000000000000000004d468cf47eb6df39618dc9450be4b56a70a520c1'),
-                       HexBytes('0x000000000000000000000000915c0d974fef3593444028a232fda420fd6e9d1a')]
+            'topics': ['0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef',
+                       '0x0000000000000000000000004d468cf47eb6df39618dc9450be4b56a70a520c1',
+                       '0x000000000000000000000000915c0d974fef3593444028a232fda420fd6e9d1a']
         }
 
     def test_iterate_block_ranges(self):
@@ -48,47 +50,40 @@ class EventsTestCase(unittest.TestCase):
             "number": i
         } for i in range(3 * test_range_size)])
 
-        self.client.bulk_index(index=TEST_BLOCKS_TRACES_EXTRACTED_INDEX, docs=[{
-            "id": i + 10,
-            "name": "events_extracted",
-            "value": 1
-        } for i in range(test_range_size)])
+        self.events.block_ranges.add([(10, 20)])
+        ClickhouseBlockRanges("other_flag", self.indices).add([(20, 30)])
+        self.events.block_ranges.add([(0, 10)])
+        self.events.block_ranges.remove([(0, 10)])
 
-        self.client.bulk_index(index=TEST_BLOCKS_TRACES_EXTRACTED_INDEX, docs=[{
-            "id": i + 20,
-            "name": "other_flag",
-            "value": 1
-        } for i in range(test_range_size)])
+        self.events.range_size = test_range_size
+        result = [r for r in self.events._iterate_block_ranges()]
+        self.assertCountEqual(result, [(0, 10), (20, 30)])
 
-        self.client.bulk_index(index=TEST_BLOCKS_TRACES_EXTRACTED_INDEX, docs=[{
-            "id": i,
-            "name": "events_extracted",
-            "value": 1
-        } for i in range(test_range_size)] + [{
-            "id": i,
-            "name": "events_extracted"
-        } for i in range(test_range_size)])
+    def test_iterate_block_ranges_split_unprocessed_ranges(self):
+        self.client.bulk_index(index=TEST_BLOCKS_INDEX, docs=[{"id": i, "number": i} for i in range(12)])
+        self.events.block_ranges.add([(2, 3)])
+        self.events.range_size = 5
+        result = list(self.events._iterate_block_ranges())
+        self.assertSequenceEqual(result, [(0, 2), (3, 8), (8, 12)])
 
-        result = [r for r in self.events._iterate_block_ranges(test_range_size)]
-        self.assertCountEqual(result, [(0, 10), (20, 30)])
-        pass
+    def test_iterate_block_ranges_adapt_range_size(self):
+        self.client.bulk_index(index=TEST_BLOCKS_INDEX, docs=[{"id": i, "number": i} for i in range(20)])
+        self.events.range_size = 2
+        result = []
+        for block_range in self.events._iterate_block_ranges():
+            result.append(block_range)
+            self.events.range_size *= 2
+        self.assertSequenceEqual(result, [(0, 2), (2, 6), (6, 14), (14, 20)])
 
     @httpretty.activate
     def test_get_events(self):
         test_event = self._get_test_event()
-        test_json_event = test_event.copy()
-        test_json_event["blockHash"] = test_event["blockHash"].hex()
-        test_json_event["blockNumber"] = hex(test_event["blockNumber"])
-        test_json_event["logIndex"] = hex(test_event["logIndex"])
-        test_json_event["transactionIndex"] = hex(test_event["transactionIndex"])
-        test_json_event["transactionHash"] = test_event["transactionHash"].hex()
-        test_json_event["topics"] = [topic.hex() for topic in test_event["topics"]]
         test_range = (10, 20)
-        response_body = json.dumps({
-            "id": 1,
+        response_body = json.dumps([{
+            "id": "logs",
             "jsonrpc": "2.0",
-            "result": [test_json_event]
-        })
+            "result": [test_event]
+        }])
         httpretty.register_uri(
             httpretty.POST,
             "http://localhost:8550/",
@@ -97,27 +92,120 @@ class EventsTestCase(unittest.TestCase):
         received_events = self.events._get_events(test_range)
         self.assertCountEqual(received_events, [test_event])
 
+    @httpretty.activate
     def test_get_events_use_range(self):
         test_range = (10, 20)
-        self.events.web3.eth.filter = MagicMock(return_value=self)
-        self.get_all_entries = MagicMock()
+        httpretty.register_uri(
+            httpretty.POST,
+            "http://localhost:8550/",
+            body=json.dumps([{"id": "logs", "jsonrpc": "2.0", "result": []}])
+        )
         self.events._get_events(test_range)
-        self.events.web3.eth.filter.assert_any_call({"fromBlock": test_range[0], "toBlock": test_range[1] - 1})
+        request, = json.loads(httpretty.last_request().body)
+        assert request["method"] == "eth_getLogs"
+        assert request["params"] == [{"fromBlock": hex(test_range[0]), "toBlock": hex(test_range[1] - 1)}]
+
+    @httpretty.activate
+    def test_get_logs_error(self):
+        httpretty.register_uri(
+            httpretty.POST,
+            "http://localhost:8550/",
+            body=json.dumps([{"id": "logs", "jsonrpc": "2.0", "error": {"code": -32005, "message": "too many results"}}])
+        )
+        with self.assertRaises(LogsRequestError):
+            self.events._get_logs((0, 10))
+
+    @httpretty.activate
+    def test_get_logs_retry_on_another_node(self):
+        httpretty.register_uri(httpretty.POST, "http://localhost:8550/", status=502, body="Bad Gateway")
+        httpretty.register_uri(
+            httpretty.POST,
+            "http://localhost:8551/",
+            body=json.dumps([{"id": "logs", "jsonrpc": "2.0", "result": ["event"]}])
+        )
+        self.events.parity_hosts = [(None, None, "http://localhost:8550"), (None, None, "http://localhost:8551")]
+        with patch("clients.parity_router._routers", {}):
+            assert self.events._get_logs((0, 10)) == ["event"]
+        hosts = [request.headers["host"] for request in httpretty.latest_requests()]
+        assert (hosts[0], hosts[-1]) == ("localhost:8550", "localhost:8551")
+
+    def test_get_logs_timeout(self):
+        """
+        Test counting timeouts as node failures and rejecting the range only when all nodes timed out
+        """
+        test_response = {"id": "logs", "jsonrpc": "2.0", "result": ["event"]}
+        responses = {
+            "http://localhost:8550": [(test_response, 10)],
+            "http://localhost:8551": requests.exceptions.Timeout()
+        }
+
+        def iterate_jsonrpc_responses(url, request):
+            if isinstance(responses[url], Exception):
+                raise responses[url]
+            return responses[url]
+
+        self.events.parity_hosts = [(None, None, "http://localhost:8550"), (None, None, "http://localhost:8551")]
+        with patch("clients.parity_router._routers", {}), \
+                patch("operations.events.parity_transport.iterate_jsonrpc_responses", iterate_jsonrpc_responses):
+            router = parity_router.get_router()
+            router._get_node("http://localhost:8550").outstanding = 1
+            assert self.events._get_logs((0, 10)) == ["event"]
+            assert router.get_stats()["http://localhost:8551"]["error_rate"] == 1
+            responses["http://localhost:8550"] = requests.exceptions.Timeout()
+            with self.assertRaises(LogsRequestError):
+                self.events._get_logs((0, 10))
+            responses["http://localhost:8550"] = ConnectionError()
+            with self.assertRaises((ConnectionError, requests.exceptions.Timeout)):
+                self.events._get_logs((0, 10))
+
+    def test_get_events_split_rejected_range(self):
+        def get_logs(block_range):
+            if block_range[1] - block_range[0] > 3:
+                raise LogsRequestError("too many results")
+            return list(range(*block_range))
+
+        self.events._get_logs = MagicMock(side_effect=get_logs)
+        self.events.range_size = 10
+        events = self.events._get_events((0, 10))
+        self.assertSequenceEqual(events, list(range(10)))
+        self.events._get_logs.assert_any_call((0, 5))
+        self.events._get_logs.assert_any_call((0, 2))
+        self.events._get_logs.assert_any_call((7, 10))
+
+    def test_get_events_raise_error_for_one_block(self):
+        self.events._get_logs = MagicMock(side_effect=LogsRequestError("error"))
+        with self.assertRaises(LogsRequestError):
+            self.events._get_events((0, 2))
+        self.events._get_logs.assert_called_with((0, 1))
+
+    def test_adapt_range_size(self):
+        self.events.range_size = 100
+        self.events._adapt_range_size((0, 100), 0, 0.1)
+        assert self.events.range_size == 200
+        self.events._adapt_range_size((0, 10), EVENTS_TARGET_COUNT, 0.1)
+        assert self.events.range_size == 10
+        self.events._adapt_range_size((0, 10), 0, 2 * EVENTS_TARGET_TIME)
+        assert self.events.range_size == 5
+        self.events._adapt_range_size((0, 1), 100 * EVENTS_TARGET_COUNT, 0.1)
+        assert self.events.range_size == 1
+
+    def test_adapt_range_size_max(self):
+        self.events.range_size = EVENTS_MAX_RANGE_SIZE
+        self.events._adapt_range_size((0, EVENTS_MAX_RANGE_SIZE), 0, 0)
+        assert self.events.range_size == EVENTS_MAX_RANGE_SIZE
 
     def test_process_event(self):
         test_event = self._get_test_event()
         test_processed_event = test_event.copy()
-        test_processed_event["transactionLogIndex"] = int(test_event["transactionLogIndex"], 0)
-        test_processed_event["id"] = "{}.{}".format(test_event['transactionHash'].hex(),
-                                                    test_processed_event["transactionLogIndex"])
+        test_processed_event["blockNumber"] = 4500000
+        test_processed_event["logIndex"] = 0
+        test_processed_event["transactionIndex"] = 2
+        test_processed_event["transactionLogIndex"] = 0
+        test_processed_event["id"] = "{}.{}".format(test_event['transactionHash'], 0)
         test_processed_event["address"] = test_event["address"].lower()
-        test_processed_event["blockHash"] = test_event["blockHash"].hex()
-        test_processed_event["transactionHash"] = test_event["transactionHash"].hex()
-        test_processed_event["topics"] = [topic.hex() for topic in test_event["topics"]]
 
-        print(test_processed_event)
         processed_event = self.events._process_event(test_event)
-        self.assertSequenceEqual(processed_event, test_processed_event)
+        self.assertDictEqual(processed_event, test_processed_event)
 
     def test_save_events(self):
         test_events = [{
@@ -143,40 +231,70 @@ class EventsTestCase(unittest.TestCase):
         self.events._save_events([])
 
     def test_save_processed_blocks(self):
-        test_range = (0, 10)
-        test_flags = [str(i) for i in range(0, 10)]
-        self.events._save_processed_blocks(test_range)
-        flags = self.client.search(index=TEST_BLOCKS_TRACES_EXTRACTED_INDEX, fields=[],
-                                   query="WHERE name = 'events_extracted' AND value IS NOT NULL", size=1000)
-        self.assertCountEqual([flag["_id"] for flag in flags], test_flags)
+        test_ranges = [(0, 10), (10, 15), (20, 30)]
+        self.events._save_processed_blocks(test_ranges)
+        assert self.events.block_ranges.get_ranges() == [(0, 15), (20, 30)]
 
     def test_extract_events(self):
-        test_ranges = [(0, 10), (20, 30)]
-        test_parity_events = [
-            [{'id': i, 'blockNumber': i} for i in range(10)],
-            [{'id': i, 'blockNumber': i + 10} for i in range(10)]
-        ]
+        test_ranges = [(0, 10), (20, 30), (30, 35)]
+        test_parity_events = {
+            test_range: [{'id': i, 'blockNumber': i} for i in range(*test_range)]
+            for test_range in test_ranges
+        }
         mockify(self.events, {
             "_iterate_block_ranges": MagicMock(return_value=test_ranges),
-            '_get_events': MagicMock(side_effect=test_parity_events),
-        }, 'extract_events')
+            '_get_events': MagicMock(side_effect=lambda block_range: test_parity_events[block_range]),
+        }, ['extract_events', '_extract_events', '_commit_ranges'])
         process = Mock(
-            iterate_blocks=self.events._iterate_block_ranges,
-            get_events=self.events._get_events,
             save_events=self.events._save_events,
             save_blocks=self.events._save_processed_blocks
         )
 
         self.events.extract_events()
 
-        event_calls = []
-        for i, events in enumerate(test_parity_events):
-            event_calls += [call.get_events(test_ranges[i]), call.save_events(events), call.save_blocks(test_ranges[i])]
-        process.assert_has_calls([
-                                     call.iterate_blocks()
-                                 ] + event_calls)
+        for test_range in test_ranges:
+            self.events._get_events.assert_any_call(test_range)
+        saved_events = [event for args, kwargs in self.events._save_events.call_args_list for event in args[0]]
+        saved_ranges = [block_range for args, kwargs in self.events._save_processed_blocks.call_args_list
+                        for block_range in args[0]]
+        self.assertSequenceEqual(saved_events, [event for test_range in test_ranges
+                                                for event in test_parity_events[test_range]])
+        self.assertSequenceEqual(saved_ranges, test_ranges)
+        for save_events_call, save_blocks_call in zip(process.mock_calls[0::2], process.mock_calls[1::2]):
+            assert save_events_call[0] == "save_events"
+            assert save_blocks_call[0] == "save_blocks"
+
+    def test_extract_events_keep_failed_ranges_unprocessed(self):
+        test_ranges = [(0, 10), (10, 20), (20, 30)]
+
+        def get_events(block_range):
+            if block_range == (10, 20):
+                raise ValueError()
+            return [{"id": block_range[0]}]
+
+        mockify(self.events, {
+            "_iterate_block_ranges": MagicMock(return_value=test_ranges),
+            '_get_events': MagicMock(side_effect=get_events),
+        }, ['extract_events', '_extract_events', '_commit_ranges'])
+
+        with self.assertRaises(ValueError):
+            self.events.extract_events()
+
+        saved_ranges = [block_range for args, kwargs in self.events._save_processed_blocks.call_args_list
+                        for block_range in args[0]]
+        self.assertSequenceEqual(saved_ranges, [(0, 10)])
+
+    def test_iterate_block_ranges_split_on_host_bounds(self):
+        self.events.parity_hosts = [(None, 15, "http://localhost:8550"), (15, None, "http://localhost:8551")]
+        self.events.block_ranges = MagicMock()
+        self.events.block_ranges.get_last_block.return_value = 29
+        self.events.block_ranges.get_unprocessed_ranges.return_value = [(0, 30)]
+        self.events.range_size = 10
+        result = list(self.events._iterate_block_ranges())
+        self.assertSequenceEqual(result, [(0, 10), (10, 15), (15, 25), (25, 30)])
 
 
 TEST_BLOCKS_INDEX = "test_ethereum_block"
 TEST_BLOCKS_TRACES_EXTRACTED_INDEX = "test_ethereum_block_flag"
+TEST_BLOCK_RANGES_INDEX = "test_ethereum_block_range"
 TEST_EVENTS_INDEX = "test_ethereum_event"
@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import MagicMock, patch, call
+from operations.follow import ClickhouseFollower
+
+
+class ClickhouseFollowerTestCase(unittest.TestCase):
+    def setUp(self):
+        stages = [
+            "ClickhouseInternalTransactions", "ClickhouseBlocks", "ClickhouseEvents", "ClickhouseContractMethods",
+            "ClickhouseReorgs"
+        ]
+        patchers = [patch("operations.follow." + stage) for stage in stages]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.follower = ClickhouseFollower(poll_interval=1, max_poll_interval=3)
+        self.follower.reorgs.find_fork_block.return_value = None
+
+    def test_wait_for_head(self):
+        self.follower._get_head = MagicMock(return_value=5)
+        assert self.follower.wait_for_head() == 5
+
+    def test_wait_for_head_backoff(self):
+        self.follower.head = 5
+        self.follower._get_head = MagicMock(side_effect=[5, 5, ConnectionError(), 5, 6])
+        with patch("operations.follow.sleep") as sleep_mock:
+            assert self.follower.wait_for_head() == 6
+        sleep_mock.assert_has_calls([call(1), call(2), call(3), call(3)])
+
+    def test_process(self):
+        test_bounds = [(10, 12)]
+        self.follower.process(test_bounds)
+        self.follower.internal_transactions.extract_traces.assert_called_with(test_bounds)
+        self.follower.blocks.create_blocks.assert_called_with()
+        self.follower.events.extract_events.assert_called_with(test_bounds)
+        self.follower.contract_methods.search_methods.assert_called_with()
+
+    def test_follow(self):
+        self.follower.wait_for_head = MagicMock(side_effect=[5, 7, 8, KeyboardInterrupt()])
+        self.follower.process = MagicMock()
+        with self.assertRaises(KeyboardInterrupt):
+            self.follower.follow()
+        self.follower.process.assert_has_calls([call(None), call([(6, 8)]), call([(8, 9)])])
+        assert self.follower.head == 8
+
+    def test_follow_repeat_failed_blocks(self):
+        self.follower.head = 5
+        self.follower.wait_for_head = MagicMock(side_effect=[7, 8, KeyboardInterrupt()])
+        self.follower.process = MagicMock(side_effect=[ValueError(), None])
+        with patch("operations.follow.sleep"), self.assertRaises(KeyboardInterrupt):
+            self.follower.follow()
+        self.follower.process.assert_has_calls([call([(6, 8)]), call([(6, 9)])])
+        assert self.follower.head == 8
+
+    def test_follow_roll_back_reorg(self):
+        self.follower.head = 10
+        self.follower.wait_for_head = MagicMock(side_effect=[12, KeyboardInterrupt()])
+        self.follower.reorgs.find_fork_block.return_value = 9
+        self.follower.process = MagicMock()
+        with self.assertRaises(KeyboardInterrupt):
+            self.follower.follow()
+        self.follower.reorgs.find_fork_block.assert_called_with(10)
+        self.follower.reorgs.rollback.assert_called_with(9)
+        self.follower.process.assert_called_with([(9, 13)])
@@ -8,6 +8,7 @@ from unittest.mock import MagicMock, call, Mock, patch, ANY
 import multiprocessing
 import json
 from operations.indices import ClickhouseIndices
+from operations.block_ranges import ClickhouseBlockRanges
 from config import INPUT_PARSING_PROCESSES
 
 TEST_CONTRACT_ABI = json.loads(
@@ -33,6 +34,7 @@ TEST_CONTRACT_BLOCK_INDEX = 'test_ethereum_contract_block'
 TEST_TRANSACTIONS_INPUT_INDEX = 'test_transactions_input'
 TEST_BLOCKS_INDEX = 'test_ethereum_blocks'
 TEST_BLOCKS_FLAG_INDEX = 'test_ethereum_blocks_flag'
+TEST_BLOCK_RANGES_INDEX = 'test_ethereum_block_ranges'
 
 
 class ClickhouseInputParsingTestCase():
@@ -45,7 +47,8 @@ class ClickhouseInputParsingTestCase():
             "contract_block": TEST_CONTRACT_BLOCK_INDEX,
             self.input_index: TEST_TRANSACTIONS_INPUT_INDEX,
             "block": TEST_BLOCKS_INDEX,
-            "block_flag": TEST_BLOCKS_FLAG_INDEX
+            "block_flag": TEST_BLOCKS_FLAG_INDEX,
+            "block_range": TEST_BLOCK_RANGES_INDEX
         }
         self.contracts = self.contracts_class(
             self.indices,
@@ -67,29 +70,80 @@ class ClickhouseInputParsingTestCase():
 
     def test_decode_inputs_batch_sync(self):
         """Test decode inputs batch"""
-        response = inputs._decode_inputs_batch_sync({
-            "0x1": (TEST_CONTRACT_ABI, TEST_CONTRACT_PARAMETERS),
-            "0x2": (TEST_CONTRACT_ABI, TEST_CONTRACT_EVENT_PARAMETERS)
-        })
+        response = inputs._decode_inputs_batch_sync([
+            ("0x1", TEST_CONTRACT_ADDRESS, TEST_CONTRACT_PARAMETERS),
+            ("0x2", TEST_CONTRACT_ADDRESS, TEST_CONTRACT_EVENT_PARAMETERS)
+        ], next(inputs._contracts_abi_versions), {TEST_CONTRACT_ADDRESS: TEST_CONTRACT_ABI})
         print(response['0x2'])
         self.assertSequenceEqual(response, {
             "0x1": TEST_CONTRACT_DECODED_PARAMETERS,
             "0x2": TEST_CONTRACT_DECODED_EVENT_PARAMETERS
         })
 
+    def test_create_pool_with_contracts_abi(self):
+        assert self.contracts.pool is None
+        self.contracts._set_contracts_abi({TEST_CONTRACT_ADDRESS: json.dumps(TEST_CONTRACT_ABI)})
+        assert self.contracts.pool is not None
+
+    def test_keep_pool_on_contracts_abi_change(self):
+        self.contracts._set_contracts_abi({TEST_CONTRACT_ADDRESS: json.dumps(TEST_CONTRACT_ABI)})
+        pool = self.contracts.pool
+        self.contracts._set_contracts_abi({TEST_CONTRACT_ADDRESS: json.dumps([])})
+        assert self.contracts.pool is pool
+
+    def test_set_contracts_abi_pass_abi_to_workers(self):
+        self.contracts._set_contracts_abi({TEST_CONTRACT_ADDRESS: json.dumps([])})
+        self.contracts._decode_inputs_batch([("0x1", TEST_CONTRACT_ADDRESS, TEST_CONTRACT_PARAMETERS)])
+        self.contracts._set_contracts_abi({TEST_CONTRACT_ADDRESS: json.dumps(TEST_CONTRACT_ABI)})
+        response = self.contracts._decode_inputs_batch([("0x1", TEST_CONTRACT_ADDRESS, TEST_CONTRACT_PARAMETERS)])
+        self.assertSequenceEqual(response, {"0x1": TEST_CONTRACT_DECODED_PARAMETERS})
+
+    def test_compile_abi(self):
+        compiled_abi = inputs._compile_abi(TEST_CONTRACT_ABI)
+        assert compiled_abi[bytes.fromhex(TEST_CONTRACT_PARAMETERS[2:10])] == [("transfer", ["address", "uint256"])]
+        assert compiled_abi[bytes.fromhex(TEST_CONTRACT_EVENT_PARAMETERS[2:10])] == [
+            ("Transfer", ["address", "address", "uint256"])
+        ]
+        assert len(compiled_abi) == len([
+            description for description in TEST_CONTRACT_ABI if description["type"] in ["function", "event"]
+        ])
+
+    def test_get_compiled_abi_once_per_address(self):
+        inputs._update_worker_abis(next(inputs._contracts_abi_versions), {TEST_CONTRACT_ADDRESS: TEST_CONTRACT_ABI})
+        with patch.object(inputs, "_compile_abi", wraps=inputs._compile_abi) as compile_abi_mock:
+            for _ in range(3):
+                compiled_abi = inputs._get_compiled_abi(TEST_CONTRACT_ADDRESS)
+            compile_abi_mock.assert_called_once_with(TEST_CONTRACT_ABI)
+            assert inputs._decode_input(compiled_abi, TEST_CONTRACT_PARAMETERS) == TEST_CONTRACT_DECODED_PARAMETERS
+
+    def test_recompile_abi_on_new_version(self):
+        inputs._update_worker_abis(next(inputs._contracts_abi_versions), {TEST_CONTRACT_ADDRESS: []})
+        assert inputs._get_compiled_abi(TEST_CONTRACT_ADDRESS) == {}
+        inputs._update_worker_abis(next(inputs._contracts_abi_versions), {TEST_CONTRACT_ADDRESS: TEST_CONTRACT_ABI})
+        assert inputs._get_compiled_abi(TEST_CONTRACT_ADDRESS) == inputs._compile_abi(TEST_CONTRACT_ABI)
+
+    def test_decode_input_unknown_method(self):
+        compiled_abi = inputs._compile_abi(TEST_CONTRACT_ABI)
+        assert inputs._decode_input(compiled_abi, "0x00000000" + TEST_CONTRACT_PARAMETERS[10:]) is None
+
     def test_decode_inputs_batch(self):
         """Test decoding inputs batch in parallel mode"""
-        test_inputs = {"0x" + str(i): "input" + str(i) for i in range(100)}
-        chunks = [[("0x1", "input1")], [("0x1", "input2")]]
+        test_inputs = [("0x" + str(i), "0xa", "input" + str(i)) for i in range(100)]
+        chunks = [[("0x1", "0xa", "input1")], [("0x1", "0xa", "input2")]]
         decoded_inputs = [{"0x1": "decoded_input2"}, {"0x0": "decoded_input1"}]
 
+        self.contracts._contracts_abi = {"0xa": "abi"}
+        self.contracts._contracts_abi_version = 2
         self.contracts._split_on_chunks = MagicMock(return_value=chunks)
-        self.contracts.pool.map = MagicMock(return_value=decoded_inputs)
+        self.contracts.pool = MagicMock()
+        self.contracts.pool.starmap = MagicMock(return_value=decoded_inputs)
 
         response = self.contracts._decode_inputs_batch(test_inputs)
 
-        self.contracts._split_on_chunks.assert_called_with([(hash, input) for hash, input in test_inputs.items()], INPUT_PARSING_PROCESSES)
-        self.contracts.pool.map.assert_called_with(inputs._decode_inputs_batch_sync, [dict(chunk) for chunk in chunks])
+        self.contracts._split_on_chunks.assert_called_with(test_inputs, INPUT_PARSING_PROCESSES)
+        self.contracts.pool.starmap.assert_called_with(inputs._decode_inputs_batch_sync, [
+            (chunk, 2, {"0xa": "abi"}) for chunk in chunks
+        ])
         self.assertSequenceEqual({"0x0": "decoded_input1", "0x1": "decoded_input2"}, response)
 
     def add_contracts_with_and_without_abi(self):
@@ -253,14 +307,9 @@ class ClickhouseInputParsingTestCase():
             "id": 2,
             "number": 2
         }]
-        test_block_flags = [{
-            "id": 1,
-            "name": self.block_flag_name,
-            "value": 1
-        }]
         test_max_block = 1
         self.client.bulk_index(index=TEST_BLOCKS_INDEX, docs=test_blocks)
-        self.client.bulk_index(index=TEST_BLOCKS_FLAG_INDEX, docs=test_block_flags)
+        ClickhouseBlockRanges(self.block_flag_name, self.indices).add([(1, 2)])
         self.contracts._iterate_contracts_with_abi = MagicMock(return_value=[])
 
         self.contracts.decode_inputs()
@@ -2,21 +2,31 @@ import unittest
 from tests.test_utils import mockify, TestClickhouse, parity
 from operations.internal_transactions import *
 from operations.internal_transactions import \
-    _get_parity_url_by_block, \
-    _get_traces_sync, \
+    _get_traces_async, \
     _make_trace_requests, \
     _merge_block, \
     _make_transactions_requests, \
-    _send_jsonrpc_request
+    _make_block_header, \
+    _send_jsonrpc_request, \
+    _send_jsonrpc_request_with_size, \
+    _iterate_dump, \
+    _list_dump_files
 from operations import internal_transactions
 import json
+import time
+import asyncio
 import httpretty
 from unittest.mock import MagicMock, patch, call, Mock, ANY
 from clients.custom_clickhouse import CustomClickhouse
+from operations.block_ranges import ClickhouseBlockRanges
+from clients.parity_router import ParityRouter
 from operations.indices import ClickhouseIndices
 import os
+import gzip
+import shutil
+import tempfile
 from pprint import pprint
-from config import TEST_PARITY_NODE
+from config import TEST_PARITY_NODE, PARITY_BLOCKS_PER_BATCH, PARITY_BATCH_WEIGHT
 
 
 class InternalTransactionsTestCase(unittest.TestCase):
@@ -27,7 +37,8 @@ class InternalTransactionsTestCase(unittest.TestCase):
             "transaction": TEST_TRANSACTIONS_INDEX,
             "internal_transaction": TEST_INTERNAL_TRANSACTIONS_INDEX,
             "miner_transaction": TEST_MINER_TRANSACTIONS_INDEX,
-            "block_flag": TEST_BLOCKS_TRACES_EXTRACTED_INDEX
+            "block_flag": TEST_BLOCKS_TRACES_EXTRACTED_INDEX,
+            "block_range": TEST_BLOCK_RANGES_INDEX
         }
         self.client.prepare_indices(self.indices)
         self.parity_hosts = [(None, None, TEST_PARITY_NODE)]
@@ -46,30 +57,6 @@ class InternalTransactionsTestCase(unittest.TestCase):
             split_mock.assert_called_with(test_list, test_chunks_number)
             assert chunks == test_chunks
 
-    def test_get_parity_url_by_block(self):
-        """
-        Test getting url for block by specified config
-        """
-        parity_hosts = [
-            (0, 100, "url1"),
-            (100, 200, "url2")
-        ]
-        assert _get_parity_url_by_block(parity_hosts, 1) == "url1"
-        assert _get_parity_url_by_block(parity_hosts, 101) == "url2"
-        assert _get_parity_url_by_block(parity_hosts, 1000) == None
-
-    def test_get_default_parity_url(self):
-        """
-        Test getting url for block inside of specified opened ranges
-        """
-        parity_hosts = [
-            (10, 100, "url1"),
-            (None, 10, "url2"),
-            (100, None, "url3")
-        ]
-        assert _get_parity_url_by_block(parity_hosts, 9) == "url2"
-        assert _get_parity_url_by_block(parity_hosts, 10000) == "url3"
-
     def _make_requests(self, method, check):
         """
         Test making trace requests for each block
@@ -79,7 +66,7 @@ class InternalTransactionsTestCase(unittest.TestCase):
             (TEST_BLOCK_NUMBER + 3, None, "http://localhost:8546")
         ]
         requests = method(parity_hosts, [TEST_BLOCK_NUMBER + i for i in range(10)])
-        requests_to_node = requests["http://localhost:8546"]
+        requests_to_node = requests[("http://localhost:8546",)]
         for i, request in enumerate(requests_to_node):
             check(self, i, request)
 
@@ -149,10 +136,13 @@ class InternalTransactionsTestCase(unittest.TestCase):
         )
         self.assertCountEqual(response, test_response)
 
-    def test_get_traces_sync(self):
+    def test_get_traces_async(self):
         test_parity_hosts = "hosts"
         test_blocks = "blocks"
-        test_urls = ["url1", "url2"]
+        test_urls = [("url1",), ("url2",)]
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        test_semaphores = {url: asyncio.Semaphore() for url in test_urls}
         test_trace_requests = {
             test_urls[0]: "trace1",
             test_urls[1]: "trace2"
@@ -169,11 +159,13 @@ class InternalTransactionsTestCase(unittest.TestCase):
                 "transactions": ["transactions"]
             }
         }
+        make_block_header_mock = MagicMock(side_effect=lambda block: "header")
 
         make_trace_requests_mock = MagicMock(return_value=test_trace_requests)
         make_transactions_requests_mock = MagicMock(return_value=test_transactions_requests)
-        return_response_mock = MagicMock(side_effect=[test_trace_response, test_transactions_response] * 2)
-        send_jsonrpc_request_mock = MagicMock(side_effect=lambda x, y, getter: getter(return_response_mock()))
+        send_jsonrpc_request_mock = MagicMock(side_effect=lambda url, request, getter: (getter(
+            test_trace_response if request.startswith("trace") else test_transactions_response
+        ), 10))
         merge_block_mock = MagicMock(side_effect=[
             ["merge1"],
             ["merge2"]
@@ -188,70 +180,172 @@ class InternalTransactionsTestCase(unittest.TestCase):
 
         with patch("operations.internal_transactions._make_trace_requests", make_trace_requests_mock), \
              patch("operations.internal_transactions._make_transactions_requests", make_transactions_requests_mock), \
-             patch("operations.internal_transactions._send_jsonrpc_request", send_jsonrpc_request_mock), \
-             patch("operations.internal_transactions._merge_block", merge_block_mock):
-            result = _get_traces_sync(test_parity_hosts, test_blocks)
-
-            calls = [
+             patch("operations.internal_transactions._send_jsonrpc_request_with_size", send_jsonrpc_request_mock), \
+             patch("operations.internal_transactions._merge_block", merge_block_mock), \
+             patch("operations.internal_transactions._make_block_header", make_block_header_mock):
+            result, headers, size = loop.run_until_complete(
+                _get_traces_async(test_parity_hosts, test_blocks, test_semaphores)
+            )
+            loop.close()
+
+            process.assert_has_calls([
                 call.trace_request(test_parity_hosts, test_blocks),
                 call.transaction_request(test_parity_hosts, test_blocks)
-            ]
+            ])
             for url, trace_request in test_trace_requests.items():
                 transaction_request = test_transactions_requests[url]
-                calls += [call.send(url, trace_request, ANY), call.send(url, transaction_request, ANY)]
-                calls += [call.merge(["trace"], ["transactions"], ["gasUsed", "gasPrice"])]
-            process.assert_has_calls(calls)
+                send_jsonrpc_request_mock.assert_any_call(url[0], trace_request, ANY)
+                send_jsonrpc_request_mock.assert_any_call(url[0], transaction_request, ANY)
+            merge_block_mock.assert_called_with(["trace"], ["transactions"], ["gasUsed", "gasPrice"])
+            make_block_header_mock.assert_called_with(test_transactions_response["result"])
             self.assertSequenceEqual(result, ["merge1", "merge2"])
+            self.assertSequenceEqual(headers, ["header", "header"])
+            assert size == 40
+
+    def test_get_traces_async_limit_batches_in_flight(self):
+        """
+        Test limiting number of batches sent simultaneously to one parity host
+        """
+        test_url = "http://localhost:8545"
+        test_parity_hosts = [(None, None, test_url)]
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        semaphores = {(test_url,): asyncio.Semaphore(1)}
+        in_flight = []
+        max_in_flight = []
+        batches_in_flight = []
+
+        def send(url, request, getter):
+            in_flight.append(request[0]["params"][0])
+            max_in_flight.append(len(in_flight))
+            batches_in_flight.append(len(set(in_flight)))
+            time.sleep(0.05)
+            in_flight.pop()
+            return [], 0
+
+        with patch("operations.internal_transactions._send_jsonrpc_request_with_size", MagicMock(side_effect=send)):
+            loop.run_until_complete(asyncio.gather(
+                _get_traces_async(test_parity_hosts, [1], semaphores),
+                _get_traces_async(test_parity_hosts, [2], semaphores)
+            ))
+            loop.close()
+        assert max(max_in_flight) == 2
+        assert max(batches_in_flight) == 1
 
     def test_get_traces(self):
         """
-        Test parallel process of getting traces
+        Test concurrent process of getting traces
         """
         test_hosts = []
         test_traces = ["trace" + str(i + 1) for i in range(100)]
         test_blocks = [str(i + 1) for i in range(100)]
         test_chunks = [[str(j * 10 + i + 1) for i in range(10)] for j in range(10)]
-        test_chunks_with_parameters = [(test_hosts, chunk) for chunk in test_chunks]
-        test_map_result = [
-            ["trace" + str(j * 10 + i + 1) for i in range(10)]
-            for j in range(10)
-        ]
+        test_traces_by_chunk = {
+            tuple(chunk): ["trace" + block for block in chunk]
+            for chunk in test_chunks
+        }
+
+        async def get_traces(parity_hosts, blocks, semaphores, executor):
+            return test_traces_by_chunk[tuple(blocks)], ["header" + block for block in blocks], 1
+
         self.internal_transactions.parity_hosts = test_hosts
-        self.internal_transactions._split_on_chunks = MagicMock(return_value=test_chunks)
-        self.internal_transactions.pool.starmap = MagicMock(return_value=test_map_result)
-        process = Mock(
-            split=self.internal_transactions._split_on_chunks,
-            map=self.internal_transactions.pool.starmap
-        )
+        self.internal_transactions._iterate_batches = MagicMock(return_value=iter(test_chunks))
+        self.internal_transactions._update_block_weight = MagicMock()
+        with patch("operations.internal_transactions._get_traces_async", MagicMock(side_effect=get_traces)):
+            traces, headers = self.internal_transactions._get_traces(test_blocks)
 
-        traces = self.internal_transactions._get_traces(test_blocks)
+        self.internal_transactions._iterate_batches.assert_called_with(test_blocks)
+        self.assertCountEqual(test_traces, traces)
+        self.assertCountEqual(["header" + block for block in test_blocks], headers)
 
-        process.assert_has_calls([
-            call.split(test_blocks, 10),
-            call.map(_get_traces_sync, test_chunks_with_parameters)
+    def test_iterate_traces_chunks(self):
+        """
+        Test splitting chunks of blocks by size of parity responses
+        """
+        test_chunks = [[1, 2, 3, 4, 5], [6]]
+        test_sizes = {1: 10, 2: 10, 3: 30, 4: 10, 5: 5, 6: 100}
+        self.internal_transactions._iterate_blocks = MagicMock(return_value=test_chunks)
+        self.internal_transactions._iterate_traces = MagicMock(side_effect=lambda blocks: [
+            ([block], ["trace" + str(block)], ["header" + str(block)], test_sizes[block]) for block in blocks
         ])
-        self.assertCountEqual(test_traces, traces)
+        with patch("operations.internal_transactions.TRACES_CHUNK_MAX_SIZE", 20):
+            chunks = list(self.internal_transactions._iterate_traces_chunks())
+        self.assertSequenceEqual([chunk[0] for chunk in chunks], [[1, 2], [3], [4, 5, 6]])
+        self.assertSequenceEqual(chunks[0][1], ["trace1", "trace2"])
+        self.assertSequenceEqual(chunks[0][2], ["header1", "header2"])
+
+    def test_iterate_traces_keep_batches_in_flight(self):
+        """
+        Test sending next batch as soon as any batch in flight is received
+        """
+        test_url = "http://localhost:8545"
+        self.internal_transactions.semaphores = {(test_url,): None}
+        self.internal_transactions._iterate_batches = MagicMock(return_value=iter([[1], [2], [3], [4]]))
+        self.internal_transactions._update_block_weight = MagicMock()
+        sent = []
+
+        async def get_traces(parity_hosts, blocks, semaphores, executor):
+            sent.append(blocks)
+            await asyncio.sleep(0.05 if blocks == [1] else 0.01)
+            return ["trace" + str(blocks[0])], ["header" + str(blocks[0])], 1
+
+        with patch("operations.internal_transactions.PARITY_BATCHES_IN_FLIGHT", 2), \
+                patch("operations.internal_transactions._get_traces_async", MagicMock(side_effect=get_traces)):
+            results = list(self.internal_transactions._iterate_traces([1, 2, 3, 4]))
+        assert [result[0] for result in results] == [[2], [3], [4], [1]]
+        assert sent == [[1], [2], [3], [4]]
+        self.internal_transactions._update_block_weight.assert_any_call(["header1"])
+
+    def test_iterate_batches(self):
+        """
+        Test splitting blocks into batches by estimated weight updated during iteration
+        """
+        self.internal_transactions.block_weight = 150
+        batches = []
+        with patch("operations.internal_transactions.PARITY_BATCH_WEIGHT", 600):
+            for batch in self.internal_transactions._iterate_batches(iter(range(1, 10))):
+                batches.append(batch)
+                self.internal_transactions.block_weight = 300
+        assert batches == [[1, 2, 3, 4], [5, 6], [7, 8], [9]]
+
+    def test_iterate_batches_max_blocks(self):
+        self.internal_transactions.block_weight = 1
+        with patch("operations.internal_transactions.PARITY_MAX_BLOCKS_PER_BATCH", 3):
+            batches = list(self.internal_transactions._iterate_batches(range(7)))
+        assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+    def test_update_block_weight(self):
+        assert self.internal_transactions.block_weight == PARITY_BATCH_WEIGHT / PARITY_BLOCKS_PER_BATCH
+        self.internal_transactions.block_weight = 100
+        self.internal_transactions._update_block_weight([{"transactionsCount": 9}, {"transactionsCount": 29}])
+        assert self.internal_transactions.block_weight == 60
+        self.internal_transactions._update_block_weight([])
+        assert self.internal_transactions.block_weight == 60
+
+    @httpretty.activate
+    def test_send_jsonrpc_request_with_size(self):
+        test_url = "http://localhost:8545/"
+        test_responses = [{"id": "1", "result": ["result_1"]}, {"id": "2", "result": ["result_2"]}]
+        httpretty.register_uri(httpretty.POST, test_url, body=json.dumps(test_responses))
+        response, size = _send_jsonrpc_request_with_size(test_url, [], lambda x: x["result"])
+        self.assertSequenceEqual(response, ["result_1", "result_2"])
+        assert size == sum(len(json.dumps(test_response)) for test_response in test_responses)
 
-    def test_set_trace_hashes(self):
+    def test_transform_traces_hashes(self):
         """
         Test setting trace hashes for each transaction with ethereum transaction hash
         """
-        transactions = [{
-            "transactionHash": "0x1"
-        }, {
-            "transactionHash": "0x1"
-        }, {
-            "transactionHash": "0x2"
-        }, {
-            "transactionHash": "0x1"
-        }]
-        self.internal_transactions._set_trace_hashes(transactions)
-        assert transactions[0]["hash"] == "0x1.0"
-        assert transactions[1]["hash"] == "0x1.1"
-        assert transactions[2]["hash"] == "0x2.0"
-        assert transactions[3]["hash"] == "0x1.2"
+        transactions = [
+            {"transactionHash": "0x1", "traceAddress": []},
+            {"transactionHash": "0x1", "traceAddress": [0]},
+            {"transactionHash": "0x2", "traceAddress": []},
+            {"transactionHash": "0x1", "traceAddress": [1]}
+        ]
+        internal_columns, miner_columns = self.internal_transactions._transform_traces(transactions)
+        assert internal_columns["hash"] == ["0x1.0", "0x1.1", "0x2.0", "0x1.2"]
+        assert miner_columns["hash"] == []
 
-    def test_set_trace_hashes_for_reward(self):
+    def test_transform_traces_hashes_for_reward(self):
         """
         Test setting trace hashes for each mining transaction
         """
@@ -262,9 +356,109 @@ class InternalTransactionsTestCase(unittest.TestCase):
             "transactionHash": None,
             "blockHash": "0x1"
         }]
-        self.internal_transactions._set_trace_hashes(transactions)
-        assert transactions[0]["hash"] == "0x1.0"
-        assert transactions[1]["hash"] == "0x1.1"
+        internal_columns, miner_columns = self.internal_transactions._transform_traces(transactions)
+        assert miner_columns["hash"] == ["0x1.0", "0x1.1"]
+        assert internal_columns["hash"] == []
+
+    def test_transform_traces_fields(self):
+        """
+        Test flattening of action and result fields and parsing of numbers
+        """
+        transactions = [{
+            "transactionHash": "0x1",
+            "blockHash": "0x2",
+            "blockNumber": 10,
+            "traceAddress": [0],
+            "gasUsed": hex(5),
+            "gasPrice": hex(int(10.1 * 10 ** 18)),
+            "action": {"from": "0x3", "value": hex(int(50.001851 * 1e18)), "gas": "0x10"},
+            "result": {"gasUsed": hex(10000), "output": "0x"}
+        }, {
+            "transactionHash": None,
+            "blockHash": "0x2",
+            "traceAddress": [],
+            "action": {"author": "0x4", "value": "0x"},
+            "result": None
+        }]
+        internal_columns, miner_columns = self.internal_transactions._transform_traces(transactions)
+        assert internal_columns["blockNumber"] == [10]
+        assert internal_columns["from"] == ["0x3"]
+        assert internal_columns["value"] == [50.001851]
+        assert internal_columns["gas"] == ["0x10"]
+        assert internal_columns["gasUsed"] == [10000]
+        assert internal_columns["gasPrice"] == [10.1]
+        assert internal_columns["output"] == ["0x"]
+        assert internal_columns["to"] == [None]
+        assert "action" not in internal_columns
+        assert "result" not in internal_columns
+        assert miner_columns["author"] == ["0x4"]
+        assert miner_columns["value"] == [0]
+        assert miner_columns["gasUsed"] == [None]
+
+    def test_transform_traces_keep_input(self):
+        """
+        Test that transactions are not changed during transformation
+        """
+        transaction = {"transactionHash": "0x1", "traceAddress": [], "action": {"value": "0x1"}}
+        self.internal_transactions._transform_traces([transaction])
+        assert transaction == {"transactionHash": "0x1", "traceAddress": [], "action": {"value": "0x1"}}
+
+    def test_transform_traces_parent_errors(self):
+        """
+        Test set parent_error for transactions inside of failed branches of trace ordered by traceAddress
+        """
+        trace = [
+            {"transactionHash": "0x1", "traceAddress": []},
+            {"transactionHash": "0x1", "traceAddress": [0], "error": "Out of gas"},
+            {"transactionHash": "0x1", "traceAddress": [0, 0]},
+            {"transactionHash": "0x1", "traceAddress": [0, 1], "error": "Out of gas"},
+            {"transactionHash": "0x1", "traceAddress": [0, 1, 0]},
+            {"transactionHash": "0x1", "traceAddress": [1]},
+            {"transactionHash": "0x2", "traceAddress": [], "error": "Out of gas"},
+            {"transactionHash": "0x2", "traceAddress": [0]},
+            {"transactionHash": "0x3", "traceAddress": []}
+        ]
+        self.internal_transactions._set_parent_errors = MagicMock()
+        internal_columns, _ = self.internal_transactions._transform_traces(trace)
+        self.assertSequenceEqual(
+            internal_columns["parent_error"],
+            [None, None, True, None, True, None, None, True, None]
+        )
+        self.internal_transactions._set_parent_errors.assert_not_called()
+
+    def test_transform_traces_parent_errors_unordered_trace(self):
+        """
+        Test set parent errors for transactions of several ethereum transactions given in arbitrary order
+        """
+        trace = [
+            {"transactionHash": "0x1", "traceAddress": [0, 1, 0]},
+            {"transactionHash": "0x2", "traceAddress": [0, 1]},
+            {"transactionHash": "0x1", "traceAddress": [1]},
+            {"transactionHash": "0x1", "error": "Out of gas", "traceAddress": [0]},
+            {"transactionHash": "0x2", "error": "Out of gas", "traceAddress": [1]},
+            {"transactionHash": "0x1", "error": "Out of gas", "traceAddress": [0, 1]},
+            {"transactionHash": None, "blockHash": "0x3", "traceAddress": []}
+        ]
+        internal_columns, miner_columns = self.internal_transactions._transform_traces(trace)
+        self.assertSequenceEqual(
+            [bool(parent_error) for parent_error in internal_columns["parent_error"]],
+            [True, False, False, False, False, False]
+        )
+        assert miner_columns["parent_error"] == [None]
+
+    def test_transform_traces_keep_input_unordered_trace(self):
+        """
+        Test that transactions are not changed during transformation of trace given in arbitrary order
+        """
+        trace = [
+            {"transactionHash": "0x1", "traceAddress": [0, 0]},
+            {"transactionHash": "0x1", "error": "Out of gas", "traceAddress": [0]}
+        ]
+        self.internal_transactions._transform_traces(trace)
+        assert trace == [
+            {"transactionHash": "0x1", "traceAddress": [0, 0]},
+            {"transactionHash": "0x1", "error": "Out of gas", "traceAddress": [0]}
+        ]
 
     def test_set_parent_error_root_node(self):
         """
@@ -343,68 +537,67 @@ class InternalTransactionsTestCase(unittest.TestCase):
         self.internal_transactions._set_parent_errors(trace)
         assert "parent_error" in trace[-1].keys()
 
-    def test_preprocess_internal_transaction_with_empty_field(self):
-        self.internal_transactions._preprocess_internal_transaction({"action": None})
-        assert True
-
-    def test_preprocess_internal_transaction_value(self):
-        transaction = self.internal_transactions._preprocess_internal_transaction({"value": hex(int(50.001851 * 1e18))})
-        assert transaction["value"] == 50.001851
-
-    def test_preprocess_internal_transaction_gas_used(self):
-        transaction = self.internal_transactions._preprocess_internal_transaction({"gasUsed": hex(10000)})
-        print(transaction["gasUsed"])
-        assert transaction["gasUsed"] == 10000
-
-    def test_preprocess_internal_transaction_gas_price(self):
-        transaction = self.internal_transactions._preprocess_internal_transaction(
-            {"gasPrice": hex(int(10.1 * 10 ** 18))})
-        assert transaction["gasPrice"] == 10.1
-
-    def test_preprocess_internal_transaction_empty_value(self):
-        transaction = self.internal_transactions._preprocess_internal_transaction({"value": "0x"})
-        assert transaction["value"] == 0
+    def test_set_parent_error_unordered_trace(self):
+        """
+        Test set parent errors for transactions of several ethereum transactions given in arbitrary order
+        """
+        trace = [{
+            "transactionHash": "0x1",
+            "traceAddress": [0, 1, 0]
+        }, {
+            "transactionHash": "0x2",
+            "traceAddress": [0, 1]
+        }, {
+            "transactionHash": "0x1",
+            "traceAddress": [1]
+        }, {
+            "transactionHash": "0x1",
+            "error": "Out of gas",
+            "traceAddress": [0]
+        }, {
+            "transactionHash": "0x2",
+            "error": "Out of gas",
+            "traceAddress": [1]
+        }, {
+            "transactionHash": "0x1",
+            "error": "Out of gas",
+            "traceAddress": [0, 1]
+        }]
+        self.internal_transactions._set_parent_errors(trace)
+        self.assertSequenceEqual(
+            ["parent_error" in transaction for transaction in trace],
+            [True, False, False, False, False, False]
+        )
 
     def test_save_internal_transactions(self):
         """
-        Test saving given transactions from trace
+        Test saving given columns of transactions
         """
-        test_trace = [{"transactionHash": "0x0", "hash": "0x0.{}".format(i)} for i in range(10)]
-        test_preprocessed_trace = [{
-            "hash": "0x{}".format(i),
-            "transactionHash": '0x0'
-        } for i in range(10)]
-        test_transactions_ids = [transaction["hash"] for transaction in test_preprocessed_trace]
-        test_transactions_bodies = [{key: value for key, value in transaction.items() if key is not "hash"} for
-                                    transaction in test_preprocessed_trace]
-        self.internal_transactions._preprocess_internal_transaction = MagicMock(side_effect=test_preprocessed_trace)
-
-        self.internal_transactions._save_internal_transactions(test_trace)
-
-        for transaction in test_trace:
-            self.internal_transactions._preprocess_internal_transaction.assert_any_call(transaction)
+        test_columns = {
+            "hash": ["0x0.{}".format(i) for i in range(10)],
+            "transactionHash": ["0x0"] * 10
+        }
+        self.internal_transactions._save_internal_transactions(test_columns)
 
         internal_transactions = self.client.search(index=TEST_INTERNAL_TRANSACTIONS_INDEX, fields=["transactionHash"])
-        internal_transactions_bodies = [transaction["_source"] for transaction in internal_transactions]
-        internal_transactions_ids = [transaction["_id"] for transaction in internal_transactions]
-        self.assertCountEqual(internal_transactions_ids, test_transactions_ids)
-        self.assertCountEqual(internal_transactions_bodies, test_transactions_bodies)
+        self.assertCountEqual([transaction["_id"] for transaction in internal_transactions], test_columns["hash"])
+        self.assertCountEqual([transaction["_source"] for transaction in internal_transactions],
+                              [{"transactionHash": "0x0"}] * 10)
 
-    def test_save_internal_transactions_ignore_rewards(self):
+    def test_save_internal_transactions_skip_empty_columns(self):
         """
-        Test ignoring transactions from trace which are not attached to any ethereum transaction
+        Test skipping insertion if there are no transactions
         """
-        trace = [{"transactionHash": None, "hash": "0x1"}]
-        self.internal_transactions._save_internal_transactions(trace)
-        internal_transactions = self.client.search(index=TEST_INTERNAL_TRANSACTIONS_INDEX, fields=[])
-        assert not len(internal_transactions)
+        self.internal_transactions.client = MagicMock()
+        self.internal_transactions._save_internal_transactions({"hash": [], "transactionHash": []})
+        self.internal_transactions._save_miner_transactions({"hash": [], "transactionHash": []})
+        self.internal_transactions.client.bulk_index_columns.assert_not_called()
 
     def test_save_miner_transaction(self):
         """
-        Test saving transactions which are not attached to any ethereum transaction
+        Test saving columns of transactions which are not attached to any ethereum transaction
         """
-        trace = [{"transactionHash": None, "hash": "0x1"}, {"transactionHash": "0x1"}]
-        self.internal_transactions._save_miner_transactions(trace)
+        self.internal_transactions._save_miner_transactions({"hash": ["0x1"], "transactionHash": [None]})
         miner_transactions = self.client.search(index=TEST_INTERNAL_TRANSACTIONS_INDEX, fields=["transactionHash"])
         assert len(miner_transactions) != 0
         assert miner_transactions[0]["_id"] == "0x1"
@@ -412,125 +605,349 @@ class InternalTransactionsTestCase(unittest.TestCase):
 
     def test_save_genesis(self):
         test_genesis = [{"hash": "1", "to": "0x"}]
-        with open('test_genesis.json', "w") as file:
+        test_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_directory)
+        genesis_path = os.path.join(test_directory, "test_genesis.json")
+        with open(genesis_path, "w") as file:
             file.write(json.dumps(test_genesis))
 
-        self.internal_transactions._save_genesis_block('test_genesis.json')
+        self.internal_transactions._save_genesis_block(genesis_path)
         genesis = self.client.search(index=TEST_INTERNAL_TRANSACTIONS_INDEX, fields=["to"])
 
-        os.remove("test_genesis.json")
-
         assert genesis[0]["_source"]["to"] == "0x"
         assert genesis[0]["_id"] == "1"
 
-    def test_extract_traces_chunk(self):
+    def test_save_traces_chunk(self):
         """
-        Test process of extraction internal transactions by a given blocks chunk
+        Test saving transformed transactions and flags for a given blocks chunk
         """
-        test_blocks = ["0x{}".format(i) for i in range(10)]
-        test_traces = [{"transactionHash": "0x{}".format(i % 3)} for i in range(10)]
-        mockify(self.internal_transactions, {
-            "_get_traces": MagicMock(return_value=test_traces)
-        }, ["_extract_traces_chunk"])
+        test_blocks = [1, 2]
+        test_internal_columns = {"hash": ["0x1.0"]}
+        test_miner_columns = {"hash": ["0x2.0"]}
+        test_headers = [{"number": block} for block in test_blocks]
+        mockify(self.internal_transactions, {}, ["_save_traces_chunk"])
         process = Mock(
-            get_traces=self.internal_transactions._get_traces,
-            set_hashes=self.internal_transactions._set_trace_hashes,
-            save_traces=self.internal_transactions._save_traces,
             save_transactions=self.internal_transactions._save_internal_transactions,
-            save_rewards=self.internal_transactions._save_miner_transactions
+            save_rewards=self.internal_transactions._save_miner_transactions,
+            save_headers=self.internal_transactions._save_headers,
+            save_traces=self.internal_transactions._save_traces
         )
 
-        self.internal_transactions._extract_traces_chunk(test_blocks)
+        self.internal_transactions._save_traces_chunk(test_blocks, (test_internal_columns, test_miner_columns),
+                                                      test_headers)
 
-        calls = [
-            call.get_traces(test_blocks),
-            call.set_hashes(test_traces),
-            call.save_transactions(test_traces),
-            call.save_rewards(test_traces),
+        process.assert_has_calls([
+            call.save_transactions(test_internal_columns),
+            call.save_rewards(test_miner_columns),
+            call.save_headers(test_headers),
             call.save_traces(test_blocks)
-        ]
-        process.assert_has_calls(calls)
+        ])
+
+    def test_save_traces_chunk_save_genesis(self):
+        mockify(self.internal_transactions, {}, ["_save_traces_chunk"])
 
-    def test_extract_traces_chunk_set_parent_error(self):
+        self.internal_transactions._save_traces_chunk([1], ({}, {}))
+        self.internal_transactions._save_genesis_block.assert_not_called()
+
+        self.internal_transactions._save_traces_chunk([0], ({}, {}))
+        self.internal_transactions._save_genesis_block.assert_called_with()
+
+    def test_extract_traces_chunk(self):
         """
-        Test setting parent error in a process of extraction by a given block chunk
+        Test process of extraction internal transactions by a given blocks chunk
         """
-        test_blocks = ["0x1"]
-        test_traces = []
+        test_blocks = ["0x{}".format(i) for i in range(10)]
+        test_traces = [{"transactionHash": "0x{}".format(i % 3)} for i in range(10)]
+        test_headers = ["header"]
+        test_columns = ({"hash": []}, {"hash": []})
         mockify(self.internal_transactions, {
-            "_get_traces": MagicMock(return_value=test_traces)
+            "_get_traces": MagicMock(return_value=(test_traces, test_headers)),
+            "_transform_traces": MagicMock(return_value=test_columns)
         }, ["_extract_traces_chunk"])
         process = Mock(
-            save_errors=self.internal_transactions._set_parent_errors,
-            save_traces=self.internal_transactions._save_internal_transactions
+            get_traces=self.internal_transactions._get_traces,
+            transform=self.internal_transactions._transform_traces,
+            save=self.internal_transactions._save_traces_chunk
         )
 
         self.internal_transactions._extract_traces_chunk(test_blocks)
 
-        calls = [
-            call.save_errors(test_traces),
-            call.save_traces(test_traces)
-        ]
-        process.assert_has_calls(calls)
-
-    def test_extract_traces_chunk_extract_genesis(self):
-        test_blocks = [0]
-        test_traces = []
-        test_blocks_no_genesis = [1]
-        mockify(self.internal_transactions, {
-            "_get_traces": MagicMock(return_value=test_traces)
-        }, ["_extract_traces_chunk"])
-
-        self.internal_transactions._extract_traces_chunk(test_blocks_no_genesis)
-        self.internal_transactions._save_genesis_block.assert_not_called()
-
-        self.internal_transactions._extract_traces_chunk(test_blocks)
-        self.internal_transactions._save_genesis_block.assert_called_with()
+        process.assert_has_calls([
+            call.get_traces(test_blocks),
+            call.transform(test_traces),
+            call.save(test_blocks, test_columns, test_headers)
+        ])
 
     def test_extract_traces(self):
         """
         Test overall extraction process
         """
         test_chunks = [list(range(5)), list(range(5, 10))]
-        test_chunks_from_elasticsearch = [[{"_source": {"number": block}} for block in chunk] for chunk in test_chunks]
-        self.internal_transactions._iterate_blocks = MagicMock(return_value=test_chunks_from_elasticsearch)
-        self.internal_transactions._extract_traces_chunk = MagicMock()
-        process = Mock(
-            iterate=self.internal_transactions._iterate_blocks,
-            extract=self.internal_transactions._extract_traces_chunk
+        test_traces = [["trace" + str(block) for block in chunk] for chunk in test_chunks]
+        test_headers = [["header" + str(block) for block in chunk] for chunk in test_chunks]
+        self.internal_transactions._iterate_traces_chunks = MagicMock(
+            return_value=list(zip(test_chunks, test_traces, test_headers))
         )
+        self.internal_transactions._transform_traces = MagicMock(side_effect=lambda traces: traces)
+        self.internal_transactions._save_traces_chunk = MagicMock()
 
         self.internal_transactions.extract_traces()
 
-        calls = [call.iterate()]
-        for chunk in test_chunks:
-            calls.append(call.extract(chunk))
-        process.assert_has_calls(calls)
+        self.internal_transactions._iterate_traces_chunks.assert_called_with(None)
+        for traces in test_traces:
+            self.internal_transactions._transform_traces.assert_any_call(traces)
+        self.internal_transactions._save_traces_chunk.assert_has_calls([
+            call(chunk, traces, headers) for chunk, traces, headers in zip(test_chunks, test_traces, test_headers)
+        ])
+
+    def test_extract_traces_raise_exception(self):
+        """
+        Test raising exception from any stage of extraction process
+        """
+        self.internal_transactions._iterate_blocks = MagicMock(return_value=[[1]])
+        self.internal_transactions._iterate_traces = MagicMock(side_effect=ValueError)
+        self.internal_transactions._save_traces_chunk = MagicMock()
+
+        with self.assertRaises(ValueError):
+            self.internal_transactions.extract_traces()
+        self.internal_transactions._save_traces_chunk.assert_not_called()
 
     def test_iterate_blocks(self):
         self.internal_transactions.parity_hosts = [(0, 4, "http://localhost:8545"), (5, None, "http://localhost:8545")]
-        blocks = [{'number': i, 'id': i} for i in range(1, 6)]
-        flags = [
-            {'name': 'traces_extracted', 'value': True, "id": 3},
-            {'name': 'traces_extracted', 'value': True, "id": 2},
-            {'name': 'traces_extracted', 'value': None, 'id': 2},
-            {"name": "other_flag", "value": True, "id": 1}
-        ]
-        self.client.bulk_index(index=TEST_BLOCKS_INDEX, docs=blocks)
-        self.client.bulk_index(index=TEST_BLOCKS_TRACES_EXTRACTED_INDEX, docs=flags)
+        self.internal_transactions._get_max_parity_block = MagicMock(return_value=5)
+        self.internal_transactions.block_ranges.add([(3, 4)])
+        self.internal_transactions.block_ranges.add([(2, 3)])
+        self.internal_transactions.block_ranges.remove([(2, 3)])
+        ClickhouseBlockRanges("other_flag", self.indices).add([(1, 2)])
         iterator = self.internal_transactions._iterate_blocks()
         blocks = next(iterator)
-        blocks = [block["_source"]["number"] for block in blocks]
-        self.assertCountEqual(blocks, [1, 2, 5])
+        self.assertCountEqual(blocks, [0, 1, 2, 5])
+
+    def test_iterate_blocks_with_leases(self):
+        self.internal_transactions.parity_hosts = [(0, 4, "http://localhost:8545"), (5, None, "http://localhost:8545")]
+        self.internal_transactions._get_max_parity_block = MagicMock(return_value=5)
+        self.internal_transactions.block_leases = MagicMock()
+        self.internal_transactions._iterate_blocks()
+        self.internal_transactions.block_leases.iterate_unprocessed_blocks.assert_called_with(5, [(0, 4), (5, None)])
+
+    def test_iterate_blocks_within_bounds(self):
+        self.internal_transactions.parity_hosts = [(0, 4, "http://localhost:8545"), (5, None, "http://localhost:8545")]
+        self.internal_transactions._get_max_parity_block = MagicMock(return_value=10)
+        self.internal_transactions.block_leases = MagicMock()
+        self.internal_transactions.block_ranges = MagicMock()
+        self.internal_transactions._iterate_blocks([(3, 8)])
+        self.internal_transactions.block_ranges.iterate_unprocessed_blocks.assert_called_with(10, [(3, 4), (5, 8)])
+        self.internal_transactions.block_leases.iterate_unprocessed_blocks.assert_not_called()
+
+    def test_create_semaphores(self):
+        self.internal_transactions.parity_hosts = [(None, 10, "url1"), (None, None, "url2"), (None, None, "url3")]
+        semaphores = self.internal_transactions.loop.run_until_complete(
+            self.internal_transactions._create_semaphores()
+        )
+        assert list(semaphores.keys()) == [("url1", "url2", "url3"), ("url2", "url3")]
+        self.internal_transactions.semaphores = semaphores
+        with patch("operations.internal_transactions.PARITY_BATCHES_IN_FLIGHT", 2):
+            assert self.internal_transactions._get_batches_in_flight() == 10
+
+    def test_send_jsonrpc_request_routed(self):
+        """
+        Test retrying request on another parity node
+        """
+        def send(url, request, getter):
+            if url == "http://localhost:8545":
+                raise ConnectionError()
+            return [url], 1
+
+        with patch("operations.internal_transactions._send_jsonrpc_request_with_size", MagicMock(side_effect=send)):
+            response = internal_transactions._send_jsonrpc_request_routed(
+                ("http://localhost:8545", "http://localhost:8546"), [], lambda x: x
+            )
+        assert response == (["http://localhost:8546"], 1)
+
+    @httpretty.activate
+    def test_get_max_parity_block_of_group(self):
+        """
+        Test taking blocks available in all parity nodes that serve the same blocks
+        """
+        test_urls = ["http://localhost:8545/", "http://localhost:8546/"]
+        for url, block in zip(test_urls, [100, 50]):
+            httpretty.register_uri(
+                httpretty.POST,
+                url,
+                body=json.dumps([{"id": "block_number", "jsonrpc": "2.0", "result": hex(block)}])
+            )
+        self.internal_transactions.parity_hosts = [(None, None, url) for url in test_urls]
+        assert self.internal_transactions._get_max_parity_block() == 50
+
+    @httpretty.activate
+    def test_get_max_parity_block(self):
+        test_urls = ["http://localhost:8545/", "http://localhost:8546/"]
+        for url, block in zip(test_urls, [100, 50]):
+            httpretty.register_uri(
+                httpretty.POST,
+                url,
+                body=json.dumps([{"id": "block_number", "jsonrpc": "2.0", "result": hex(block)}])
+            )
+        self.internal_transactions.parity_hosts = [(0, 10, test_urls[0]), (10, None, test_urls[1])]
+        assert self.internal_transactions._get_max_parity_block() == 50
+        self.internal_transactions.parity_hosts = [(0, 10, test_urls[0])]
+        assert self.internal_transactions._get_max_parity_block() == 9
+
+    @httpretty.activate
+    def test_get_max_parity_block_skip_failed_node(self):
+        """
+        Test skipping failed and ejected parity nodes
+        """
+        test_urls = ["http://localhost:8545/", "http://localhost:8546/"]
+        httpretty.register_uri(
+            httpretty.POST,
+            test_urls[0],
+            body=json.dumps([{"id": "block_number", "jsonrpc": "2.0", "result": hex(100)}])
+        )
+        httpretty.register_uri(httpretty.POST, test_urls[1], status=502)
+        self.internal_transactions.parity_hosts = [(None, None, url) for url in test_urls]
+        test_router = ParityRouter(eject_errors=1)
+        with patch("operations.internal_transactions.parity_router.get_router", return_value=test_router):
+            assert self.internal_transactions._get_max_parity_block() == 100
+            assert test_router.is_ejected(test_urls[1])
+            assert self.internal_transactions._get_max_parity_block() == 100
+            self.internal_transactions.parity_hosts = [(None, None, test_urls[1])]
+            with self.assertRaises(ConnectionError):
+                self.internal_transactions._get_max_parity_block()
+
+    def test_make_block_header(self):
+        test_block = {
+            "number": "0x10",
+            "hash": "0x1",
+            "timestamp": "0x5",
+            "miner": "0x2",
+            "gasUsed": "0x3",
+            "gasLimit": "0x4",
+            "difficulty": "0x6",
+            "transactions": [{}, {}]
+        }
+        header = _make_block_header(test_block)
+        assert header["id"] == 16
+        assert header["number"] == 16
+        assert header["timestamp"] == datetime.fromtimestamp(5)
+        assert header["gasUsed"] == 3
+        assert header["difficulty"] == 6
+        assert header["baseFeePerGas"] is None
+        assert header["transactionsCount"] == 2
+
+    def test_save_headers(self):
+        test_headers = [{"id": i, "number": i, "hash": "0x{}".format(i)} for i in range(3)]
+        self.internal_transactions._save_headers(test_headers)
+        blocks = self.client.search(index=TEST_BLOCKS_INDEX, fields=["number", "hash"])
+        self.assertCountEqual([block["_source"] for block in blocks], [
+            {"number": header["number"], "hash": header["hash"]} for header in test_headers
+        ])
 
     def test_save_traces(self):
-        self.internal_transactions._save_traces([123])
-        block = \
-            self.client.search(index=TEST_BLOCKS_TRACES_EXTRACTED_INDEX, query="WHERE id = '123'",
-                               fields=["name", "value"])[0][
-                '_source']
-        assert block['value']
-        assert block['name'] == 'traces_extracted'
+        self.internal_transactions._save_traces([123, 124, 126])
+        ranges = ClickhouseBlockRanges("traces_extracted", self.indices).get_ranges()
+        assert ranges == [(123, 125), (126, 127)]
+
+    def _write_dump(self, path, records, open_file=open):
+        with open_file(path, "wt") as dump:
+            for record in records:
+                dump.write(json.dumps(record) + "\n")
+
+    def test_iterate_dump(self):
+        test_directory = tempfile.mkdtemp()
+        try:
+            test_traces = [{"blockNumber": 1}]
+            test_block = {"number": "0x1", "transactions": []}
+            test_records = [test_traces, {"jsonrpc": "2.0", "id": 1, "result": test_block}]
+            for file_name, open_file in [("dump.jsonl", open), ("dump.jsonl.gz", gzip.open)]:
+                path = os.path.join(test_directory, file_name)
+                self._write_dump(path, test_records, open_file)
+                assert list(_iterate_dump(path)) == [(test_traces, None), (None, test_block)]
+        finally:
+            shutil.rmtree(test_directory)
+
+    def test_list_dump_files(self):
+        test_directory = tempfile.mkdtemp()
+        try:
+            for file_name in ["2.jsonl", "1.jsonl.gz"]:
+                open(os.path.join(test_directory, file_name), "w").close()
+            os.mkdir(os.path.join(test_directory, "subdirectory"))
+            test_file = os.path.join(test_directory, "0.jsonl")
+            files = _list_dump_files([test_directory, test_file])
+            assert files == [os.path.join(test_directory, name) for name in ["0.jsonl", "1.jsonl.gz", "2.jsonl"]]
+        finally:
+            shutil.rmtree(test_directory)
+
+    def test_iterate_dump_chunks(self):
+        test_block = {
+            "number": "0x2", "hash": "0x2", "timestamp": "0x5", "miner": "0x0", "gasUsed": "0x0",
+            "gasLimit": "0x0", "difficulty": "0x0",
+            "transactions": [{"hash": "0x10", "blockHash": "0x2", "gasPrice": "0x1", "input": "0x"}]
+        }
+        test_records = [
+            ([{"blockNumber": 1, "transactionHash": "0x9", "blockHash": "0x1"}], None),
+            ([{"blockNumber": 2, "transactionHash": "0x10", "blockHash": "0x2"}], None),
+            (None, test_block),
+            ([{"blockNumber": 3, "transactionHash": None, "blockHash": "0x3"}], None)
+        ]
+        with patch("operations.internal_transactions._iterate_dump", MagicMock(return_value=test_records)):
+            chunks = list(self.internal_transactions._iterate_dump_chunks("dump.jsonl", size=3))
+        assert [chunk[0] for chunk in chunks] == [[1, 2], [3]]
+        assert chunks[0][1][1]["gasPrice"] == "0x1"
+        assert "input" not in chunks[0][1][1]
+        assert [header["number"] for header in chunks[0][2]] == [2]
+        assert chunks[1][2] == []
+
+    def test_iterate_dump_chunks_split_block(self):
+        test_block = {
+            "number": "0x2", "hash": "0x2", "timestamp": "0x5", "miner": "0x0", "gasUsed": "0x0",
+            "gasLimit": "0x0", "difficulty": "0x0",
+            "transactions": [{"hash": "0x10", "blockHash": "0x2", "gasPrice": "0x1", "gas": "0x5"}]
+        }
+        test_records = [
+            ([{"blockNumber": 1, "transactionHash": "0x9", "blockHash": "0x1"}], None),
+            ([{"blockNumber": 2, "transactionHash": "0x10", "blockHash": "0x2"}], None),
+            (None, test_block),
+            ([{"blockNumber": 3, "transactionHash": None, "blockHash": "0x3"}], None)
+        ]
+        with patch("operations.internal_transactions._iterate_dump", MagicMock(return_value=test_records)):
+            chunks = list(self.internal_transactions._iterate_dump_chunks("dump.jsonl", size=2))
+        assert [chunk[0] for chunk in chunks] == [[1, 2], [3]]
+        assert chunks[0][1][1]["gasPrice"] == "0x1"
+        assert [header["number"] for header in chunks[0][2]] == [2]
+
+    def test_import_dump(self):
+        test_traces = [{"transactionHash": "0x1"}]
+        test_columns = ({"hash": ["0x1.0"]}, {"hash": []})
+        test_chunks = [([0, 1], test_traces, ["header"]), ([2], [], [])]
+        mockify(self.internal_transactions, {
+            "_iterate_dump_chunks": MagicMock(return_value=test_chunks),
+            "_transform_traces": MagicMock(return_value=test_columns)
+        }, ["_import_dump"])
+        blocks = self.internal_transactions._import_dump("dump.jsonl")
+        assert blocks == [0, 1, 2]
+        self.internal_transactions._transform_traces.assert_any_call(test_traces)
+        self.internal_transactions._save_genesis_block.assert_called_once_with()
+        self.internal_transactions._save_internal_transactions.assert_any_call(test_columns[0])
+        self.internal_transactions._save_miner_transactions.assert_any_call(test_columns[1])
+        self.internal_transactions._save_headers.assert_any_call(["header"])
+        self.internal_transactions._save_traces.assert_not_called()
+
+    def test_import_traces(self):
+        test_ranges = {"1.jsonl": [(0, 2)], "2.jsonl": [(5, 6)]}
+        pool = MagicMock()
+        pool.__enter__.return_value.imap_unordered.side_effect = lambda function, files: map(function, files)
+        import_dump_file = MagicMock(side_effect=lambda path: (path, test_ranges[path]))
+        self.internal_transactions._save_ranges = MagicMock()
+        with patch("operations.internal_transactions.Pool", MagicMock(return_value=pool)), \
+                patch("operations.internal_transactions._import_dump_file", import_dump_file):
+            self.internal_transactions.import_traces(["2.jsonl", "1.jsonl"])
+        self.internal_transactions._save_ranges.assert_has_calls([call([(0, 2)]), call([(5, 6)])])
+
+    def test_save_ranges(self):
+        self.internal_transactions._save_ranges([(1, 3), (5, 6)])
+        ranges = ClickhouseBlockRanges("traces_extracted", self.indices).get_ranges()
+        assert ranges == [(1, 3), (5, 6)]
 
     @parity
     def test_process(self):
@@ -563,3 +980,4 @@ TEST_TRANSACTION_HASH = '0x38a999ebba98a14a67ea7a83921e3e58d04a29fc55adfa124a985
 TEST_TRANSACTION_INPUT = '0xb1631db29e09ec5581a0ec398f1229abaf105d3524c49727621841af947bdc44'
 TEST_INCORRECT_TRANSACTION_HASH = "0x"
 TEST_BLOCKS_TRACES_EXTRACTED_INDEX = "test_ethereum_block_traces_extracted"
+TEST_BLOCK_RANGES_INDEX = "test_ethereum_block_range"
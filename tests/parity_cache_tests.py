@@ -0,0 +1,139 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from unittest.mock import patch
+from clients.parity_cache import ResponseCache, get_key, get_block, get_logs_range
+
+
+def _make_logs_request(start, end):
+    return {
+        "id": "logs",
+        "method": "eth_getLogs",
+        "params": [{"fromBlock": hex(start), "toBlock": hex(end - 1)}]
+    }
+
+
+class ParityCacheFunctionsTestCase(unittest.TestCase):
+    def test_get_key(self):
+        test_request = {"id": 1, "method": "trace_block", "params": ["0x10"]}
+        assert get_key(test_request) == 'trace_block["0x10"]'
+
+    def test_get_key_ignore_id(self):
+        test_request = {"id": 1, "method": "eth_getBlockByNumber", "params": ["0x10", True]}
+        assert get_key(test_request) == get_key(dict(test_request, id=2))
+
+    def test_get_key_not_cached(self):
+        assert get_key({"id": 1, "method": "eth_blockNumber", "params": []}) is None
+        assert get_key({"id": 1, "method": "trace_block", "params": ["latest"]}) is None
+        assert get_key({"id": 1, "method": "eth_getLogs", "params": [{"fromBlock": "0x1"}]}) is None
+
+    def test_get_block(self):
+        assert get_block({"id": 1, "method": "trace_block", "params": ["0x10"]}) == 16
+        assert get_block(_make_logs_request(5, 20)) == 19
+
+    def test_get_logs_range(self):
+        assert get_logs_range(_make_logs_request(5, 20)) == (5, 20)
+        test_request = _make_logs_request(5, 20)
+        test_request["params"][0]["address"] = "0x1"
+        assert get_logs_range(test_request) is None
+
+
+def _make_key(block):
+    return get_key({"id": 1, "method": "trace_block", "params": [hex(block)]})
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.path)
+
+    def _reopen(self):
+        self.cache.close()
+        self.cache = ResponseCache(self.path)
+
+    def test_put_get(self):
+        self.cache.put(_make_key(1), '{"test": 1}')
+        self.cache.put(_make_key(2), '[]')
+        assert self.cache.get(_make_key(1)) == '{"test": 1}'
+        assert self.cache.get(_make_key(2)) == '[]'
+        assert self.cache.get(_make_key(3)) is None
+
+    def test_reopen(self):
+        self.cache.put(_make_key(1), '{"test": 1}')
+        self._reopen()
+        assert self.cache.get(_make_key(1)) == '{"test": 1}'
+
+    def test_reopen_without_loading_index(self):
+        for block in [5, 1, 3, 10, 7]:
+            self.cache.put(_make_key(block), json.dumps(block))
+        self.cache.put(get_key({"id": 1, "method": "eth_getBlockByNumber", "params": ["0x3", False]}), '"block"')
+        self._reopen()
+        assert self.cache._index == {}
+        assert [self.cache.get(_make_key(block)) for block in [1, 3, 5, 7, 10]] == ["1", "3", "5", "7", "10"]
+        assert self.cache.get(_make_key(4)) is None
+        assert self.cache.get(_make_key(100)) is None
+        assert self.cache.get(get_key({"id": 1, "method": "eth_getBlockByNumber", "params": ["0x3", False]})) \
+            == '"block"'
+
+    def test_skip_incomplete_records(self):
+        self.cache.put(_make_key(1), '"value1"')
+        self.cache.put(_make_key(2), '"value2"')
+        segment = [file_name for file_name in os.listdir(self.path) if file_name.endswith(".seg")][0]
+        segment_path = os.path.join(self.path, segment)
+        with open(segment_path, "r+b") as segment_file:
+            segment_file.truncate(os.path.getsize(segment_path) - 1)
+        cache = ResponseCache(self.path)
+        assert cache.get(_make_key(1)) == '"value1"'
+        assert cache.get(_make_key(2)) is None
+
+    def test_finish_segments_of_stopped_processes(self):
+        self.cache.put(_make_key(1), '"value1"')
+        with patch("clients.parity_cache._is_process_alive", return_value=False):
+            cache = ResponseCache(self.path)
+        assert cache._index == {}
+        assert cache.get(_make_key(1)) == '"value1"'
+        assert len([file_name for file_name in os.listdir(self.path) if file_name.endswith(".sidx")]) == 1
+
+    def test_split_segments(self):
+        self.cache.segment_max_size = 1
+        for i in range(3):
+            self.cache.put(_make_key(i), json.dumps(i))
+        assert len([file_name for file_name in os.listdir(self.path) if file_name.endswith(".seg")]) == 3
+        assert [self.cache.get(_make_key(i)) for i in range(3)] == ["0", "1", "2"]
+        self._reopen()
+        assert [self.cache.get(_make_key(i)) for i in range(3)] == ["0", "1", "2"]
+
+    def _put_logs(self, start, end, blocks):
+        logs = [{"blockNumber": hex(block), "logIndex": "0x0"} for block in blocks]
+        self.cache.put(get_key(_make_logs_request(start, end)), json.dumps(logs))
+
+    def test_get_logs(self):
+        self._put_logs(0, 10, [1, 5, 9])
+        self._put_logs(10, 20, [10, 15])
+        self._put_logs(5, 15, [5, 9, 10])
+        logs = self.cache.get_logs(3, 17)
+        assert [int(log["blockNumber"], 16) for log in logs] == [5, 9, 10, 15]
+
+    def test_get_logs_from_finished_segments(self):
+        self.cache.segment_max_size = 1
+        self._put_logs(0, 10, [1, 5, 9])
+        self._put_logs(5, 15, [5, 9, 10])
+        self._reopen()
+        self._put_logs(10, 20, [10, 15])
+        logs = self.cache.get_logs(3, 17)
+        assert [int(log["blockNumber"], 16) for log in logs] == [5, 9, 10, 15]
+
+    def test_get_logs_not_covered(self):
+        self._put_logs(0, 10, [1])
+        self._put_logs(11, 20, [15])
+        assert self.cache.get_logs(5, 15) is None
+        assert self.cache.get_logs(25, 30) is None
+        self._reopen()
+        assert self.cache.get_logs(5, 15) is None
+        assert [int(log["blockNumber"], 16) for log in self.cache.get_logs(12, 20)] == [15]
@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from threading import Event, Thread
+from clients.parity_router import ParityRouter, get_urls, get_groups
+
+
+class ParityRouterFunctionsTestCase(unittest.TestCase):
+    def test_get_urls(self):
+        parity_hosts = [
+            (0, 100, "url1"),
+            (100, 200, "url2"),
+            (None, None, "url3")
+        ]
+        assert get_urls(parity_hosts, 1) == ("url1", "url3")
+        assert get_urls(parity_hosts, 101) == ("url2", "url3")
+        assert get_urls(parity_hosts, 1000) == ("url3",)
+
+    def test_get_urls_not_served(self):
+        assert get_urls([(10, 100, "url1")], 5) == ()
+
+    def test_get_groups(self):
+        parity_hosts = [
+            (None, 10, "url1"),
+            (10, None, "url2"),
+            (None, None, "url3")
+        ]
+        assert get_groups(parity_hosts) == [("url1", "url3"), ("url2", "url3")]
+
+
+class ParityRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.router = ParityRouter(eject_errors=2, eject_time=30)
+
+    def test_call(self):
+        send = MagicMock(return_value="result")
+        assert self.router.call(["url1"], send) == "result"
+        send.assert_called_with("url1")
+        assert self.router.nodes["url1"].outstanding == 0
+
+    def test_call_least_outstanding(self):
+        """
+        Test sending request to a node with less requests in flight
+        """
+        started = Event()
+        finish = Event()
+
+        def slow_send(url):
+            started.set()
+            finish.wait()
+
+        thread = Thread(target=self.router.call, args=(["url1", "url2"], slow_send))
+        thread.start()
+        started.wait()
+        busy_url = [url for url, node in self.router.nodes.items() if node.outstanding][0]
+        chosen_url = self.router.call(["url1", "url2"], lambda url: url)
+        finish.set()
+        thread.join()
+        assert chosen_url != busy_url
+
+    def test_call_prefer_fast_node(self):
+        self.router.call(["url1", "url2"], lambda url: None)
+        self.router.nodes["url1"].latency = 2
+        self.router.nodes["url2"].latency = 1
+        assert self.router.call(["url1", "url2"], lambda url: url) == "url2"
+
+    def test_call_retry_on_another_node(self):
+        def send(url):
+            if url == "url1":
+                raise ConnectionError()
+            return url
+
+        self.router.call(["url1", "url2"], lambda url: None)
+        self.router.nodes["url2"].latency = 1
+        assert self.router.call(["url1", "url2"], send) == "url2"
+        assert self.router.nodes["url1"].errors == 1
+
+    def test_call_raise_error_of_last_node(self):
+        send = MagicMock(side_effect=[ConnectionError(), ValueError()])
+        with self.assertRaises(ValueError):
+            self.router.call(["url1", "url2"], send)
+        assert send.call_count == 2
+
+    def test_call_passthrough_errors(self):
+        send = MagicMock(side_effect=TimeoutError())
+        with self.assertRaises(TimeoutError):
+            self.router.call(["url1", "url2"], send, passthrough_errors=(TimeoutError,))
+        send.assert_called_once()
+        assert not any(node.errors for node in self.router.nodes.values())
+
+    def test_eject_failing_node(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.router.call(["url1"], MagicMock(side_effect=ConnectionError()))
+        assert self.router.get_stats()["url1"]["ejected"]
+        assert self.router.is_ejected("url1")
+        assert not self.router.is_ejected("url2")
+        assert self.router.get_stats()["url1"]["error_rate"] == 1
+        self.router.nodes["url2"] = self.router._get_node("url2")
+        self.router.nodes["url2"].outstanding = 10
+        assert self.router.call(["url1", "url2"], lambda url: url) == "url2"
+
+    def test_return_ejected_node(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.router.call(["url1"], MagicMock(side_effect=ConnectionError()))
+        with patch("clients.parity_router.time.monotonic", MagicMock(return_value=10 ** 9)):
+            assert not self.router.get_stats()["url1"]["ejected"]
+
+    def test_call_all_nodes_ejected(self):
+        self.router._get_node("url1").ejected_until = 10 ** 9 + 2
+        self.router._get_node("url2").ejected_until = 10 ** 9 + 1
+        assert self.router.call(["url1", "url2"], lambda url: url) == "url2"
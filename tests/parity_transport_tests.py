@@ -0,0 +1,128 @@
+import unittest
+from clients import parity_transport
+from clients.parity_transport import create_session, get_session, post, create_web3, iterate_json_array, \
+    iterate_jsonrpc_responses
+from clients.parity_cache import ResponseCache
+import tempfile
+import shutil
+import httpretty
+import json
+from unittest.mock import patch, MagicMock
+
+TEST_PARITY_URL = "http://localhost:8545/"
+
+
+class ParityTransportTestCase(unittest.TestCase):
+    def test_get_session(self):
+        """Test reusing one session within a process"""
+        assert get_session() is get_session()
+
+    def test_get_session_after_fork(self):
+        """Test creating new session in a forked process"""
+        session = get_session()
+        with patch("os.getpid", return_value=-1):
+            assert get_session() is not session
+
+    def test_create_session_pool_size(self):
+        test_pool_size = 3
+        session = create_session(pool_size=test_pool_size)
+        adapter = session.get_adapter(TEST_PARITY_URL)
+        assert adapter._pool_maxsize == test_pool_size
+        assert adapter._pool_block
+
+    def test_create_session_gzip(self):
+        assert "gzip" in create_session(gzip=True).headers["accept-encoding"]
+        assert create_session(gzip=False).headers["accept-encoding"] == "identity"
+
+    @httpretty.activate
+    def test_post(self):
+        test_response = [{"id": 1, "result": "0x1"}]
+        httpretty.register_uri(httpretty.POST, TEST_PARITY_URL, body=json.dumps(test_response))
+        response = post(TEST_PARITY_URL, json.dumps([{"id": 1}]))
+        assert response.json() == test_response
+        assert httpretty.last_request().headers["content-type"] == "application/json"
+
+    def _make_streamed_response(self, body, chunk_size):
+        body = body.encode()
+        response = MagicMock()
+        response.iter_content.return_value = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        return response
+
+    def test_iterate_json_array(self):
+        test_responses = [{"id": i, "result": [{"trace": "ä" * i, "output": "]"}] * i} for i in range(20)]
+        body = json.dumps(test_responses, ensure_ascii=False, indent=2)
+        for chunk_size in [1, 7, 100, len(body)]:
+            elements = list(iterate_json_array(self._make_streamed_response(body, chunk_size)))
+            self.assertSequenceEqual([element for element, size in elements], test_responses)
+
+    def test_iterate_json_array_size(self):
+        test_responses = [{"id": 1}, {"id": 22}]
+        elements = list(iterate_json_array(self._make_streamed_response(json.dumps(test_responses), 3)))
+        self.assertSequenceEqual([size for element, size in elements], [9, 10])
+
+    def test_iterate_json_array_incomplete(self):
+        with self.assertRaises(ValueError):
+            list(iterate_json_array(self._make_streamed_response('[{"id": 1}, {"id"', 3)))
+
+    def test_iterate_json_array_not_array(self):
+        test_body = '{"jsonrpc": "2.0", "error": {"code": -32600, "message": "batch is too big"}, "id": null}'
+        with self.assertRaisesRegex(ValueError, "not an array: .*batch is too big"):
+            list(iterate_json_array(self._make_streamed_response(test_body, 3)))
+
+    @httpretty.activate
+    def test_post_stream(self):
+        test_response = [{"id": 1, "result": "0x1"}]
+        httpretty.register_uri(httpretty.POST, TEST_PARITY_URL, body=json.dumps(test_response))
+        response = post(TEST_PARITY_URL, json.dumps([{"id": 1}]), stream=True)
+        self.assertSequenceEqual([element for element, size in iterate_json_array(response)], test_response)
+
+    @httpretty.activate
+    def test_iterate_jsonrpc_responses_without_cache(self):
+        test_response = [{"id": 1, "result": "0x1"}]
+        httpretty.register_uri(httpretty.POST, TEST_PARITY_URL, body=json.dumps(test_response))
+        with patch.object(parity_transport.parity_cache, "get_cache", return_value=None):
+            responses = list(iterate_jsonrpc_responses(TEST_PARITY_URL, [{"id": 1, "method": "trace_block"}]))
+        self.assertSequenceEqual([response for response, size in responses], test_response)
+
+    @httpretty.activate
+    def test_iterate_jsonrpc_responses_with_cache(self):
+        test_requests = [
+            {"id": "trace_{}".format(block), "method": "trace_block", "params": [hex(block)]}
+            for block in [5, 10]
+        ]
+
+        def respond(request, uri, headers):
+            return 200, headers, json.dumps([
+                {"id": request_item["id"], "result": [request_item["params"][0]]}
+                for request_item in json.loads(request.body)
+            ])
+
+        httpretty.register_uri(httpretty.POST, TEST_PARITY_URL, body=respond)
+        path = tempfile.mkdtemp()
+        cache = ResponseCache(path)
+        try:
+            with patch.object(parity_transport.parity_cache, "get_cache", return_value=cache), \
+                 patch.object(parity_transport, "_get_confirmed_block", return_value=5):
+                list(iterate_jsonrpc_responses(TEST_PARITY_URL, test_requests))
+                test_requests[0]["id"] = "another_id"
+                responses = list(iterate_jsonrpc_responses(TEST_PARITY_URL, test_requests))
+            self.assertCountEqual([response for response, size in responses], [
+                {"jsonrpc": "2.0", "id": "another_id", "result": ["0x5"]},
+                {"id": "trace_10", "result": ["0xa"]}
+            ])
+            self.assertSequenceEqual(json.loads(httpretty.last_request().body), test_requests[1:])
+        finally:
+            cache.close()
+            shutil.rmtree(path)
+
+    @httpretty.activate
+    def test_create_web3(self):
+        httpretty.register_uri(
+            httpretty.POST,
+            TEST_PARITY_URL,
+            body=json.dumps({"id": 0, "jsonrpc": "2.0", "result": hex(100)})
+        )
+        w3 = create_web3(TEST_PARITY_URL)
+        with patch.object(parity_transport, "get_session", wraps=get_session) as get_session_mock:
+            assert w3.eth.blockNumber == 100
+            get_session_mock.assert_called_with()
@@ -1,5 +1,5 @@
 import unittest
-from operations.indices import ClickhouseIndices
+from operations.indices import ClickhouseIndices, make_partition_key
 from tests.test_utils import TestClickhouse
 from datetime import datetime
 
@@ -178,6 +178,22 @@ class ClickhouseIndicesTestCase(unittest.TestCase):
         self.client.send_sql_request("CREATE TABLE {} (id String) ENGINE = MergeTree() ORDER BY id".format(TEST_INDEX))
         self.indices._create_index(TEST_INDEX)
 
+    def test_create_index_add_missing_fields(self):
+        self.indices._create_index(TEST_INDEX, {"x": "Int32"})
+        self.indices._create_index(TEST_INDEX, {"x": "Int32", "y": "Nullable(String)"})
+        self.client.bulk_index(index=TEST_INDEX, docs=[{"id": 1, "x": 10, "y": "test"}])
+        result = self.client.search(index=TEST_INDEX, query=None, fields=["y"])
+        assert result[0]["_source"]["y"] == "test"
+
+    def test_create_partitioned_index(self):
+        self.indices._create_index(TEST_INDEX, {"blockNumber": "Int64"}, partition_field="blockNumber")
+        partition_key = self.client.send_sql_request(
+            "SELECT partition_key FROM system.tables WHERE database = currentDatabase() AND name = '{}'".format(
+                TEST_INDEX
+            )
+        )
+        assert partition_key == make_partition_key("blockNumber")
+
     def test_create_blocks_index(self):
         self.indices.prepare_indices()
         self.client.bulk_index(index=TEST_INDICES["block"], docs=self._test_blocks, id_field="number")
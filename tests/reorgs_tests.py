@@ -0,0 +1,132 @@
+import unittest
+from unittest.mock import MagicMock, patch, call
+from operations.reorgs import ClickhouseReorgs
+
+TEST_INDICES = {
+    "block": "test_ethereum_block",
+    "block_range": "test_ethereum_block_range",
+    "internal_transaction": "test_ethereum_internal_transaction",
+    "event": "test_ethereum_event",
+    "transaction_input": "test_ethereum_transaction_input",
+    "contract_block": "test_ethereum_contract_block"
+}
+
+
+class ClickhouseReorgsTestCase(unittest.TestCase):
+    def setUp(self):
+        with patch("operations.reorgs.CustomClickhouse"):
+            self.reorgs = ClickhouseReorgs(TEST_INDICES, [(None, None, "http://localhost:8545")], depth=3)
+        self.client = self.reorgs.client
+
+    def _set_hashes(self, stored_hashes, parity_hashes):
+        self.reorgs._get_stored_hashes = MagicMock(side_effect=lambda start, end: {
+            block: hash for block, hash in stored_hashes.items() if start <= block < end
+        })
+        self.reorgs._get_parity_hashes = MagicMock(side_effect=lambda blocks: {
+            block: parity_hashes[block] for block in blocks if block in parity_hashes
+        })
+
+    def test_get_stored_hashes(self):
+        self.client.search.return_value = [{"_id": "1", "_source": {"number": 1, "hash": "0x1"}}]
+        assert self.reorgs._get_stored_hashes(0, 3) == {1: "0x1"}
+        self.client.search.assert_called_with(
+            index=TEST_INDICES["block"],
+            fields=["number", "hash"],
+            query="WHERE number >= 0 AND number < 3 AND hash IS NOT NULL"
+        )
+
+    def test_get_parity_hashes(self):
+        test_headers = [{"number": "0x1", "hash": "0x1"}, None]
+        with patch("operations.reorgs._send_jsonrpc_request_routed", return_value=(test_headers, 0)) as send_mock:
+            assert self.reorgs._get_parity_hashes([1, 2]) == {1: "0x1"}
+        assert send_mock.call_args[0][0] == ("http://localhost:8545",)
+        assert [request["params"][0] for request in send_mock.call_args[0][1]] == ["0x1", "0x2"]
+
+    def test_find_fork_block_without_reorg(self):
+        test_hashes = {block: "0x{}".format(block) for block in range(10)}
+        self._set_hashes(test_hashes, test_hashes)
+        assert self.reorgs.find_fork_block(9) is None
+        self.reorgs._get_stored_hashes.assert_called_once_with(7, 10)
+
+    def test_find_fork_block(self):
+        test_hashes = {block: "0x{}".format(block) for block in range(10)}
+        self._set_hashes(test_hashes, {**test_hashes, 8: "0xa", 9: "0xb"})
+        assert self.reorgs.find_fork_block(9) == 8
+
+    def test_find_fork_block_deeper_than_depth(self):
+        test_hashes = {block: "0x{}".format(block) for block in range(10)}
+        parity_hashes = {block: "0x{}".format(block) for block in range(5)}
+        self._set_hashes(test_hashes, parity_hashes)
+        assert self.reorgs.find_fork_block(9) == 5
+        self.reorgs._get_stored_hashes.assert_has_calls([call(7, 10), call(4, 7)])
+
+    def _send_sql_request(self, sql, settings=None, partitions=None):
+        if sql.startswith("EXISTS TABLE"):
+            return 1
+        if "system.tables" in sql:
+            return (sql.split("name = '")[1].split("'")[0], "intDiv(number, 10)" if partitions else "")
+        if sql.startswith("WITH"):
+            return 1
+        if "system.parts" in sql:
+            return partitions
+
+    def _get_sql_requests(self):
+        return [args[0] for args, kwargs in self.client.send_sql_request.call_args_list]
+
+    def test_rollback(self):
+        self.client.send_sql_request.side_effect = self._send_sql_request
+        self.client.search.return_value = []
+        self.reorgs.block_ranges = [MagicMock(), MagicMock()]
+        self.reorgs.block_ranges[0].get_max_block.return_value = 20
+        self.reorgs.block_ranges[1].get_max_block.return_value = 5
+        self.reorgs.rollback(10)
+        self.client.send_sql_request.assert_any_call(
+            "ALTER TABLE test_ethereum_block DELETE WHERE number >= 10"
+        )
+        self.client.send_sql_request.assert_any_call(
+            "ALTER TABLE test_ethereum_internal_transaction DELETE WHERE blockNumber >= 10"
+        )
+        self.client.send_sql_request.assert_any_call(
+            "ALTER TABLE test_ethereum_event DELETE WHERE blockNumber >= 10"
+        )
+        self.reorgs.block_ranges[0].remove.assert_called_with([(10, 21)])
+        self.reorgs.block_ranges[1].remove.assert_not_called()
+
+    def test_rollback_partitions(self):
+        self.client.send_sql_request.side_effect = lambda sql, settings=None: self._send_sql_request(
+            sql, partitions=["0", "1", "2", "3"]
+        )
+        self.reorgs._delete_rows("test_ethereum_block", "number", 15)
+        assert [sql for sql in self._get_sql_requests() if "ALTER" in sql] == [
+            "ALTER TABLE test_ethereum_block DROP PARTITION 2",
+            "ALTER TABLE test_ethereum_block DROP PARTITION 3",
+            "ALTER TABLE test_ethereum_block DELETE IN PARTITION 1 WHERE number >= 15"
+        ]
+        assert "WITH 15 AS number SELECT intDiv(number, 10)" in self._get_sql_requests()
+
+    def test_rollback_missing_partition(self):
+        self.client.send_sql_request.side_effect = lambda sql, settings=None: self._send_sql_request(sql, partitions=["0"])
+        self.reorgs._delete_rows("test_ethereum_block", "number", 15)
+        assert not [sql for sql in self._get_sql_requests() if "ALTER" in sql]
+
+    def test_rollback_inputs(self):
+        self.client.send_sql_request.side_effect = self._send_sql_request
+        self.reorgs.block_ranges = []
+        self.reorgs.rollback(10)
+        sql_requests = self._get_sql_requests()
+        input_request = "ALTER TABLE test_ethereum_transaction_input DELETE WHERE id IN " \
+                        "(SELECT id FROM test_ethereum_internal_transaction WHERE blockNumber >= 10)"
+        assert [sql for sql in sql_requests if "transaction_input DELETE" in sql] == [input_request]
+        self.client.send_sql_request.assert_any_call(input_request, settings={"mutations_sync": 1})
+        assert sql_requests.index(input_request) < sql_requests.index(
+            "ALTER TABLE test_ethereum_internal_transaction DELETE WHERE blockNumber >= 10"
+        )
+        self.client.send_sql_request.assert_any_call(
+            "ALTER TABLE test_ethereum_contract_block UPDATE value = 9 WHERE value >= 10"
+        )
+
+    def test_rollback_skip_missing_tables(self):
+        self.client.send_sql_request.return_value = 0
+        self.reorgs.block_ranges = []
+        self.reorgs.rollback(10)
+        assert not [sql for sql in self._get_sql_requests() if "ALTER" in sql]
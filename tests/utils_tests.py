@@ -1,10 +1,12 @@
 import unittest
-from utils import split_on_chunks, make_range_query, repeat_on_exception
+from utils import split_on_chunks, make_range_query, repeat_on_exception, run_pipeline
 from utils import ClickhouseContractTransactionsIterator
 from tests.test_utils import TestClickhouse
 import config
 from unittest.mock import MagicMock, ANY
+from time import sleep
 from clients.custom_clickhouse import CustomClickhouse
+from operations.block_ranges import ClickhouseBlockRanges
 
 
 class UtilsTestCase(unittest.TestCase):
@@ -40,6 +42,63 @@ class UtilsTestCase(unittest.TestCase):
         with self.assertRaises(KeyboardInterrupt):
             keyboard_interrupt()
 
+    def test_run_pipeline(self):
+        test_items = list(range(10))
+        result = run_pipeline(test_items, [lambda x: x * 2, lambda x: x + 1], queue_size=2)
+        self.assertSequenceEqual(list(result), [x * 2 + 1 for x in test_items])
+
+    def test_run_pipeline_overlap_stages(self):
+        started = []
+
+        def first_stage(item):
+            started.append(item)
+            return item
+
+        result = run_pipeline(range(10), [first_stage], queue_size=1)
+        next(result)
+        sleep(0.5)
+        assert len(started) > 1
+        assert len(started) < 10
+
+    def test_run_pipeline_raise_exception(self):
+        def failing_stage(item):
+            if item == 2:
+                raise ValueError()
+            return item
+
+        result = run_pipeline(range(10), [failing_stage], queue_size=2)
+        assert next(result) == 0
+        assert next(result) == 1
+        with self.assertRaises(ValueError):
+            next(result)
+
+    def _generate_items(self, closed):
+        try:
+            for item in range(100):
+                yield item
+        finally:
+            closed.append(True)
+
+    def test_run_pipeline_close_source_on_exception(self):
+        closed = []
+
+        def failing_stage(item):
+            if item == 2:
+                raise ValueError()
+            return item
+
+        result = run_pipeline(self._generate_items(closed), [failing_stage], queue_size=2)
+        with self.assertRaises(ValueError):
+            list(result)
+        assert closed == [True]
+
+    def test_run_pipeline_close_source_on_consumer_stop(self):
+        closed = []
+        result = run_pipeline(self._generate_items(closed), [lambda x: x], queue_size=2)
+        assert next(result) == 0
+        result.close()
+        assert closed == [True]
+
 class ClickhouseIteratorTestCase(unittest.TestCase):
     client_class = CustomClickhouse
     iterator_class = ClickhouseContractTransactionsIterator
@@ -51,7 +110,8 @@ class ClickhouseIteratorTestCase(unittest.TestCase):
             "contract": TEST_CONTRACTS_INDEX,
             "internal_transaction": TEST_TRANSACTIONS_INDEX,
             "contract_block": TEST_CONTRACT_BLOCK_INDEX,
-            "block_flag": TEST_BLOCK_FLAGS_INDEX
+            "block_flag": TEST_BLOCK_FLAGS_INDEX,
+            "block_range": TEST_BLOCK_RANGES_INDEX
         }
         self.client.prepare_indices(self.indices)
         self._create_contracts_iterator()
@@ -319,15 +379,31 @@ class ClickhouseIteratorTestCase(unittest.TestCase):
         assert type(max_block) == int
 
     def test_get_max_block_by_a_query(self):
-        block_flags = [{
-            "id": 0,
-            "name": "trace",
-            "value": True
-        }]
-        self.client.bulk_index(index=TEST_BLOCK_FLAGS_INDEX, docs=block_flags)
+        ClickhouseBlockRanges("trace", self.indices).add([(0, 3)])
+        ClickhouseBlockRanges("other_trace", self.indices).add([(0, 5)])
+        max_block = self.contracts_iterator._get_max_block({"trace": 1})
+        assert max_block == 2
+
+    def test_get_max_block_before_gap(self):
+        ClickhouseBlockRanges("trace", self.indices).add([(0, 3), (5, 10)])
+        max_block = self.contracts_iterator._get_max_block({"trace": 1})
+        assert max_block == 2
+
+    def test_get_max_block_without_first_blocks(self):
+        ClickhouseBlockRanges("trace", self.indices).add([(5, 10)])
         max_block = self.contracts_iterator._get_max_block({"trace": 1})
         assert max_block == 0
 
+    def test_get_max_block_from_min_consistent_block(self):
+        ClickhouseBlockRanges("trace", self.indices).add([(5, 10), (11, 20)])
+        max_block = self.contracts_iterator._get_max_block({"trace": 1}, 5)
+        assert max_block == 9
+
+    def test_get_max_block_before_min_consistent_block(self):
+        ClickhouseBlockRanges("trace", self.indices).add([(5, 10)])
+        max_block = self.contracts_iterator._get_max_block({"trace": 1}, 3)
+        assert max_block == 3
+
     def test_get_max_block_in_empty_index(self):
         max_block = self.contracts_iterator._get_max_block({}, 1)
         assert max_block == 1
@@ -383,6 +459,7 @@ class ClickhouseIteratorTestCase(unittest.TestCase):
 
 TEST_BLOCKS_INDEX = "test_ethereum_blocks"
 TEST_BLOCK_FLAGS_INDEX = "test_ethereum_block_flags"
+TEST_BLOCK_RANGES_INDEX = "test_ethereum_block_ranges"
 TEST_CONTRACTS_INDEX = "test_ethereum_contract"
 TEST_TRANSACTIONS_INDEX = "test_ethereum_transaction"
 TEST_CONTRACT_BLOCK_INDEX = "test_ethereum_contract_flags"
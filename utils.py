@@ -1,5 +1,9 @@
 from config import INDICES, PROCESSED_CONTRACTS
 from time import sleep
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+
+_PIPELINE_END = object()
 
 
 def generate_sql_for_value(field):
@@ -92,6 +96,139 @@ def split_on_chunks(iterable, size):
         yield elements
 
 
+class _PipelineError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def make_columns(docs):
+    """
+    Convert list of documents to columns
+
+    Parameters
+    ----------
+    docs : list
+        List of dicts
+    Returns
+    -------
+    dict
+        Each field found in documents and list of its values.
+        Value is None for documents without this field
+    """
+    fields = {field for doc in docs for field in doc}
+    return {field: [doc.get(field) for doc in docs] for field in fields}
+
+
+def _put_to_pipeline(queue, item, stop_event):
+    """
+    Put item to a bounded queue, waiting for free space until pipeline is stopped
+
+    Returns
+    -------
+    bool
+        True if item was put into queue
+    """
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get_from_pipeline(queue, stop_event):
+    """
+    Get item from a queue, waiting for it until pipeline is stopped
+
+    Returns
+    -------
+    object
+        Next item of queue, or end marker if pipeline is stopped
+    """
+    while not stop_event.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Empty:
+            pass
+    return _PIPELINE_END
+
+
+def _feed_pipeline(source, output_queue, stop_event):
+    """
+    Put each item of given iterable to the first queue of pipeline
+
+    Source generator is closed once pipeline is stopped,
+    so it can release resources held for items that will not be processed
+    """
+    try:
+        for item in source:
+            if not _put_to_pipeline(output_queue, item, stop_event):
+                return
+        _put_to_pipeline(output_queue, _PIPELINE_END, stop_event)
+    except Exception as exception:
+        _put_to_pipeline(output_queue, _PipelineError(exception), stop_event)
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+
+
+def _run_pipeline_stage(function, input_queue, output_queue, stop_event):
+    """Apply given function to each item from input queue and put results to output queue"""
+    try:
+        for item in iter(lambda: _get_from_pipeline(input_queue, stop_event), _PIPELINE_END):
+            if isinstance(item, _PipelineError):
+                _put_to_pipeline(output_queue, item, stop_event)
+                return
+            if not _put_to_pipeline(output_queue, function(item), stop_event):
+                return
+        _put_to_pipeline(output_queue, _PIPELINE_END, stop_event)
+    except Exception as exception:
+        _put_to_pipeline(output_queue, _PipelineError(exception), stop_event)
+
+
+def run_pipeline(source, stages, queue_size):
+    """
+    Process items of given iterable through several stages running concurrently
+
+    Each stage works in a separate thread and passes results to the next one through a bounded queue,
+    so the fast stages wait for the slow ones instead of accumulating items in memory
+
+    Parameters
+    ----------
+    source : generator
+        Iterable with items to process
+    stages : list
+        Functions applied to each item one by one
+    queue_size : int
+        Max number of items waiting between two stages
+
+    Returns
+    -------
+    generator
+        Generator that returns items processed by all stages in order of source.
+        Exception raised in any stage is raised by the generator.
+        Once the generator is finished or closed, source generator is closed as well
+    """
+    stop_event = Event()
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = [Thread(target=_feed_pipeline, args=(source, queues[0], stop_event), daemon=True)]
+    for stage, input_queue, output_queue in zip(stages, queues, queues[1:]):
+        threads.append(
+            Thread(target=_run_pipeline_stage, args=(stage, input_queue, output_queue, stop_event), daemon=True)
+        )
+    for thread in threads:
+        thread.start()
+    try:
+        for item in iter(queues[-1].get, _PIPELINE_END):
+            if isinstance(item, _PipelineError):
+                raise item.exception
+            yield item
+    finally:
+        stop_event.set()
+        threads[0].join()
+
+
 class ClickhouseContractTransactionsIterator():
     def _iterate_contracts(self, max_block=None, partial_query=None, fields=[]):
         query = partial_query
@@ -199,11 +336,36 @@ class ClickhouseContractTransactionsIterator():
         self.client.bulk_index(self.indices["contract_block"], docs)
 
     def _get_max_block(self, query={}, min_consistent_block=0):
-        query_string = " OR ".join(
-            ["(name = '{}' AND value = {})".format(field, value) for field, value in query.items()])
-        sql = "SELECT MAX(toInt32(id))"
-        if query_string:
-            sql += " FROM {} WHERE {}".format(self.indices["block_flag"], query_string)
+        """
+        Get last block which can be processed
+
+        Block ranges can be processed out of order by several extractor instances,
+        so only the end of processed blocks starting from min_consistent_block is taken for each flag.
+        Blocks before min_consistent_block are considered processed
+
+        Parameters
+        ----------
+        query : dict
+            Names of block flags, flags with false values are ignored
+        min_consistent_block : int
+            Block to return if less blocks are processed
+
+        Returns
+        -------
+        int
+            Block number
+        """
+        # Imported here because block_ranges module depends on this module
+        from operations.block_ranges import ClickhouseBlockRanges, merge_ranges
+        names = [field for field, value in query.items() if value]
+        if names:
+            max_blocks = []
+            for name in names:
+                ranges = ClickhouseBlockRanges(name, self.indices, self.client).get_ranges()
+                ranges = merge_ranges(ranges + [(0, min_consistent_block)])
+                max_blocks.append(ranges[0][1] - 1 if ranges and ranges[0][0] == 0 else -1)
+            max_block = min(max_blocks)
         else:
-            sql += " FROM {}".format(self.indices["block"])
-        return max(self.client.send_sql_request(sql), min_consistent_block)
+            sql = "SELECT MAX(toInt32(id)) FROM {}".format(self.indices["block"])
+            max_block = self.client.send_sql_request(sql)
+        return max(max_block, min_consistent_block)